@@ -5,15 +5,24 @@ Created on Jul 1, 2013
 '''
 from avatar.bintools.gdb.mi import GDB, Debugger
 import logging
+import re
 from avatar.bintools.gdb.mi_parser import Stream
+from avatar.util.checksum import gdb_crc32
 
 log = logging.getLogger(__name__)
 
 class GdbDebugger(Debugger):
+    #Largest block moved by a single -data-read/write-memory-bytes command
+    MEMORY_BYTES_CHUNK_SIZE = 0x10000
+
     def __init__(self, gdb_executable = "gdb", cwd = ".", additional_args = []):
         self._async_message_handler = None
         self._stream_handler = None
         self._register_names = None
+        #Console output of the running command, while it is captured
+        self._console_output = None
+        #Cleared when the stub does not answer qCRC
+        self._remote_crc_supported = True
         self._gdb = GDB(self, executable = gdb_executable, cwd = cwd, additional_args = additional_args)
   
     def insert_breakpoint(self, 
@@ -63,10 +72,54 @@ class GdbDebugger(Debugger):
         result = self._gdb.sync_cmd(["-data-read-memory", "0x%x" % address, "x", "%d" % size, "1", "1"], "done")
         return int(result["memory"][0]["data"][0], 16)
 
+    def read_untyped_memory(self, address, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk_size = min(length - len(data), self.MEMORY_BYTES_CHUNK_SIZE)
+            result = self._gdb.sync_cmd(["-data-read-memory-bytes", "0x%x" % (address + len(data)), "%d" % chunk_size], "done")
+            chunk = b"".join([bytes.fromhex(block["contents"]) for block in result["memory"]])
+            if len(chunk) != chunk_size:
+                raise Exception("Could only read %d of %d bytes at 0x%x" % (len(chunk), chunk_size, address + len(data)))
+            data += chunk
+        return bytes(data)
+
+    def write_untyped_memory(self, address, data):
+        data = memoryview(data)
+        for offset in range(0, len(data), self.MEMORY_BYTES_CHUNK_SIZE):
+            chunk = data[offset:offset + self.MEMORY_BYTES_CHUNK_SIZE]
+            self._gdb.sync_cmd(["-data-write-memory-bytes", "0x%x" % (address + offset), chunk.hex()], "done")
+
     def get_checksum(self, address, size):
-        result = self._gdb.sync_cmd(["-gdb-show", "remote", "checksum", "%x" % address, "%x" % size], "done")
-        print("And the result is: " + repr(result))
-        return int(result["value"], 10)
+        """
+        Return the CRC-32 of a memory range. The stub computes it with a
+        qCRC packet, so the memory is not transferred; OpenOCD, for
+        example, runs a CRC codelet on the target. Stubs without qCRC
+        support (e.g., QEMU) are read in bulk instead.
+        """
+        if self._remote_crc_supported:
+            reply = self._execute_console_command("maint packet qCRC:%x,%x" % (address, size))
+            match = re.search(r'received: "?C([0-9a-fA-F]+)', reply)
+            if match:
+                return int(match.group(1), 16)
+            if re.search(r'received: "?E', reply):
+                #Supported, but the stub could not access the range
+                raise Exception("qCRC of 0x%x bytes at 0x%x failed: %s" % (size, address, reply.strip()))
+            log.info("Remote stub does not support qCRC (reply: %s), computing checksums on the host", reply.strip())
+            self._remote_crc_supported = False
+        return gdb_crc32(self.read_untyped_memory(address, size))
+
+    def has_remote_checksum(self):
+        """Return True until the stub turned out not to support qCRC"""
+        return self._remote_crc_supported
+
+    def _execute_console_command(self, cmd):
+        """Execute a CLI command and return its console output"""
+        self._console_output = []
+        try:
+            self._gdb.sync_cmd(["-interpreter-exec", "console", "\"%s\"" % cmd], "done")
+            return "".join(self._console_output)
+        finally:
+            self._console_output = None
 
     def map_register_name(self, reg):
         if not self._register_names:
@@ -92,6 +145,37 @@ class GdbDebugger(Debugger):
         #reg_num = self.map_register_name(reg)
         self._gdb.sync_cmd(["-gdb-set", "$%s=0x%x" % (reg, value)], "done") 
 
+    def get_registers(self, regs):
+        """
+        Read several registers with one MI command. Raises an exception if
+        gdb does not know or cannot read a requested register.
+        """
+        numbers = {}
+        for reg in regs:
+            try:
+                numbers[self.map_register_name(reg)] = reg
+            except KeyError:
+                raise Exception("Register %s was requested, but gdb does not know it" % reg)
+        values = {}
+        if numbers:
+            result = self._gdb.sync_cmd(["-data-list-register-values", "x"] + ["%d" % x for x in numbers], "done")
+            for register in result["register-values"]:
+                reg = numbers[int(register["number"])]
+                try:
+                    values[reg] = int(register["value"], 16)
+                except ValueError:
+                    raise Exception("Register %s could not be read: %s" % (reg, register["value"]))
+        missing = [x for x in regs if not x in values]
+        if missing:
+            raise Exception("gdb did not return registers %s" % ", ".join(missing))
+        return values
+
+    def set_registers(self, values):
+        """Set several registers with one MI command, as a comma expression"""
+        if values:
+            expression = ",".join(["$%s=0x%x" % (reg, value) for (reg, value) in values.items()])
+            self._gdb.sync_cmd(["-data-evaluate-expression", expression], "done")
+
     def delete_breakpoint(self, bkpt):
         self._gdb.sync_cmd(["-break-delete", "%d" % bkpt], "done")
         
@@ -105,15 +189,25 @@ class GdbDebugger(Debugger):
         self._gdb.sync_cmd(["-exec-interrupt"],"done")
         
     def connect(self, proto_addr_port):
+        """
+        Connect to a remote gdb stub, given as ("tcp", host, port) or
+        ("unix", path). Unix domain sockets need a gdb that accepts a
+        local socket path as remote target.
+        """
         log.debug("Connecting to remote gdb: %s", ":".join(proto_addr_port))
-        self._gdb.sync_cmd(["-target-select", "remote", ":".join(proto_addr_port)], "connected")
+        if proto_addr_port[0] == "unix":
+            self._gdb.sync_cmd(["-target-select", "remote", proto_addr_port[1]], "connected")
+        else:
+            self._gdb.sync_cmd(["-target-select", "remote", ":".join(proto_addr_port)], "connected")
         
     def handle_async(self, msg):
         if self._async_message_handler:
             self._async_message_handler(msg)
             
     def handle_stream_msg(self, msg):
-        if self._stream_handler:
+        if self._console_output is not None and msg.type == Stream.CONSOLE:
+            self._console_output.append(msg.string)
+        elif self._stream_handler:
             self._stream_handler(msg)
         else:
             if msg.type == Stream.CONSOLE:
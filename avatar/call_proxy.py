@@ -4,7 +4,23 @@ Created on Jun 24, 2013
 @author: Jonas Zaddach <zaddach@eurecom.fr>
 '''
 
-from collections import defaultdict
+from bisect import bisect_right
+from collections import deque
+from threading import Condition, RLock, Thread
+import logging
+import time
+from avatar.util.cpu_state import to_cpu_state, get_pc
+from avatar.forwarding.overlay import StateOverlays
+from avatar.forwarding.policy import MemoryPolicy
+from avatar.forwarding.read_cache import ReadCache
+from avatar.forwarding.prefetch import Prefetcher
+from avatar.forwarding.monitors import IntervalIndex, MonitorRegistry
+from avatar.forwarding.write_combining import WriteCombiner
+from avatar.forwarding.polling import PollingDetector
+from avatar.forwarding.journal import UndoJournal
+from avatar.util.checksum import gdb_crc32
+
+log = logging.getLogger(__name__)
 
 class EmulatorTargetCallProxy():
     MONITOR_EVENTS = ["emulator_pre_read_request", 
@@ -12,48 +28,592 @@ class EmulatorTargetCallProxy():
                       "emulator_pre_write_request",
                       "emulator_post_write_request"]
     
-    def __init__(self):
+    def __init__(self, configuration = {}):
+        """
+        :param configuration: The "call_proxy" section of the Avatar
+            configuration. With "posted_writes" (default off), forwarded
+            writes to memory ranges without "io" set are queued and applied
+            to the target in order by a writer thread instead of on the
+            emulator's request thread. Reads that overlap a queued write
+            wait for it; writes to IO and unlisted addresses are never
+            queued, but wait for all queued writes, so peripherals see the
+            accesses in program order. All queued writes are flushed on
+            continue and on CPU state handover; a queued write that failed
+            fails the next request of the emulator.
+            "state_overlay_ranges" is a list of {"address", "size"} RAM
+            ranges that are kept per emulator state once the emulator forks
+            states (see StateOverlays), "endianness" the byte order used to
+            store word accesses in them.
+            "memory_ranges" lists the forwarded ranges with their access
+            policy (see avatar.forwarding.policy); accesses to cached, local,
+            rom and deny ranges are served without a target round trip.
+            "read_cache" configures the cache of the cached ranges with
+            "page_size" and "max_pages"; it is invalidated by writes and
+            whenever the target continues.
+            "prefetch" enables the stride prefetcher for forwarded reads
+            with "depth", "max_depth" and "exclude"; memory ranges with
+            "io" set or the deny policy are always excluded, and blocks do
+            not extend beyond the memory range of the access.
+            With "register_shadow" (default on), the last known target
+            registers are kept, so that a CPU state handover only writes
+            the registers that changed; the shadow is dropped when the
+            target runs or stops (see handle_target_event).
+            Writes to memory ranges with "combine_writes" set are merged
+            into runs of adjacent bytes that are written with one bulk
+            write (see WriteCombiner); "write_combining" sets its
+            "max_size" and "max_delay". A run older than max_delay is
+            written by the writer thread if no access flushed it before.
+            "polling" enables the detection of status polling loops in
+            forwarded reads with "threshold", "max_wait" and "interval";
+            a detected loop is fast-forwarded by polling the target until
+            the value changes (see PollingDetector).
+            The pre-images of target writes to memory ranges with "journal"
+            set are recorded in an UndoJournal, so that the target memory
+            can be rolled back to a checkpoint (see mark_checkpoint);
+            "undo_journal" sets its "block_size".
+        """
         self._target = None
-        self._monitor_hooks = defaultdict(list)
+        self._monitors = MonitorRegistry()
+        self._compile_monitor_hooks()
+        self._peripheral_models = []
+        #None without models, so the common case is one comparison
+        self._peripheral_index = None
+        self._posted_writes = configuration.get("posted_writes", False)
+        #Only plain memory may be written late
+        self._posted_ranges = sorted([(x["address"], x["address"] + x["size"])
+                                      for x in configuration.get("memory_ranges", []) if not x.get("io")])
+        self._posted_starts = [x[0] for x in self._posted_ranges]
+        #First failure of a queued write, reported with the next request
+        self._write_error = None
+        #Serializes target accesses of the request and the writer thread
+        self._target_lock = RLock()
+        #Writes stay in the queue until they are applied to the target
+        self._pending_writes = deque()
+        self._pending_writes_changed = Condition()
+        self._writer_thread = None
+        self._stopping = False
+        self._endianness = configuration.get("endianness", "little")
+        overlay_ranges = configuration.get("state_overlay_ranges", [])
+        self._overlays = overlay_ranges and StateOverlays(overlay_ranges) or None
+        read_cache = "read_cache" in configuration and ReadCache(**configuration["read_cache"]) or None
+        self._policy = MemoryPolicy(configuration.get("memory_ranges", []), read_cache)
+        self._read_cache = self._policy.read_cache
+        if self._policy.is_forward_only():
+            #Fast path: nothing to look up
+            self._policy = None
+        else:
+            self._policy.set_checksum_target(self._checksum_target_range)
+        self._use_register_shadow = configuration.get("register_shadow", True)
+        self._register_shadow = {}
+        self._register_statistics = {"set": 0, "skipped": 0, "read": 0, "cached": 0}
+        combined_ranges = [x for x in configuration.get("memory_ranges", []) if x.get("combine_writes")]
+        self._write_combiner = None
+        if combined_ranges:
+            self._write_combiner = WriteCombiner(combined_ranges, **configuration.get("write_combining", {}))
+        journaled_ranges = [x for x in configuration.get("memory_ranges", []) if x.get("journal")]
+        self._journal = None
+        if journaled_ranges:
+            self._journal = UndoJournal(journaled_ranges, **configuration.get("undo_journal", {}))
+        self._polling = "polling" in configuration and PollingDetector(**configuration["polling"]) or None
+        self._prefetcher = None
+        if "prefetch" in configuration:
+            prefetch = dict(configuration["prefetch"])
+            prefetch["exclude"] = list(prefetch.get("exclude", [])) + \
+                [x for x in configuration.get("memory_ranges", []) if x.get("io") or x.get("policy") == "deny"]
+            prefetch.setdefault("ranges", configuration.get("memory_ranges", []))
+            self._prefetcher = Prefetcher(**prefetch)
         
     def set_target(self, target):
         self._target = target
         
-    def add_monitor(self, monitor):
-        for monitor_event in self.MONITOR_EVENTS:
-            if hasattr(monitor, monitor_event):
-                self._monitor_hooks[monitor_event].append(monitor)
+    def add_monitor(self, monitor, ranges = None):
+        """
+        Register a monitor for the events in MONITOR_EVENTS it implements.
+        :param ranges: List of {"address", "size"} ranges; if given, the
+            monitor is only called for accesses that overlap them
+        """
+        self._monitors.add(monitor, ranges)
+        self._compile_monitor_hooks()
                 
     def remove_monitor(self, monitor):
-        for (_, monitor_hooks) in self._monitor_hooks.items():
-            try:
-                monitor_hooks.remove(monitor)
-            except ValueError:
-                pass
+        self._monitors.remove(monitor)
+        self._compile_monitor_hooks()
+
+    def add_peripheral_model(self, model):
+        """
+        Let a PeripheralModel (see avatar.plugins.peripheral_models) answer
+        the accesses to its range before they are forwarded. Where models
+        overlap, the one added first is asked first.
+        """
+        self._peripheral_models.append(model)
+        self._index_peripheral_models()
+
+    def remove_peripheral_model(self, model):
+        self._peripheral_models = [x for x in self._peripheral_models if x is not model]
+        self._index_peripheral_models()
+
+    def _index_peripheral_models(self):
+        models = self._peripheral_models
+        self._peripheral_index = models and IntervalIndex([(x.address, x.address + x.size, x) for x in models]) or None
+
+    def _read_peripheral_models(self, address, size):
+        """Return the value of the first model answering a read, or None to read the target"""
+        for model in self._peripheral_index.lookup(address, size):
+            value = model.handle_read(address, size)
+            if value is not None:
+                return value
+        return None
+
+    def _write_peripheral_models(self, params):
+        """Offer a write to the models, returns True if it must not reach the target"""
+        for model in self._peripheral_index.lookup(params["address"], params["size"]):
+            if model.handle_write(params["address"], params["size"], params["value"]):
+                if model.write_through:
+                    return False
+                if self._pre_write_hooks is not None:
+                    self._pre_write_hooks(params)
+                if self._post_write_hooks is not None:
+                    self._post_write_hooks(params)
+                return True
+        return False
+
+    def _compile_monitor_hooks(self):
+        #Each is None without monitors, so the common case is one comparison
+        self._pre_read_hooks = self._monitors.compile("emulator_pre_read_request")
+        self._post_read_hooks = self._monitors.compile("emulator_post_read_request")
+        self._pre_write_hooks = self._monitors.compile("emulator_pre_write_request")
+        self._post_write_hooks = self._monitors.compile("emulator_post_write_request")
         
+    def stop(self):
+        """Apply all queued writes and stop the writer thread"""
+        try:
+            self.flush_writes()
+        except RuntimeError as ex:
+            #No request is left to report it to
+            log.warning("%s", ex)
+        with self._pending_writes_changed:
+            self._stopping = True
+            self._pending_writes_changed.notify_all()
+        if self._writer_thread:
+            self._writer_thread.join()
+            self._writer_thread = None
+
+    def flush_writes(self):
+        """
+        Wait until all queued and combined writes have been applied to the
+        target. Raises if a queued write failed.
+        """
+        if self._write_combiner is not None:
+            self._flush_combined_writes()
+        if self._pending_writes:
+            with self._pending_writes_changed:
+                while self._pending_writes:
+                    self._pending_writes_changed.wait()
+        if self._write_error is not None:
+            self._raise_write_error()
+
+    def _raise_write_error(self):
+        (params, error) = self._write_error
+        self._write_error = None
+        raise RuntimeError("Posted write of %d bytes to 0x%08x failed: %s" %
+                           (params["size"], params["address"], error)) from error
+
+    def _may_post(self, address, size):
+        """Return True if a write may be queued, i.e., goes to plain memory"""
+        if not self._posted_writes:
+            return False
+        i = bisect_right(self._posted_starts, address) - 1
+        return i >= 0 and address + size <= self._posted_ranges[i][1]
+
+    def _wait_for_overlapping_writes(self, address, size):
+        end = address + size
+        with self._pending_writes_changed:
+            while any(write["address"] < end and address < write["address"] + write["size"] \
+                      for write in self._pending_writes):
+                self._pending_writes_changed.wait()
+
+    def _start_writer_thread(self):
+        """Start the writer thread if it is not running, call with _pending_writes_changed held"""
+        if not self._writer_thread:
+            self._stopping = False
+            self._writer_thread = Thread(target = self._process_writes, name = "CallProxyWriter")
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+
+    def _post_write(self, params):
+        with self._pending_writes_changed:
+            self._start_writer_thread()
+            self._pending_writes.append(params)
+            self._pending_writes_changed.notify_all()
+
+    def _wait_for_writes(self):
+        """
+        Wait on the writer thread until a write is queued, the writer is
+        stopped, or the combined run expires. Returns True for an expired run.
+        """
+        while not self._pending_writes and not self._stopping:
+            deadline = self._write_combiner is not None and self._write_combiner.get_deadline() or None
+            if deadline is None:
+                self._pending_writes_changed.wait()
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return True
+            self._pending_writes_changed.wait(timeout)
+        return False
+
+    def _process_writes(self):
+        while True:
+            with self._pending_writes_changed:
+                expired = self._wait_for_writes()
+                if not expired and not self._pending_writes:
+                    return
+                params = not expired and self._pending_writes[0] or None
+            if expired:
+                self._write_expired_run()
+                continue
+            #The monitors saw the write on the request thread already
+            try:
+                if "data" in params:
+                    self._write_target_range(params["address"], params["data"])
+                else:
+                    self._write_target_typed(params["address"], params["size"], params["value"])
+            except Exception as ex:
+                log.error("Posted write of %d bytes to 0x%08x failed: %s", params["size"], params["address"], ex)
+                if self._write_error is None:
+                    self._write_error = (params, ex)
+            with self._pending_writes_changed:
+                self._pending_writes.popleft()
+                self._pending_writes_changed.notify_all()
+
+    def _write_expired_run(self):
+        """
+        Write the combined run if it expired without an access flushing it.
+        Runs on the writer thread while no write is queued. The run is
+        taken and written under _target_lock, so that an access that finds
+        no run pending reaches the target only after it was written.
+        """
+        with self._target_lock:
+            run = self._write_combiner.take_expired()
+            if run is None:
+                return
+            (address, data) = run
+            try:
+                self._write_target_range(address, data)
+            except Exception as ex:
+                log.error("Combined write of %d bytes to 0x%08x failed: %s", len(data), address, ex)
+                if self._write_error is None:
+                    self._write_error = ({"address": address, "size": len(data), "data": data}, ex)
+        self.invalidate_read_cache(address, len(data))
+
+    def _flush_combined_writes(self, address = None, size = None):
+        """Write the combined run if it overlaps a range or expired, or in any case without range"""
+        run = self._write_combiner.take(address, size)
+        if run is not None:
+            self._write_combined(run)
+
+    def _write_combined(self, run):
+        (address, data) = run
+        if self._may_post(address, len(data)):
+            self._post_write({"address": address, "size": len(data), "data": data})
+        else:
+            self._write_target_range(address, data)
+        #Bulk reads may have cached the bytes of the run from before it was flushed
+        self.invalidate_read_cache(address, len(data))
+
+    def _combine_write(self, params):
+        if self._pre_write_hooks is not None:
+            self._pre_write_hooks(params)
+        pending = self._write_combiner.is_pending()
+        run = self._write_combiner.add(params["address"], params["value"].to_bytes(params["size"], self._endianness))
+        if run is not None:
+            self._write_combined(run)
+        if (run is not None or not pending) and self._write_combiner.is_pending():
+            #A new run was started, the writer thread flushes it once it expires
+            with self._pending_writes_changed:
+                self._start_writer_thread()
+                self._pending_writes_changed.notify_all()
+        if self._post_write_hooks is not None:
+            self._post_write_hooks(params)
+
+    def mark_checkpoint(self):
+        """Return a checkpoint of the journaled target memory to roll back to"""
+        assert(self._journal is not None) #No memory range has "journal" set
+        #Writes posted before belong to the state of the checkpoint
+        self.flush_writes()
+        return self._journal.mark()
+
+    def rollback(self, checkpoint):
+        """
+        Restore the journaled target memory to a checkpoint with bulk writes.
+        Returns the number of bytes restored.
+        """
+        assert(self._journal is not None) #No memory range has "journal" set
+        self.flush_writes()
+        restored = self._journal.rollback(checkpoint, lambda address, data: self._write_memory(address, data, journal = False))
+        self.invalidate_read_cache()
+        return restored
+
+    def write_memory(self, address, data):
+        """
+        Write target memory on behalf of Avatar, e.g., to synchronize RAM.
+        The write is journaled, and the host-side copies of the memory
+        (policy ranges, read cache, prefetcher) take it over.
+        """
+        self.flush_writes()
+        self._write_memory(address, data)
+        self.invalidate_read_cache(address, len(data))
+
+    def _write_memory(self, address, data, journal = True):
+        self._write_target_range(address, data, journal)
+        if self._policy is not None:
+            self._policy.target_written(address, data)
+
+    def get_journal_statistics(self):
+        """Return the counters of the UndoJournal, or None if it is disabled"""
+        return self._journal is not None and self._journal.get_statistics() or None
+
+    def get_polling_statistics(self):
+        """Return the counters and the fast-forwarded loops of the PollingDetector, or None"""
+        if self._polling is None:
+            return None
+        return dict(self._polling.get_statistics(), loops = self._polling.get_loops())
+
+    def get_write_combining_statistics(self):
+        """Return the counters of the WriteCombiner, or None if no range combines writes"""
+        return self._write_combiner is not None and self._write_combiner.get_statistics() or None
+
+    def _uses_overlay(self, address, size):
+        """Return True if an access is served by the overlay of its state"""
+        return self._overlays is not None and self._overlays.is_active() \
+            and self._overlays.covers(address, size)
+
+    def _get_policy_range(self, address, size):
+        """Return the PolicyRange serving an access, or None if it goes to the target"""
+        return self._policy is not None and self._policy.lookup(address, size) or None
+
+    def get_memory_policy(self):
+        """Return the MemoryPolicy, or None if all accesses are forwarded"""
+        return self._policy
+
+    def invalidate_read_cache(self, address = None, size = None):
+        """Drop cached and prefetched target memory overlapping a range, or all of it"""
+        if self._read_cache is not None:
+            self._read_cache.invalidate(address, size)
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate(address, size)
+
+    def get_prefetcher(self):
+        """Return the Prefetcher, or None if prefetching is disabled"""
+        return self._prefetcher
+
+    @staticmethod
+    def _get_state(params):
+        return params and params.get("state", 0) or 0
+
+    def _read_target_range(self, address, size):
+        if self._write_combiner is not None and self._write_combiner.is_pending():
+            #Bulk reads, e.g., of the prefetcher, may cover the combined run
+            self._flush_combined_writes(address, size)
+        if self._pending_writes:
+            self._wait_for_overlapping_writes(address, size)
+        return self._read_target_now(address, size)
+
+    def _checksum_target_range(self, address, size):
+        """Return the target-side CRC-32 of a range, or None if the target would have to send it"""
+        if not self._target.has_remote_checksum():
+            return None
+        if self._write_combiner is not None and self._write_combiner.is_pending():
+            self._flush_combined_writes(address, size)
+        if self._pending_writes:
+            self._wait_for_overlapping_writes(address, size)
+        with self._target_lock:
+            return self._target.get_checksum(address, size)
+
+    def _read_target_now(self, address, size):
+        """Read the target without waiting for posted writes"""
+        with self._target_lock:
+            return self._target.read_untyped_memory(address, size)
+
+    def _write_target_range(self, address, data, journal = True):
+        if journal and self._journal is not None:
+            #Runs on the writer thread for posted writes, which is just before the write
+            self._journal.record(address, len(data), self._read_target_now)
+        with self._target_lock:
+            self._target.write_untyped_memory(address, data)
+
+    def _read_target_typed(self, address, size):
+        with self._target_lock:
+            return self._target.read_typed_memory(address, size)
+
+    def _write_target_typed(self, address, size, value):
+        if self._journal is not None:
+            self._journal.record(address, size, self._read_target_now)
+        with self._target_lock:
+            self._target.write_typed_memory(address, size, value)
+
+    def _materialize_overlay(self, state):
+        """Let the target memory hold the view of state before it executes"""
+        self._overlays.materialize(state, self._read_target_range, self._write_target_range)
+
     def handle_emulator_read_request(self, params):
         assert(self._target)
         
-        for monitor in self._monitor_hooks["emulator_pre_read_request"]:
-            monitor.emulator_pre_read_request(params)
+        if self._write_error is not None:
+            self._raise_write_error()
+        if self._write_combiner is not None and self._write_combiner.is_pending():
+            self._flush_combined_writes(params["address"], params["size"])
+        overlay = self._uses_overlay(params["address"], params["size"])
+        policy_range = self._get_policy_range(params["address"], params["size"])
+        #Fast path: without queued writes there is nothing to wait for
+        if self._pending_writes and not overlay and policy_range is None:
+            self._wait_for_overlapping_writes(params["address"], params["size"])
+
+        if self._pre_read_hooks is not None:
+            self._pre_read_hooks(params)
+
+        value = None
+        if self._peripheral_index is not None and not overlay:
+            value = self._read_peripheral_models(params["address"], params["size"])
             
-        params["value"] = self._target.read_typed_memory(params["address"], params["size"])
+        if value is not None:
+            params["value"] = value
+        elif overlay:
+            data = self._overlays.read(self._get_state(params), params["address"], params["size"], self._read_target_range)
+            params["value"] = int.from_bytes(data, self._endianness)
+        elif policy_range is not None:
+            data = policy_range.read(params["address"], params["size"], self._read_target_range)
+            params["value"] = int.from_bytes(data, self._endianness)
+        else:
+            data = None
+            if self._prefetcher is not None:
+                data = self._prefetcher.read(get_pc(params), params["address"], params["size"], self._read_target_range)
+            if data is not None:
+                params["value"] = int.from_bytes(data, self._endianness)
+            else:
+                params["value"] = self._read_target_typed(params["address"], params["size"])
+                if self._polling is not None:
+                    pc = get_pc(params)
+                    if pc is not None:
+                        params["value"] = self._polling.read(pc, params["address"], params["size"], params["value"],
+                                                             self._read_target_typed)
         
-        for monitor in self._monitor_hooks["emulator_post_read_request"]:
-            monitor.emulator_post_read_request(params)
+        if self._post_read_hooks is not None:
+            self._post_read_hooks(params)
             
         return params["value"]
             
     def handle_emulator_write_request(self, params):
         assert(self._target)
         
-        for monitor in self._monitor_hooks["emulator_pre_write_request"]:
-            monitor.emulator_pre_write_request(params)
+        if self._write_error is not None:
+            self._raise_write_error()
+        if self._polling is not None:
+            self._polling.note_write()
+        if self._uses_overlay(params["address"], params["size"]):
+            self._apply_write(params, overlay = True)
+            return
+        if self._peripheral_index is not None and self._write_peripheral_models(params):
+            return
+        policy_range = self._get_policy_range(params["address"], params["size"])
+        if self._write_combiner is not None:
+            if policy_range is None and self._write_combiner.covers(params["address"], params["size"]):
+                self.invalidate_read_cache(params["address"], params["size"])
+                self._combine_write(params)
+                return
+            #Other writes must not overtake the combined ones
+            self._flush_combined_writes()
+        posted = self._may_post(params["address"], params["size"])
+        if not posted and self._pending_writes:
+            #Writes to IO must not overtake queued ones
+            self.flush_writes()
+        if policy_range is not None and not (posted and policy_range.forwards_writes):
+            self._apply_write(params, policy_range)
+            return
+        if policy_range is not None:
+            #The policy range sees the write now, the target when it is applied
+            policy_range.write(params["address"], params["value"].to_bytes(params["size"], self._endianness))
+        else:
+            #The write may overlap cached or prefetched memory
+            self.invalidate_read_cache(params["address"], params["size"])
+        if posted:
+            if self._pre_write_hooks is not None:
+                self._pre_write_hooks(params)
+            self._post_write(params)
+            if self._post_write_hooks is not None:
+                self._post_write_hooks(params)
+        else:
+            self._apply_write(params)
+
+    def _apply_write(self, params, policy_range = None, overlay = False):
+        if self._pre_write_hooks is not None:
+            self._pre_write_hooks(params)
             
-        self._target.write_typed_memory(params["address"], params["size"], params["value"])
+        if overlay:
+            self._overlays.write(self._get_state(params), params["address"],
+                                 params["value"].to_bytes(params["size"], self._endianness))
+        elif policy_range is None or policy_range.write(params["address"],
+                                                        params["value"].to_bytes(params["size"], self._endianness)):
+            self._write_target_typed(params["address"], params["size"], params["value"])
         
-        for monitor in self._monitor_hooks["emulator_post_write_request"]:
-            monitor.emulator_post_write_request(params)
+        if self._post_write_hooks is not None:
+            self._post_write_hooks(params)
+
+    def handle_emulator_read_range_request(self, params):
+        assert(self._target)
+
+        if self._write_error is not None:
+            self._raise_write_error()
+        if self._write_combiner is not None and self._write_combiner.is_pending():
+            self._flush_combined_writes(params["address"], params["size"])
+        if self._uses_overlay(params["address"], params["size"]):
+            return self._overlays.read(self._get_state(params), params["address"], params["size"], self._read_target_range)
+        policy_range = self._get_policy_range(params["address"], params["size"])
+        if policy_range is not None:
+            return policy_range.read(params["address"], params["size"], self._read_target_range)
+        return self._read_target_range(params["address"], params["size"])
+
+    def handle_emulator_write_range_request(self, params):
+        assert(self._target)
+
+        if self._write_error is not None:
+            self._raise_write_error()
+        if self._polling is not None:
+            self._polling.note_write()
+        if self._uses_overlay(params["address"], params["size"]):
+            self._overlays.write(self._get_state(params), params["address"], params["data"])
+            return
+        policy_range = self._get_policy_range(params["address"], len(params["data"]))
+        if policy_range is not None and not policy_range.write(params["address"], params["data"]):
+            return
+        self.invalidate_read_cache(params["address"], len(params["data"]))
+        #Keep the order with earlier posted writes; the data may be a view
+        #of a mapped file, so the range is written before returning
+        self.flush_writes()
+        self._write_target_range(params["address"], params["data"])
+
+    def handle_emulator_fork_state_request(self, params):
+        if self._overlays is None:
+            log.warning("Emulator forked state %d, but no state_overlay_ranges are configured; "
+                        "the states share the target memory", params["state"])
+            return
+        #Writes issued before the fork belong to both states
+        self.flush_writes()
+        self._overlays.fork(params["state"], params["child"])
+
+    def handle_emulator_kill_state_request(self, params):
+        if self._overlays is None:
+            return
+        remaining = self._overlays.kill(params["state"])
+        if remaining is not None:
+            #Back to a single state, which accesses the target directly again
+            self._materialize_overlay(remaining)
+
+    #Registers sent to the emulator on get_cpu_state, with the names they are sent as
+    CPU_STATE_REGISTERS = [("r%d" % x, "r%d" % x) for x in range(13)] + \
+        [("sp", "r13"), ("lr", "r14"), ("pc", "pc")]
+    #Emulator register name -> target register name, the shadow uses the latter
+    TARGET_REGISTER_NAMES = dict((name, reg) for (reg, name) in CPU_STATE_REGISTERS)
 
     def handle_emulator_set_cpu_state_request(self, params):
         # this function sets the CPU state on the target device
@@ -61,42 +621,81 @@ class EmulatorTargetCallProxy():
 
         # TODO: fire events?
 
-        for reg in params["cpu_state"]:
-            if reg == "cpsr":
-                # skip cpsr register
-                continue
-            value = int(params["cpu_state"][reg], 16)
-            self._target.set_register(reg, value)
+        self.flush_writes()
+        cpu_state = to_cpu_state(params["cpu_state"])
+        # skip cpsr register
+        values = dict((self.TARGET_REGISTER_NAMES.get(reg, reg), cpu_state.get_value(reg)) for reg in cpu_state if reg != "cpsr")
+        with self._target_lock:
+            shadow = self._register_shadow
+            changed = dict((reg, value) for (reg, value) in values.items() if shadow.get(reg) != value)
+            if changed:
+                self._target.set_registers(changed)
+            if self._use_register_shadow:
+                shadow.update(changed)
+            self._register_statistics["set"] += len(changed)
+            self._register_statistics["skipped"] += len(values) - len(changed)
 
     def handle_emulator_get_cpu_state_request(self, params):
         # this function gets the CPU state on the target device
         assert(self._target)
 
         # TODO: fire events?
-        ret = {}
-
-        for r in range(13):
-            val = self._target.get_register("r"+str(r))
-            ret["cpu_state_"+"r"+str(r)] = hex(val)
-        val = self._target.get_register("sp")
-        ret["cpu_state_r13"] = hex(val)
-        val = self._target.get_register("lr")
-        ret["cpu_state_r14"] = hex(val)
-        val = self._target.get_register("pc")
-        ret["cpu_state_pc"] = hex(val)
-        return ret
+
+        self.flush_writes()
+        with self._target_lock:
+            values = dict(self._register_shadow)
+            missing = [reg for (reg, _) in self.CPU_STATE_REGISTERS if not reg in values]
+            if missing:
+                values.update(self._target.get_registers(missing))
+                if self._use_register_shadow:
+                    self._register_shadow.update(values)
+            self._register_statistics["read"] += len(missing)
+            self._register_statistics["cached"] += len(self.CPU_STATE_REGISTERS) - len(missing)
+        return dict(("cpu_state_" + name, hex(values[reg])) for (reg, name) in self.CPU_STATE_REGISTERS)
+
+    def invalidate_register_shadow(self):
+        """
+        Forget the last known target registers. Needs to be called by code
+        that changes target registers without going through the proxy.
+        """
+        with self._target_lock:
+            self._register_shadow = {}
+
+    def handle_target_event(self, evt):
+        """
+        Called by the thread that observed a target event, before the event
+        is queued for the listeners. The target registers may have changed
+        when it ran, stepped or stopped, so the shadow is dropped right
+        away, and no request served until the listeners run sees it.
+        """
+        with self._target_lock:
+            self._register_shadow = {}
+
+    def get_register_statistics(self):
+        """Return how many registers were written or read, and how many of these were avoided"""
+        return dict(self._register_statistics)
 
     def handle_emulator_continue_request(self, params):
         assert(self._target)
 
-        self._target.cont()
+        self.flush_writes()
+        if self._overlays is not None and self._overlays.is_active():
+            self._materialize_overlay(self._get_state(params))
+        self.invalidate_read_cache()
+        if self._polling is not None:
+            self._polling.reset()
+        with self._target_lock:
+            self._register_shadow = {}
+            self._target.cont()
 
     def handle_emulator_get_checksum_request(self, params):
         assert(self._target)
 
-        cmd = "-gdb-show remote checksum %s %s" % \
-                (hex(params['address'])[2:], params['size'][2:])
-        return self._target.execute_gdb_command(cmd)
-        #return self._target.get_checksum(\
-        #        params['address'], params['size'])
+        (address, size) = (params["address"], params["size"])
+        if self._uses_overlay(address, size) or self._get_policy_range(address, size) is not None:
+            #The emulator does not see the target memory here
+            return gdb_crc32(self.handle_emulator_read_range_request(params))
+        self.flush_writes()
+        with self._target_lock:
+            return self._target.get_checksum(address, size)
 
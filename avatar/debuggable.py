@@ -3,6 +3,7 @@ Created on May 3, 2013
 
 @author: Jonas Zaddach <zaddach@eurecom.fr>
 '''
+from avatar.util.checksum import gdb_crc32
 
 class Breakpoint():
     """This is an interface for breakpoints that are created by Debuggable.set_breakpoint"""
@@ -47,6 +48,14 @@ class Debuggable():
         for byte in data:
             self.write_typed_memory(address, 1, byte)
             address += 1
+
+    def get_checksum(self, address, size):
+        """Return the CRC-32 of a memory range, as computed by gdb's qCRC packet"""
+        return gdb_crc32(self.read_untyped_memory(address, size))
+
+    def has_remote_checksum(self):
+        """Return True if get_checksum does not transfer the memory"""
+        return False
         
     def get_register(self, register):
         """Return the value of a register"""
@@ -55,6 +64,15 @@ class Debuggable():
     def set_register(self, register, value):
         """Set the value of a register"""
         assert(False) #No implementation
+
+    def get_registers(self, registers):
+        """Return a dict of the values of several registers"""
+        return dict((register, self.get_register(register)) for register in registers)
+
+    def set_registers(self, values):
+        """Set several registers from a dict of register name to value"""
+        for (register, value) in values.items():
+            self.set_register(register, value)
         
     def set_breakpoint(self, address, **properties):
         """
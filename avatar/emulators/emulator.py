@@ -1,6 +1,7 @@
 from avatar.debuggable import Debuggable
 from avatar.system import EVENT_REQUEST_WRITE_MEMORY_VALUE,\
-    EVENT_REQUEST_READ_MEMORY_VALUE
+    EVENT_REQUEST_READ_MEMORY_VALUE, EVENT_REQUEST_READ_MEMORY_RANGE,\
+    EVENT_REQUEST_WRITE_MEMORY_RANGE
 
 class Emulator(Debuggable):
     def __init__(self, system):
@@ -12,6 +13,10 @@ class Emulator(Debuggable):
         self._get_cpu_state_handler = None
         self._continue_handler = None
         self._get_checksum_handler = None
+        self._read_range_handler = None
+        self._write_range_handler = None
+        self._fork_state_handler = None
+        self._kill_state_handler = None
         
     def set_read_request_handler(self, handler):
         self._read_handler = handler
@@ -31,6 +36,18 @@ class Emulator(Debuggable):
     def set_get_checksum_request_handler(self, handler):
         self._get_checksum_handler = handler
 
+    def set_read_range_request_handler(self, handler):
+        self._read_range_handler = handler
+
+    def set_write_range_request_handler(self, handler):
+        self._write_range_handler = handler
+
+    def set_fork_state_request_handler(self, handler):
+        self._fork_state_handler = handler
+
+    def set_kill_state_request_handler(self, handler):
+        self._kill_state_handler = handler
+
     def _notify_read_request_handler(self, params):
         self._system.post_event({"source": "emulator", 
                                  "tags": [EVENT_REQUEST_READ_MEMORY_VALUE],
@@ -71,3 +88,31 @@ class Emulator(Debuggable):
 
         return self._get_checksum_handler(params)
 
+    def _notify_read_range_handler(self, params):
+        #The data is not part of the event, it may be a view of a mapped file
+        self._system.post_event({"source": "emulator",
+                                 "tags": [EVENT_REQUEST_READ_MEMORY_RANGE],
+                                 "properties": {"address": params["address"], "size": params["size"]}})
+        assert(self._read_range_handler) #Read range handler must be set at this point
+
+        return self._read_range_handler(params)
+
+    def _notify_write_range_handler(self, params):
+        self._system.post_event({"source": "emulator",
+                                 "tags": [EVENT_REQUEST_WRITE_MEMORY_RANGE],
+                                 "properties": {"address": params["address"], "size": params["size"]}})
+        assert(self._write_range_handler) #Write range handler must be set at this point
+
+        return self._write_range_handler(params)
+
+    def _notify_fork_state_handler(self, params):
+        # TODO: we don't have a notify event
+        assert(self._fork_state_handler)
+
+        return self._fork_state_handler(params)
+
+    def _notify_kill_state_handler(self, params):
+        # TODO: we don't have a notify event
+        assert(self._kill_state_handler)
+
+        return self._kill_state_handler(params)
@@ -3,7 +3,7 @@ import shutil
 import json
 import tempfile
 import logging
-from avatar.util.ostools import get_random_free_port
+from avatar.util.ostools import get_random_free_port, is_unix_address, format_address
 from collections import OrderedDict
 
 log = logging.getLogger(__name__)
@@ -21,7 +21,7 @@ class S2EConfiguration():
         self._qemu_configuration = ("qemu_configuration" in config) and config["qemu_configuration"] or {}
         
         mem_addr = "127.0.0.1"
-        mem_port = get_random_free_port()
+        mem_port = None
         if not isinstance(self._s2e_configuration["plugins"],OrderedDict):
             log.warn("plugins dictionnary should be ordered (use OrderedDict), s2e should take care of ordering plugins one day !")
         if "RemoteMemory" in self._s2e_configuration["plugins"] \
@@ -29,11 +29,37 @@ class S2EConfiguration():
           and self._s2e_configuration["plugins"]["RemoteMemory"]["listen_address"]:
             listen_addr = self._s2e_configuration["plugins"]["RemoteMemory"]["listen_address"]
             mem_addr = str(listen_addr[:listen_addr.rfind(":")])
-            mem_port = int(listen_addr[listen_addr.rfind(":") + 1:])
-        self._s2e_remote_memory_plugin_sockaddr = (mem_addr, mem_port)
+            mem_port = listen_addr[listen_addr.rfind(":") + 1:]
+            if listen_addr.startswith("shm:"):
+                #Shared-memory ring file created by Avatar
+                mem_addr = self._get_local_endpoint(listen_addr, "remote_memory.ring")
+            elif is_unix_address(listen_addr):
+                mem_addr = self._get_local_endpoint(listen_addr, "remote_memory.sock")
+        if mem_addr.startswith("shm:") or is_unix_address(mem_addr):
+            self._s2e_remote_memory_plugin_sockaddr = mem_addr
+        else:
+            self._s2e_remote_memory_plugin_sockaddr = (mem_addr, mem_port and int(mem_port) or get_random_free_port())
         
-        #TODO: Test if this is specified in configuration, and use values from config if so
-        self._s2e_gdb_sockaddr = ("127.0.0.1", get_random_free_port())
+        gdb_addr = "gdb_address" in self._qemu_configuration and self._qemu_configuration["gdb_address"] or None
+        if gdb_addr and is_unix_address(gdb_addr):
+            self._s2e_gdb_sockaddr = self._get_local_endpoint(gdb_addr, "qemu_gdb.sock")
+        elif gdb_addr:
+            if gdb_addr.startswith("tcp:"):
+                gdb_addr = gdb_addr[4:]
+            self._s2e_gdb_sockaddr = (gdb_addr[:gdb_addr.rfind(":")], int(gdb_addr[gdb_addr.rfind(":") + 1:]))
+        else:
+            self._s2e_gdb_sockaddr = ("127.0.0.1", get_random_free_port())
+
+    def _get_local_endpoint(self, address, default_name):
+        """
+        Complete a "unix:" or "shm:" address. If no path is given, a file
+        in the output directory is used, so that parallel instances never
+        compete for the same endpoint.
+        """
+        (scheme, path) = address.split(":", 1)
+        if not path:
+            path = os.path.join(self._output_directory, default_name)
+        return "%s:%s" % (scheme, path)
         
 
     def get_klee_cmdline(self):
@@ -111,7 +137,11 @@ class S2EConfiguration():
                 # using the listen config from the main python config file
                 host, port = plug_conf["listen"].split(':')
                 self._s2e_remote_memory_plugin_sockaddr = (host, int(port))
-            lua.append("listen = \"%s:%d\"," % self._s2e_remote_memory_plugin_sockaddr)
+            if self.is_remote_memory_server():
+                #Avatar listens, the plugin connects to it
+                lua.append("connect = \"%s\"," % format_address(self._s2e_remote_memory_plugin_sockaddr))
+            else:
+                lua.append("listen = \"%s\"," % format_address(self._s2e_remote_memory_plugin_sockaddr))
             lua.append("ranges = {")
             ranges = []
             for (range_name, mem_range) in plug_conf["ranges"].items():
@@ -209,9 +239,11 @@ class S2EConfiguration():
         cmdline.append(os.path.join(self._output_directory, "configurable_machine.json"))
         if "halt_processor_on_startup" in self._qemu_configuration and self._qemu_configuration["halt_processor_on_startup"]:
             cmdline.append("-S")
-        self._qemu_configuration["gdb"] = "tcp::%d,server" % get_random_free_port()
         cmdline.append("-gdb")
-        cmdline.append("tcp:127.0.0.1:%d,server" % self._s2e_gdb_sockaddr[1])
+        if is_unix_address(self._s2e_gdb_sockaddr):
+            cmdline.append("%s,server" % self._s2e_gdb_sockaddr)
+        else:
+            cmdline.append("tcp:%s:%d,server" % self._s2e_gdb_sockaddr)
         if "append" in self._qemu_configuration:
             for val in self._qemu_configuration["append"]:
                 cmdline.append(val)
@@ -298,5 +330,39 @@ class S2EConfiguration():
     def get_s2e_gdb_port(self):
         return self._s2e_gdb_sockaddr[1]
 
+    def get_s2e_gdb_address(self):
+        """Return the address of the QEMU gdb stub, a (host, port) tuple or a "unix:/path" string"""
+        return self._s2e_gdb_sockaddr
+
     def get_remote_memory_listen_address(self):
         return self._s2e_remote_memory_plugin_sockaddr
+
+    def is_remote_memory_server(self):
+        """Return True if Avatar accepts RemoteMemory connections instead of connecting to the plugin"""
+        plug_conf = self._s2e_configuration["plugins"].get("RemoteMemory") or {}
+        return "server" in plug_conf and plug_conf["server"] or False
+
+    def is_remote_memory_shared_memory(self):
+        """Return True if the RemoteMemory plugin talks to Avatar through a shared-memory ring"""
+        return isinstance(self._s2e_remote_memory_plugin_sockaddr, str) \
+            and self._s2e_remote_memory_plugin_sockaddr.startswith("shm:")
+
+    def get_remote_memory_wire_format(self):
+        """Return the wire format Avatar proposes to the RemoteMemory plugin"""
+        plug_conf = self._s2e_configuration["plugins"].get("RemoteMemory") or {}
+        return "wire_format" in plug_conf and plug_conf["wire_format"] or "json"
+
+    def get_remote_memory_record_path(self):
+        """Return the path of the log RemoteMemory sessions are recorded to, or None"""
+        return self._get_remote_memory_log_path("record")
+
+    def get_remote_memory_replay_path(self):
+        """Return the path of the log RemoteMemory requests are answered from, or None"""
+        return self._get_remote_memory_log_path("replay")
+
+    def _get_remote_memory_log_path(self, option):
+        plug_conf = self._s2e_configuration["plugins"].get("RemoteMemory") or {}
+        if not option in plug_conf or not plug_conf[option]:
+            return None
+        #Relative paths are relative to the output directory
+        return os.path.join(self._output_directory, plug_conf[option])
@@ -2,10 +2,13 @@ from avatar.emulators.s2e.configuration import S2EConfiguration
 import logging
 import subprocess
 import os
-from avatar.interfaces.s2e_remote_memory import S2ERemoteMemoryInterface
+from avatar.interfaces.s2e_remote_memory import S2ERemoteMemoryInterface, S2ERemoteMemoryServer, \
+    SharedMemoryRemoteMemoryInterface
+from avatar.interfaces.remote_memory_recording import RemoteMemoryRecorder, RemoteMemoryReplay
 from avatar.emulators.emulator import Emulator
 import time
 from avatar.util.processes import find_processes
+from avatar.util.ostools import is_unix_address
 import signal
 import threading
 from avatar.bintools.gdb.gdb_debugger import GdbDebugger
@@ -74,6 +77,24 @@ class S2EEmulator(Emulator):
     def stop(self):
         if hasattr(self, "_s2e_process"):
             self._s2e_process.kill()
+        if hasattr(self, "_remote_memory_interface"):
+            self._remote_memory_interface.dump_statistics(
+                os.path.join(self._configuration.get_output_directory(), "remote_memory_statistics.json"))
+        if hasattr(self, "_remote_memory_recorder"):
+            self._remote_memory_recorder.close()
+        if hasattr(self, "_remote_memory_replay"):
+            divergence = self._remote_memory_replay.get_divergence()
+            log.info("Replayed %d RemoteMemory requests, %s", self._remote_memory_replay.get_position(),
+                     divergence and "diverged at request %d" % divergence["sequence"] or "no divergence")
+
+    def get_remote_memory_statistics(self):
+        """
+        Return the latency and throughput counters of the RemoteMemory
+        bridge, or None if the RemoteMemory plugin is not used
+        """
+        if not hasattr(self, "_remote_memory_interface"):
+            return None
+        return self._remote_memory_interface.get_statistics()
             
     def exit(self):
         if hasattr(self, "_remote_memory_interface"):
@@ -81,9 +102,51 @@ class S2EEmulator(Emulator):
             
         print("Exiting")
         
+    def _has_remote_memory(self):
+        return "RemoteMemory" in self._configuration._s2e_configuration["plugins"]
+
+    def _avatar_creates_remote_memory_endpoint(self):
+        return self._configuration.is_remote_memory_server() or \
+            self._configuration.is_remote_memory_shared_memory()
+
+    def _start_remote_memory_interface(self):
+        if self._configuration.is_remote_memory_shared_memory():
+            self._remote_memory_interface = SharedMemoryRemoteMemoryInterface(self._configuration.get_remote_memory_listen_address()[4:],
+                                                                              self._configuration.get_remote_memory_wire_format())
+        elif self._configuration.is_remote_memory_server():
+            self._remote_memory_interface = S2ERemoteMemoryServer(self._configuration.get_remote_memory_listen_address(),
+                                                                  [self._configuration.get_remote_memory_wire_format(), "json"])
+        else:
+            self._remote_memory_interface = S2ERemoteMemoryInterface(self._configuration.get_remote_memory_listen_address(),
+                                                                     self._configuration.get_remote_memory_wire_format())
+        if self._configuration.get_remote_memory_replay_path():
+            #Answer the emulator from a recorded session instead of the target
+            log.info("Replaying RemoteMemory session from %s", self._configuration.get_remote_memory_replay_path())
+            self._remote_memory_replay = RemoteMemoryReplay(self._configuration.get_remote_memory_replay_path())
+            self._remote_memory_replay.attach(self._remote_memory_interface)
+        else:
+            self._remote_memory_interface.set_read_handler(self._notify_read_request_handler)
+            self._remote_memory_interface.set_write_handler(self._notify_write_request_handler)
+            self._remote_memory_interface.set_set_cpu_state_handler(self._notify_set_cpu_state_handler)
+            self._remote_memory_interface.set_get_cpu_state_handler(self._notify_get_cpu_state_handler)
+            self._remote_memory_interface.set_continue_handler(self._notify_continue_handler)
+            self._remote_memory_interface.set_get_checksum_handler(self._notify_get_checksum_handler)
+            self._remote_memory_interface.set_read_range_handler(self._notify_read_range_handler)
+            self._remote_memory_interface.set_write_range_handler(self._notify_write_range_handler)
+            self._remote_memory_interface.set_fork_state_handler(self._notify_fork_state_handler)
+            self._remote_memory_interface.set_kill_state_handler(self._notify_kill_state_handler)
+        if self._configuration.get_remote_memory_record_path():
+            self._remote_memory_recorder = RemoteMemoryRecorder(self._configuration.get_remote_memory_record_path())
+            self._remote_memory_interface.set_recorder(self._remote_memory_recorder)
+        self._remote_memory_interface.start()
+
     def run_s2e_process(self):
         try:
             log.info("Starting S2E process: %s", " ".join(["'%s'" % x for x in self._cmdline]))
+
+            if self._has_remote_memory() and self._avatar_creates_remote_memory_endpoint():
+                #The plugin attaches to Avatar, so be ready before it is started
+                self._start_remote_memory_interface()
         
             self._s2e_process = subprocess.Popen(
                         self._cmdline, 
@@ -99,20 +162,9 @@ class S2EEmulator(Emulator):
                     stdin = self._s2e_process.stderr, 
                     cwd = self._configuration.get_output_directory())
 
-            remote_target = False
-            if "RemoteMemory" in self._configuration._s2e_configuration["plugins"]:
-                remote_target= True
-
-            if remote_target:
-                self._remote_memory_interface = S2ERemoteMemoryInterface(self._configuration.get_remote_memory_listen_address())
-                self._remote_memory_interface.set_read_handler(self._notify_read_request_handler)
-                self._remote_memory_interface.set_write_handler(self._notify_write_request_handler)
-                self._remote_memory_interface.set_set_cpu_state_handler(self._notify_set_cpu_state_handler)
-                self._remote_memory_interface.set_get_cpu_state_handler(self._notify_get_cpu_state_handler)
-                self._remote_memory_interface.set_continue_handler(self._notify_continue_handler)
-                self._remote_memory_interface.set_get_checksum_handler(self._system.get_target().get_checksum)
+            if self._has_remote_memory() and not self._avatar_creates_remote_memory_endpoint():
                 time.sleep(2) #Wait a bit for the S2E process to start
-                self._remote_memory_interface.start()
+                self._start_remote_memory_interface()
 
             try:
                 gdb_path = self._configuration._s2e_configuration["emulator_gdb_path"]
@@ -132,7 +184,11 @@ class S2EEmulator(Emulator):
             while count != 0:
                 try:
                     log.debug("Trying to connect to emulator.")
-                    self._gdb_interface.connect(("tcp", "127.0.0.1", "%d" % self._configuration.get_s2e_gdb_port()))
+                    gdb_address = self._configuration.get_s2e_gdb_address()
+                    if is_unix_address(gdb_address):
+                        self._gdb_interface.connect(("unix", gdb_address[len("unix:"):]))
+                    else:
+                        self._gdb_interface.connect(("tcp", gdb_address[0], "%d" % gdb_address[1]))
                     break
                 except:
                     count -= 1
@@ -155,6 +211,18 @@ class S2EEmulator(Emulator):
     def read_typed_memory(self, address, size):
         return self._gdb_interface.read_memory(address, size)
 
+    def read_untyped_memory(self, address, length):
+        return self._gdb_interface.read_untyped_memory(address, length)
+
+    def write_untyped_memory(self, address, data):
+        self._gdb_interface.write_untyped_memory(address, data)
+
+    def get_checksum(self, address, size):
+        return self._gdb_interface.get_checksum(address, size)
+
+    def has_remote_checksum(self):
+        return self._gdb_interface.has_remote_checksum()
+
     def set_register(self, reg, val):
         self._gdb_interface.set_register(reg, val)
 
@@ -164,6 +232,12 @@ class S2EEmulator(Emulator):
     def get_register(self, reg):
         return self._gdb_interface.get_register(reg)
 
+    def get_registers(self, regs):
+        return self._gdb_interface.get_registers(regs)
+
+    def set_registers(self, values):
+        self._gdb_interface.set_registers(values)
+
     def set_breakpoint(self, address, **properties):
         if "thumb" in properties:
             del properties["thumb"]
@@ -0,0 +1,127 @@
+'''
+Undo journal of target memory writes.
+'''
+from bisect import bisect_right
+from collections import OrderedDict
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+class UndoJournal(object):
+    """
+    Keeps the contents target RAM had before it was written, so that the
+    target can be rolled back to a checkpoint in milliseconds instead of
+    being reset and initialized again.
+
+    Pre-images are saved per aligned block of block_size bytes: the first
+    write to a block after a checkpoint reads the whole block, and the
+    blocks a write touches are read with one bulk read. Later writes to
+    the block cost nothing until the next checkpoint. Only the journaled
+    ranges are restored; writes elsewhere, e.g., to peripherals, are
+    counted, but cannot be undone.
+    """
+    def __init__(self, ranges, block_size = 64):
+        """
+        :param ranges: List of {"address", "size"} RAM ranges to journal
+        :param block_size: Granularity of the saved pre-images
+        """
+        assert(block_size > 0 and block_size & (block_size - 1) == 0) #Block size must be a power of two
+        self._ranges = sorted([(x["address"], x["address"] + x["size"]) for x in ranges])
+        self._starts = [x[0] for x in self._ranges]
+        self._block_size = block_size
+        #Pre-images saved since each checkpoint, block address -> bytes
+        self._epochs = [OrderedDict()]
+        self._lock = Lock()
+        self.writes = 0
+        self.unjournaled = 0
+        self.bytes_saved = 0
+        self.rollbacks = 0
+        self.bytes_restored = 0
+
+    def _blocks(self, address, size):
+        """Return the (start, end) of the blocks a range touches, clipped to the journaled ranges"""
+        end = address + size
+        blocks = []
+        i = max(bisect_right(self._starts, address) - 1, 0)
+        for (range_start, range_end) in self._ranges[i:]:
+            if range_start >= end:
+                break
+            if range_end <= address:
+                continue
+            block = max(address, range_start)
+            block -= block % self._block_size
+            while block < min(end, range_end):
+                blocks.append((max(block, range_start), min(block + self._block_size, range_end)))
+                block += self._block_size
+        return blocks
+
+    def record(self, address, size, read_target):
+        """
+        Save the pre-images of a write that is about to change
+        [address, address + size), reading missing blocks with
+        read_target(address, size).
+        """
+        blocks = self._blocks(address, size)
+        with self._lock:
+            self.writes += 1
+            if not blocks:
+                self.unjournaled += 1
+                return
+            epoch = self._epochs[-1]
+            missing = [x for x in blocks if not x[0] in epoch]
+            #Read adjacent missing blocks at once
+            runs = []
+            for (start, end) in missing:
+                if runs and runs[-1][-1][1] == start:
+                    runs[-1].append((start, end))
+                else:
+                    runs.append([(start, end)])
+            for run in runs:
+                data = read_target(run[0][0], run[-1][1] - run[0][0])
+                for (start, end) in run:
+                    epoch[start] = bytes(data[start - run[0][0]:end - run[0][0]])
+                    self.bytes_saved += end - start
+
+    def mark(self):
+        """Start a new checkpoint and return its number"""
+        with self._lock:
+            self._epochs.append(OrderedDict())
+            return len(self._epochs) - 1
+
+    def rollback(self, checkpoint, write_target):
+        """
+        Restore the journaled memory as it was when checkpoint was marked,
+        with write_target(address, data). Later checkpoints are dropped,
+        checkpoint stays valid. Returns the number of bytes restored.
+        """
+        with self._lock:
+            assert(0 <= checkpoint < len(self._epochs)) #Unknown checkpoint
+            #Undo the newest writes first, so the oldest pre-image of a block wins
+            images = {}
+            for epoch in reversed(self._epochs[checkpoint:]):
+                images.update(epoch)
+            del self._epochs[checkpoint + 1:]
+            self._epochs[checkpoint] = OrderedDict()
+            runs = []
+            for start in sorted(images):
+                if runs and runs[-1][0] + len(runs[-1][1]) == start:
+                    runs[-1][1] += images[start]
+                else:
+                    runs.append([start, bytearray(images[start])])
+            restored = 0
+            for (start, data) in runs:
+                write_target(start, bytes(data))
+                restored += len(data)
+            self.rollbacks += 1
+            self.bytes_restored += restored
+            log.debug("Rolled back %d bytes in %d writes to checkpoint %d", restored, len(runs), checkpoint)
+            return restored
+
+    def get_statistics(self):
+        return {"writes": self.writes,
+                "unjournaled": self.unjournaled,
+                "bytes_saved": self.bytes_saved,
+                "checkpoints": len(self._epochs) - 1,
+                "rollbacks": self.rollbacks,
+                "bytes_restored": self.bytes_restored}
@@ -0,0 +1,201 @@
+'''
+Dispatch of forwarded accesses to monitors.
+
+The call proxy compiles the monitors registered for an event into a single
+callable, or None if there are none, so an access without monitors costs
+one comparison. Monitors registered for address ranges are looked up in an
+IntervalIndex and only called for accesses that overlap their ranges.
+
+Run this module for a microbenchmark of the per-access overhead:
+
+    python3 -m avatar.forwarding.monitors
+'''
+from bisect import bisect_right
+import logging
+
+log = logging.getLogger(__name__)
+
+class IntervalIndex(object):
+    """
+    Maps addresses to the values whose ranges contain them. The ranges are
+    cut into disjoint segments at all range boundaries; each segment holds
+    the tuple of values covering it, so a lookup is one binary search.
+    Results are memoized per access, as firmware hits few addresses often.
+    """
+    MAX_MEMOIZED = 4096
+
+    def __init__(self, entries):
+        """
+        :param entries: List of (start, end, value), ranges may overlap
+        """
+        boundaries = sorted(set([x[0] for x in entries] + [x[1] for x in entries]))
+        self._boundaries = boundaries
+        self._segments = []
+        for (i, start) in enumerate(boundaries):
+            end = i + 1 < len(boundaries) and boundaries[i + 1] or start
+            #Keep the order in which the values were given
+            values = []
+            for (entry_start, entry_end, value) in entries:
+                if entry_start <= start and end <= entry_end and start < end and not value in values:
+                    values.append(value)
+            self._segments.append(tuple(values))
+        self._memo = {}
+
+    def get_bounds(self):
+        """Return (start, end) of the span covered by all ranges"""
+        return self._boundaries and (self._boundaries[0], self._boundaries[-1]) or (0, 0)
+
+    def lookup(self, address, size = 1):
+        """Return the values whose ranges overlap [address, address + size)"""
+        try:
+            return self._memo[(address, size)]
+        except KeyError:
+            pass
+        values = self._lookup(address, size)
+        if len(self._memo) >= self.MAX_MEMOIZED:
+            self._memo.clear()
+        self._memo[(address, size)] = values
+        return values
+
+    def _lookup(self, address, size):
+        boundaries = self._boundaries
+        end = address + size
+        if not boundaries or end <= boundaries[0] or address >= boundaries[-1]:
+            return ()
+        first = bisect_right(boundaries, address) - 1
+        if first >= 0 and end <= boundaries[first + 1]:
+            return self._segments[first]
+        #The access spans several segments
+        last = bisect_right(boundaries, end - 1) - 1
+        values = []
+        for segment in self._segments[max(first, 0):last + 1]:
+            for value in segment:
+                if not value in values:
+                    values.append(value)
+        return tuple(values)
+
+def compile_hooks(hooks, index = None):
+    """
+    Return one callable that calls all hooks with the request parameters,
+    followed by the hooks of index whose ranges the access overlaps, or
+    None if there is nothing to call.
+    """
+    hooks = tuple(hooks)
+    if index is None:
+        if not hooks:
+            return None
+        if len(hooks) == 1:
+            return hooks[0]
+        def call_hooks(params):
+            for hook in hooks:
+                hook(params)
+        return call_hooks
+
+    lookup = index.lookup
+    memo = index._memo
+    #Most accesses are far from the watched ranges, e.g., RAM accesses with
+    #monitors on peripherals; they are rejected without the lookup. The
+    #memo is consulted inline, a method call costs as much as the lookup.
+    (low, high) = index.get_bounds()
+    if not hooks:
+        def call_ranged(params):
+            address = params["address"]
+            size = params["size"]
+            if address < high and address + size > low:
+                ranged = memo.get((address, size))
+                if ranged is None:
+                    ranged = lookup(address, size)
+                for hook in ranged:
+                    hook(params)
+        return call_ranged
+
+    def call_hooks_and_ranged(params):
+        for hook in hooks:
+            hook(params)
+        address = params["address"]
+        size = params["size"]
+        if address < high and address + size > low:
+            ranged = memo.get((address, size))
+            if ranged is None:
+                ranged = lookup(address, size)
+            for hook in ranged:
+                hook(params)
+    return call_hooks_and_ranged
+
+class MonitorRegistry(object):
+    """Monitors of the call proxy and the address ranges they watch"""
+    def __init__(self):
+        self._monitors = []
+
+    def add(self, monitor, ranges = None):
+        """
+        :param ranges: List of {"address", "size"} ranges the monitor
+            watches, or None for all accesses
+        """
+        self._monitors.append((monitor, ranges))
+
+    def remove(self, monitor):
+        self._monitors = [x for x in self._monitors if x[0] is not monitor]
+
+    def compile(self, event):
+        """Return the compiled hook chain of an event (see compile_hooks)"""
+        hooks = []
+        entries = []
+        for (monitor, ranges) in self._monitors:
+            hook = getattr(monitor, event, None)
+            if hook is None:
+                continue
+            if ranges is None:
+                hooks.append(hook)
+            else:
+                entries += [(x["address"], x["address"] + x["size"], hook) for x in ranges]
+        return compile_hooks(hooks, entries and IntervalIndex(entries) or None)
+
+def benchmark(accesses = 200000):
+    """Print the time per forwarded read with 0, 1 and 20 monitors"""
+    import time
+    from avatar.call_proxy import EmulatorTargetCallProxy
+
+    class NullTarget(object):
+        def read_typed_memory(self, address, size):
+            return 0
+
+    class Monitor(object):
+        def __init__(self):
+            self.count = 0
+
+        def emulator_pre_read_request(self, params):
+            self.count += 1
+
+        def emulator_post_read_request(self, params):
+            pass
+
+    def measure(proxy, address):
+        params = {"address": address, "size": 4}
+        best = None
+        #Best of three runs, to filter out scheduling noise
+        for _ in range(3):
+            start = time.perf_counter()
+            for _ in range(accesses):
+                proxy.handle_emulator_read_request(params)
+            elapsed = (time.perf_counter() - start) * 1e9 / accesses
+            best = best is None and elapsed or min(best, elapsed)
+        return best
+
+    baseline = None
+    for (description, monitors, ranged, address) in [("no monitors", 0, False, 0x40000000),
+                                                     ("1 monitor", 1, False, 0x40000000),
+                                                     ("20 monitors", 20, False, 0x40000000),
+                                                     ("20 monitors, access elsewhere", 20, True, 0x20000000),
+                                                     ("20 monitors, access in a gap", 20, True, 0x40000000)]:
+        proxy = EmulatorTargetCallProxy({"posted_writes": False})
+        proxy.set_target(NullTarget())
+        for i in range(monitors):
+            #Peripherals around 0x40000000, which lies in a gap between them
+            proxy.add_monitor(Monitor(), ranged and [{"address": 0x3fff6800 + i * 0x1000, "size": 0x100}] or None)
+        nanoseconds = measure(proxy, address)
+        baseline = baseline is None and nanoseconds or baseline
+        print("%-30s %7.0f ns/access (+%.0f ns)" % (description, nanoseconds, nanoseconds - baseline))
+
+if __name__ == "__main__":
+    benchmark()
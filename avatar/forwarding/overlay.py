@@ -0,0 +1,187 @@
+'''
+Copy-on-write memory overlays for forked emulator states.
+'''
+import logging
+
+log = logging.getLogger(__name__)
+
+class OverlayPage(object):
+    """Bytes written by a state to one page, mask marks the valid ones"""
+    __slots__ = ("data", "mask")
+
+    def __init__(self, size, page = None):
+        if page is None:
+            self.data = bytearray(size)
+            self.mask = bytearray(size)
+        else:
+            self.data = bytearray(page.data)
+            self.mask = bytearray(page.mask)
+
+class StateOverlays(object):
+    """
+    Per-state views of RAM ranges.
+
+    As long as there is a single state, it has no overlay and all accesses
+    go to the target. Once a state is forked, the target holds the memory
+    contents shared by all states, and the bytes a state writes to a RAM
+    range are kept in its own overlay. Forking copies the overlay of the
+    parent lazily: pages are shared until one of the states writes to them.
+
+    Before a state lets the target execute, its overlay is written to the
+    target with materialize(); the target contents it replaces are kept in
+    the overlays of all other states first.
+    """
+    PAGE_SIZE = 4096
+
+    def __init__(self, ranges, initial_state = 0):
+        """
+        :param ranges: List of {"address": ..., "size": ...} RAM ranges
+            that are kept per state. Everything else is shared.
+        :param initial_state: Identifier of the state that exists before
+            the first fork
+        """
+        self._ranges = sorted([(x["address"], x["address"] + x["size"]) for x in ranges])
+        self._pages = {initial_state: {}}
+        #Pages a state may modify in place, all others are shared
+        self._owned = {initial_state: set()}
+
+    def is_active(self):
+        """Return True if there is more than one state"""
+        return len(self._pages) > 1
+
+    def covers(self, address, size):
+        """Return True if the access lies within a RAM range"""
+        end = address + size
+        for (range_start, range_end) in self._ranges:
+            if range_start <= address and end <= range_end:
+                return True
+        return False
+
+    def get_states(self):
+        return list(self._pages.keys())
+
+    def fork(self, state, child):
+        """Create the state child with the memory view of state"""
+        if not state in self._pages:
+            log.warning("Forking unknown state %d, giving it an empty overlay", state)
+            self._add_state(state)
+        if child in self._pages:
+            log.warning("State %d already exists, replacing its overlay", child)
+        self._pages[child] = dict(self._pages[state])
+        self._owned[child] = set()
+        #The pages are shared now
+        self._owned[state] = set()
+
+    def kill(self, state):
+        """
+        Drop the overlay of a state. Returns the identifier of the last
+        remaining state if the overlays have to be materialized and
+        deactivated, or None.
+        """
+        if not state in self._pages or len(self._pages) == 1:
+            return None
+        del self._pages[state]
+        del self._owned[state]
+        if len(self._pages) == 1:
+            return list(self._pages.keys())[0]
+        return None
+
+    def _add_state(self, state):
+        self._pages[state] = {}
+        self._owned[state] = set()
+
+    def _get_writable_page(self, state, page_number):
+        pages = self._pages[state]
+        owned = self._owned[state]
+        if not page_number in owned:
+            pages[page_number] = OverlayPage(self.PAGE_SIZE, pages.get(page_number))
+            owned.add(page_number)
+        return pages[page_number]
+
+    def _chunks(self, address, size):
+        """Split a range at page boundaries into (page number, page offset, offset, length)"""
+        offset = 0
+        while offset < size:
+            (page_number, page_offset) = divmod(address + offset, self.PAGE_SIZE)
+            length = min(size - offset, self.PAGE_SIZE - page_offset)
+            yield (page_number, page_offset, offset, length)
+            offset += length
+
+    def write(self, state, address, data):
+        if not state in self._pages:
+            log.warning("Write from unknown state %d, giving it an empty overlay", state)
+            self._add_state(state)
+        for (page_number, page_offset, offset, length) in self._chunks(address, len(data)):
+            page = self._get_writable_page(state, page_number)
+            page.data[page_offset:page_offset + length] = data[offset:offset + length]
+            page.mask[page_offset:page_offset + length] = b"\x01" * length
+
+    def read(self, state, address, size, read_target):
+        """
+        Return the view of state of a memory range. Bytes the state has not
+        written are fetched with read_target(address, size).
+        """
+        pages = self._pages.get(state, {})
+        data = bytearray(size)
+        missing = []
+        for (page_number, page_offset, offset, length) in self._chunks(address, size):
+            page = pages.get(page_number)
+            if page is None:
+                missing.append((offset, length, None))
+                continue
+            data[offset:offset + length] = page.data[page_offset:page_offset + length]
+            mask = page.mask[page_offset:page_offset + length]
+            if mask.count(1) != length:
+                missing.append((offset, length, mask))
+
+        if missing:
+            target = read_target(address, size)
+            for (offset, length, mask) in missing:
+                if mask is None:
+                    data[offset:offset + length] = target[offset:offset + length]
+                else:
+                    for i in range(length):
+                        if not mask[i]:
+                            data[offset + i] = target[offset + i]
+        return bytes(data)
+
+    def _dirty_runs(self, state):
+        """Yield (address, data) for every contiguous range written by state"""
+        pages = self._pages.get(state, {})
+        for page_number in sorted(pages.keys()):
+            page = pages[page_number]
+            start = page.mask.find(1)
+            while start >= 0:
+                end = page.mask.find(0, start)
+                if end < 0:
+                    end = self.PAGE_SIZE
+                yield (page_number * self.PAGE_SIZE + start, bytes(page.data[start:end]))
+                start = page.mask.find(1, end)
+
+    def _preserve(self, state, address, data):
+        """Keep target contents that state is about to overwrite for all other states"""
+        for other in self._pages.keys():
+            if other == state:
+                continue
+            for (page_number, page_offset, offset, length) in self._chunks(address, len(data)):
+                page = self._pages[other].get(page_number)
+                if page is not None and page.mask.count(1, page_offset, page_offset + length) == length:
+                    continue
+                page = self._get_writable_page(other, page_number)
+                for i in range(length):
+                    if not page.mask[page_offset + i]:
+                        page.data[page_offset + i] = data[offset + i]
+                        page.mask[page_offset + i] = 1
+
+    def materialize(self, state, read_target, write_target):
+        """
+        Write the overlay of state to the target and clear it, so that the
+        target holds the view of state.
+        """
+        for (address, data) in list(self._dirty_runs(state)):
+            if self.is_active():
+                self._preserve(state, address, read_target(address, len(data)))
+            write_target(address, data)
+        if state in self._pages:
+            self._pages[state] = {}
+            self._owned[state] = set()
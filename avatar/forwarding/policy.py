@@ -0,0 +1,373 @@
+'''
+Classification of forwarded memory accesses by address range.
+
+Every range of the RemoteMemory plugin configuration can carry a "policy"
+that tells the call proxy how to serve the accesses the emulator forwards
+to it:
+
+ - forward: every access goes to the target (the default)
+ - cached: non-volatile memory, reads are served from a ReadCache that is
+   filled by bulk target reads, writes go to the target and drop the pages
+   they touch
+ - shadow: RAM the emulator owns, but that the target initialized. It is
+   mirrored on the host after one bulk target read, reads are served from
+   the mirror and writes go to both. With "verify_interval", the mirror is
+   compared with the target every that many reads, by the target-side
+   checksum if the target computes one.
+ - local: the range is RAM held by Avatar, optionally initialized from
+   "file", the target is never accessed
+ - rom: reads are served from the image "file", writes are dropped
+ - deny: accesses are not executed, reads return 0
+
+Ranges are kept sorted by address, so looking up the range of an access is
+a binary search.
+'''
+from bisect import bisect_left, bisect_right
+import logging
+import os
+from avatar.forwarding.read_cache import ReadCache
+from avatar.util.checksum import gdb_crc32
+
+log = logging.getLogger(__name__)
+
+FORWARD = "forward"
+CACHED = "cached"
+SHADOW = "shadow"
+LOCAL = "local"
+ROM = "rom"
+DENY = "deny"
+POLICIES = [FORWARD, CACHED, SHADOW, LOCAL, ROM, DENY]
+
+def load_image(path, offset, size):
+    """Read size bytes at offset of an image file, padded with zeros"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(size)
+    if len(data) < size:
+        log.warning("Image %s has only %d of %d bytes at offset 0x%x, padding with zeros",
+                    path, len(data), size, offset)
+    return data + bytes(size - len(data))
+
+class PolicyRange(object):
+    """
+    An address range and the policy for accesses within it. read() returns
+    the bytes of an access, write() returns True if the write has to be
+    forwarded to the target as well, which is always the case if
+    forwards_writes is set.
+    """
+    policy = FORWARD
+    forwards_writes = True
+
+    def __init__(self, name, address, size):
+        self.name = name
+        self.start = address
+        self.end = address + size
+        self.reads = 0
+        self.writes = 0
+
+    def read(self, address, size, read_target):
+        self.reads += 1
+        return read_target(address, size)
+
+    def write(self, address, data):
+        self.writes += 1
+        return True
+
+    def get_statistics(self):
+        return {"address": self.start,
+                "size": self.end - self.start,
+                "policy": self.policy,
+                "reads": self.reads,
+                "writes": self.writes}
+
+class CachedRange(PolicyRange):
+    policy = CACHED
+
+    def __init__(self, name, address, size, read_cache):
+        super(CachedRange, self).__init__(name, address, size)
+        self._read_cache = read_cache
+
+    def read(self, address, size, read_target):
+        self.reads += 1
+        page_size = self._read_cache.page_size
+
+        def fill_page(page_number):
+            #Do not read outside of the range, its neighbours might be IO
+            start = max(page_number * page_size, self.start)
+            end = min((page_number + 1) * page_size, self.end)
+            return bytes(start - page_number * page_size) + bytes(read_target(start, end - start))
+        return self._read_cache.read(address, size, fill_page, self)
+
+    def write(self, address, data):
+        self.writes += 1
+        self._read_cache.invalidate(address, len(data))
+        return True
+
+class ShadowRange(PolicyRange):
+    policy = SHADOW
+
+    def __init__(self, name, address, size, verify_interval = 0):
+        super(ShadowRange, self).__init__(name, address, size)
+        #Seeded on the first access, the target may not be running before
+        self.data = None
+        self._verify_interval = verify_interval
+        self._reads_until_verify = verify_interval
+        self.verifications = 0
+        self.mismatches = 0
+        #Returns the CRC-32 of a target range, or None if it cannot be had
+        #without reading the range
+        self.checksum_target = None
+
+    def _seed(self, read_target):
+        log.debug("Seeding shadow of range %s from the target", self.name)
+        self.data = bytearray(read_target(self.start, self.end - self.start))
+
+    def read(self, address, size, read_target):
+        self.reads += 1
+        if self.data is None:
+            self._seed(read_target)
+        elif self._verify_interval:
+            self._reads_until_verify -= 1
+            if self._reads_until_verify <= 0:
+                self.verify(read_target)
+        offset = address - self.start
+        return bytes(self.data[offset:offset + size])
+
+    def write(self, address, data):
+        self.writes += 1
+        if self.data is not None:
+            offset = address - self.start
+            self.data[offset:offset + len(data)] = data
+        return True
+
+    def verify(self, read_target):
+        """
+        Compare the shadow with the target. The range is only read if the
+        target has no remote checksum or the checksums differ; on a
+        mismatch, the target contents are taken over. Returns True if both
+        were equal.
+        """
+        self._reads_until_verify = self._verify_interval
+        if self.data is None:
+            return True
+        self.verifications += 1
+        checksum = None
+        if self.checksum_target is not None:
+            checksum = self.checksum_target(self.start, self.end - self.start)
+        if checksum is not None:
+            if checksum == gdb_crc32(self.data):
+                return True
+            target = read_target(self.start, self.end - self.start)
+        else:
+            target = read_target(self.start, self.end - self.start)
+            if target == self.data:
+                return True
+        self.mismatches += 1
+        log.warning("Shadow of range %s differs from the target, the target changed it behind the emulator's back",
+                    self.name)
+        self.data = bytearray(target)
+        return False
+
+    def invalidate(self):
+        """Drop the shadow, it is seeded again on the next access"""
+        self.data = None
+
+    def get_statistics(self):
+        statistics = super(ShadowRange, self).get_statistics()
+        statistics.update({"seeded": self.data is not None,
+                           "verifications": self.verifications,
+                           "mismatches": self.mismatches})
+        return statistics
+
+class LocalRange(PolicyRange):
+    policy = LOCAL
+    forwards_writes = False
+
+    def __init__(self, name, address, size, data = None):
+        super(LocalRange, self).__init__(name, address, size)
+        self.data = bytearray(size) if data is None else bytearray(data)
+
+    def read(self, address, size, read_target):
+        self.reads += 1
+        offset = address - self.start
+        return bytes(self.data[offset:offset + size])
+
+    def write(self, address, data):
+        self.writes += 1
+        offset = address - self.start
+        self.data[offset:offset + len(data)] = data
+        return False
+
+class RomRange(LocalRange):
+    policy = ROM
+
+    def write(self, address, data):
+        self.writes += 1
+        log.debug("Dropping write of %d bytes to ROM range %s at 0x%08x", len(data), self.name, address)
+        return False
+
+class DenyRange(PolicyRange):
+    policy = DENY
+    forwards_writes = False
+
+    def read(self, address, size, read_target):
+        self.reads += 1
+        log.warning("Denied read of %d bytes at 0x%08x (range %s)", size, address, self.name)
+        return bytes(size)
+
+    def write(self, address, data):
+        self.writes += 1
+        log.warning("Denied write of %d bytes at 0x%08x (range %s)", len(data), address, self.name)
+        return False
+
+def create_policy_range(mem_range, read_cache = None):
+    """
+    Create the PolicyRange for one range dictionary with the keys "name",
+    "address", "size", "policy" and, for local and rom ranges, "file" and
+    "file_offset", for shadow ranges "verify_interval". Cached ranges share
+    read_cache.
+    """
+    policy = mem_range.get("policy", FORWARD)
+    assert(policy in POLICIES) #Unknown memory access policy
+    name = mem_range.get("name", "0x%08x" % mem_range["address"])
+    (address, size) = (mem_range["address"], mem_range["size"])
+    if policy in [LOCAL, ROM]:
+        assert(policy == LOCAL or "file" in mem_range) #ROM ranges need an image file
+        data = None
+        if "file" in mem_range:
+            data = load_image(mem_range["file"], mem_range.get("file_offset", 0), size)
+        return policy == ROM and RomRange(name, address, size, data) or LocalRange(name, address, size, data)
+    if policy == CACHED:
+        assert(read_cache is not None)
+        return CachedRange(name, address, size, read_cache)
+    if policy == SHADOW:
+        return ShadowRange(name, address, size, mem_range.get("verify_interval", 0))
+    return {FORWARD: PolicyRange, DENY: DenyRange}[policy](name, address, size)
+
+class MemoryPolicy(object):
+    """Interval index over the policy ranges"""
+    def __init__(self, ranges, read_cache = None):
+        """
+        :param ranges: List of range dictionaries (see create_policy_range).
+            Ranges with a policy other than forward must not overlap each
+            other; forwarded ranges, e.g., IO ranges, may overlap anything.
+        :param read_cache: ReadCache of the cached ranges, a default one is
+            created if there are any and none is given
+        :raises ValueError: if ranges with a policy overlap
+        """
+        if any(x.get("policy") == CACHED for x in ranges):
+            read_cache = read_cache is None and ReadCache() or read_cache
+        else:
+            read_cache = None
+        self.read_cache = read_cache
+        self._all_ranges = [create_policy_range(x, read_cache) for x in ranges]
+        #Forwarded ranges behave like unlisted memory and are not indexed
+        self._ranges = sorted([x for x in self._all_ranges if x.policy != FORWARD], key = lambda x: x.start)
+        self._starts = [x.start for x in self._ranges]
+        self._ends = [x.end for x in self._ranges]
+        for i in range(1, len(self._ranges)):
+            (previous, current) = (self._ranges[i - 1], self._ranges[i])
+            if previous.end > current.start:
+                raise ValueError("Memory range %s (%s, 0x%08x-0x%08x) overlaps %s (%s, 0x%08x-0x%08x)" %
+                                 (current.name, current.policy, current.start, current.end,
+                                  previous.name, previous.policy, previous.start, previous.end))
+
+    def is_forward_only(self):
+        """Return True if no range changes how accesses are served"""
+        return not self._ranges
+
+    def lookup(self, address, size):
+        """
+        Return the PolicyRange serving an access, or None if it is forwarded.
+        Accesses that cross a range boundary are forwarded, unless they
+        touch a denied range.
+        """
+        i = bisect_right(self._starts, address) - 1
+        if i >= 0 and address + size <= self._ends[i]:
+            return self._ranges[i]
+        #Not contained in a single range
+        end = bisect_left(self._starts, address + size)
+        for policy_range in self._ranges[max(i, 0):end]:
+            if policy_range.policy == DENY and policy_range.end > address:
+                return policy_range
+        return None
+
+    def target_written(self, address, data):
+        """
+        Let the ranges overlapping a target write that did not come from the
+        emulator, e.g., a rollback, take over its bytes: shadows are seeded
+        again on their next access, local ranges copy the bytes. Cached
+        pages are up to the caller to invalidate.
+        """
+        end = address + len(data)
+        for policy_range in self._ranges[max(bisect_right(self._starts, address) - 1, 0):bisect_left(self._starts, end)]:
+            if policy_range.end <= address:
+                continue
+            if policy_range.policy == SHADOW:
+                policy_range.invalidate()
+            elif policy_range.policy == LOCAL:
+                start = max(address, policy_range.start)
+                stop = min(end, policy_range.end)
+                policy_range.data[start - policy_range.start:stop - policy_range.start] = \
+                    data[start - address:stop - address]
+
+    def set_checksum_target(self, checksum_target):
+        """
+        Let shadow ranges verify against checksum_target(address, size),
+        which returns the target's CRC-32 of a range or None if the target
+        cannot compute it remotely.
+        """
+        for policy_range in self._ranges:
+            if policy_range.policy == SHADOW:
+                policy_range.checksum_target = checksum_target
+
+    def get_ranges(self):
+        return list(self._all_ranges)
+
+    def get_statistics(self):
+        """Return the access counters of all ranges by name"""
+        statistics = {"ranges": dict((x.name, x.get_statistics()) for x in self._all_ranges)}
+        if self.read_cache is not None:
+            statistics["read_cache"] = self.read_cache.get_statistics()
+        return statistics
+
+def get_remote_memory_ranges(configuration):
+    """
+    Return the ranges of the RemoteMemory plugin in an Avatar configuration
+    as list for MemoryPolicy. Relative image paths are relative to the
+    configuration directory.
+    """
+    try:
+        ranges = configuration["s2e"]["plugins"]["RemoteMemory"]["ranges"]
+    except (KeyError, TypeError):
+        return []
+    configuration_directory = configuration.get("configuration_directory", ".")
+    result = []
+    for (name, mem_range) in ranges.items():
+        mem_range = dict(mem_range, name = name)
+        if "file" in mem_range:
+            mem_range["file"] = os.path.join(configuration_directory, mem_range["file"])
+        result.append(mem_range)
+    return result
+
+def check_adjacent_cached_ranges():
+    """
+    Regression check: cached ranges that share a cache page must each be
+    served their own bytes.
+    """
+    memory = bytes(range(256)) * 32
+
+    def read_target(address, size):
+        return memory[address:address + size]
+
+    policy = MemoryPolicy([{"name": "a", "address": 0x1000, "size": 0x200, "policy": CACHED},
+                           {"name": "b", "address": 0x1200, "size": 0x200, "policy": CACHED}])
+    for address in [0x1000, 0x1200, 0x11fc, 0x13fc, 0x1000]:
+        data = policy.lookup(address, 4).read(address, 4, read_target)
+        assert(data == memory[address:address + 4]) #Adjacent cached ranges are served each other's page
+    policy.read_cache.invalidate(0x1200, 4)
+    assert(policy.lookup(0x1204, 4).read(0x1204, 4, read_target) == memory[0x1204:0x1208])
+    print("Adjacent cached ranges OK")
+
+if __name__ == "__main__":
+    check_adjacent_cached_ranges()
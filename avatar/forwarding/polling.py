@@ -0,0 +1,124 @@
+'''
+Detection of IO polling loops in forwarded reads.
+'''
+from collections import OrderedDict
+from threading import Lock
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+class PollingLoop(object):
+    """Reads of one PC and how often they returned the same value"""
+    __slots__ = ("address", "size", "value", "count", "generation", "futile", "collapsed")
+
+    def __init__(self, address, size, value, generation):
+        self.address = address
+        self.size = size
+        self.value = value
+        self.count = 0
+        self.generation = generation
+        #Set when waiting timed out, the condition depends on the emulator
+        self.futile = False
+        self.collapsed = 0
+
+class PollingDetector(object):
+    """
+    A PC that reads the same address threshold times in a row, gets the
+    same value each time and writes nothing in between is polling a status
+    register. Instead of returning the value to the emulator for yet
+    another loop iteration, the read is repeated on the target until the
+    value changes, and only the changed value is returned.
+
+    If the value does not change within max_wait seconds, it probably
+    waits for something the emulator does, e.g., an interrupt handler; the
+    loop is not fast-forwarded again until its value changed.
+    """
+    MAX_LOOPS = 256
+
+    def __init__(self, threshold = 16, max_wait = 1.0, interval = 0):
+        """
+        :param threshold: Identical reads before a loop is fast-forwarded
+        :param max_wait: Longest time in seconds the target is polled
+        :param interval: Seconds between target polls, 0 for link speed
+        """
+        self._threshold = threshold
+        self._max_wait = max_wait
+        self._interval = interval
+        self._loops = OrderedDict()
+        self._lock = Lock()
+        #Incremented by writes, which end the loops
+        self._generation = 0
+        self.detected = 0
+        self.collapsed = 0
+        self.timeouts = 0
+        self.target_polls = 0
+
+    def note_write(self):
+        self._generation += 1
+
+    def reset(self):
+        with self._lock:
+            self._loops.clear()
+
+    def read(self, pc, address, size, value, read_target):
+        """
+        Called with the value a forwarded read returned. Returns the value
+        to answer the emulator with; if the read is part of a detected
+        loop, that is the first different value read_target(address, size)
+        returns.
+        """
+        with self._lock:
+            loop = self._loops.get(pc)
+            if loop is None or loop.address != address or loop.size != size:
+                self._loops[pc] = PollingLoop(address, size, value, self._generation)
+                if len(self._loops) > self.MAX_LOOPS:
+                    self._loops.popitem(last = False)
+                return value
+            if loop.value != value or loop.generation != self._generation:
+                #The value changed or the loop wrote something, count again
+                if loop.value != value:
+                    loop.futile = False
+                loop.value = value
+                loop.generation = self._generation
+                loop.count = 0
+                return value
+            loop.count += 1
+            if loop.count < self._threshold or loop.futile:
+                return value
+            if loop.count == self._threshold:
+                self.detected += 1
+                log.debug("Polling loop at PC 0x%08x on 0x%08x (value 0x%x), waiting on the target", pc, address, value)
+        #Wait outside of the lock, other requests may be handled meanwhile
+        deadline = time.monotonic() + self._max_wait
+        polls = 0
+        new_value = value
+        while new_value == value and time.monotonic() < deadline:
+            if self._interval:
+                time.sleep(self._interval)
+            new_value = read_target(address, size)
+            polls += 1
+        with self._lock:
+            self.target_polls += polls
+            if new_value == value:
+                self.timeouts += 1
+                loop.futile = True
+                log.debug("Polling loop at PC 0x%08x did not end within %.2f s", pc, self._max_wait)
+            else:
+                self.collapsed += 1
+                loop.collapsed += 1
+                loop.value = new_value
+                loop.count = 0
+        return new_value
+
+    def get_loops(self):
+        """Return the loops that were fast-forwarded, by PC"""
+        with self._lock:
+            return dict((pc, {"address": loop.address, "collapsed": loop.collapsed, "futile": loop.futile})
+                        for (pc, loop) in self._loops.items() if loop.collapsed or loop.futile)
+
+    def get_statistics(self):
+        return {"detected": self.detected,
+                "collapsed": self.collapsed,
+                "timeouts": self.timeouts,
+                "target_polls": self.target_polls}
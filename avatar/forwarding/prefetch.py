@@ -0,0 +1,175 @@
+'''
+Stride prefetcher for forwarded reads.
+'''
+from collections import OrderedDict
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+class Stream(object):
+    """Access pattern of one PC and the block prefetched for it"""
+    __slots__ = ("last_address", "stride", "confidence", "depth", "buffer_start", "buffer", "used")
+
+    def __init__(self, address, depth):
+        self.last_address = address
+        self.stride = 0
+        self.confidence = 0
+        self.depth = depth
+        self.buffer_start = 0
+        self.buffer = None
+        #Bytes of the buffer that were read, to adapt the depth
+        self.used = 0
+
+class Prefetcher(object):
+    """
+    Detects reads of one PC that advance by a constant stride, e.g., the
+    loads of a memcpy or CRC loop. Once a stride has been seen CONFIDENCE
+    times in a row, the next depth bytes in the direction of the stride are
+    fetched with one bulk read, and the following reads of that PC are
+    served from them.
+
+    The depth of a stream doubles whenever its block was used up and halves
+    when most of it was wasted. Blocks never extend into excluded ranges,
+    which must cover all memory with read side effects (peripherals), and
+    are dropped when a write overlaps them. If memory ranges are given,
+    blocks also stay within the range of the access. A block that cannot be
+    read leaves the access to the caller.
+    """
+    CONFIDENCE = 2
+    #Strides above this are not worth prefetching
+    MAX_STRIDE = 64
+    MAX_STREAMS = 256
+
+    def __init__(self, depth = 64, max_depth = 4096, exclude = [], ranges = []):
+        """
+        :param depth: Initial number of bytes prefetched for a stream
+        :param max_depth: Upper bound of the adaptive depth
+        :param exclude: List of {"address", "size"} ranges that are never
+            read ahead
+        :param ranges: List of {"address", "size"} forwarded memory ranges;
+            if given, only accesses within one of them are read ahead
+        """
+        self._min_depth = depth
+        self._max_depth = max(depth, max_depth)
+        self._exclude = sorted([(x["address"], x["address"] + x["size"]) for x in exclude])
+        self._ranges = sorted([(x["address"], x["address"] + x["size"]) for x in ranges])
+        self._streams = OrderedDict()
+        self._lock = Lock()
+        #Incremented by invalidate(), so blocks read concurrently are not kept
+        self._generation = 0
+        self.hits = 0
+        self.fills = 0
+        self.bytes_prefetched = 0
+        self.bytes_used = 0
+
+    def _clip(self, start, end, address, size):
+        """
+        Shrink the window [start, end) so that it contains the access but
+        no excluded range. Returns None if the access itself is excluded.
+        """
+        if self._ranges:
+            containing = [x for x in self._ranges if x[0] <= address and address + size <= x[1]]
+            if not containing:
+                return None
+            start = max(start, containing[0][0])
+            end = min(end, containing[0][1])
+        for (exclude_start, exclude_end) in self._exclude:
+            if exclude_start < address + size and address < exclude_end:
+                return None
+            if exclude_end <= address:
+                start = max(start, exclude_end)
+            elif exclude_start >= address + size:
+                end = min(end, exclude_start)
+        return (start, end)
+
+    def _retire_buffer(self, stream):
+        if stream.buffer is None:
+            return
+        used = stream.used
+        self.bytes_used += used
+        if used >= len(stream.buffer):
+            stream.depth = min(stream.depth * 2, self._max_depth)
+        elif used * 2 < len(stream.buffer):
+            stream.depth = max(stream.depth // 2, self._min_depth)
+        stream.buffer = None
+
+    def read(self, pc, address, size, read_target):
+        """
+        Return the bytes of a read if they were prefetched or the read
+        starts a prefetch, or None if the caller has to read the target.
+        read_target(address, size) performs the bulk read.
+        """
+        with self._lock:
+            stream = self._streams.get(pc)
+            if stream is None:
+                self._streams[pc] = Stream(address, self._min_depth)
+                if len(self._streams) > self.MAX_STREAMS:
+                    self._streams.popitem(last = False)
+                return None
+
+            stride = address - stream.last_address
+            stream.last_address = address
+            if stride != 0 and stride == stream.stride:
+                stream.confidence += 1
+            else:
+                stream.stride = stride
+                stream.confidence = 0
+
+            if stream.buffer is not None:
+                offset = address - stream.buffer_start
+                if 0 <= offset and offset + size <= len(stream.buffer):
+                    self.hits += 1
+                    stream.used += size
+                    return bytes(stream.buffer[offset:offset + size])
+                self._retire_buffer(stream)
+
+            if stream.confidence < self.CONFIDENCE or abs(stride) > self.MAX_STRIDE:
+                return None
+            if stride > 0:
+                window = self._clip(address, address + max(stream.depth, size), address, size)
+            else:
+                window = self._clip(address + size - max(stream.depth, size), address + size, address, size)
+            if window is None:
+                return None
+            (start, end) = window
+            generation = self._generation
+        #Read outside of the lock, the target access is slow
+        try:
+            data = bytes(read_target(start, end - start))
+        except Exception:
+            log.debug("Prefetch of 0x%x bytes at 0x%08x failed, reading 0x%08x alone", end - start, start, address)
+            with self._lock:
+                #Do not try again at once
+                stream.confidence = 0
+                stream.depth = self._min_depth
+            return None
+        with self._lock:
+            if generation != self._generation:
+                #A write overlapped the block while it was read
+                return None
+            stream.buffer_start = start
+            stream.buffer = data
+            stream.used = size
+            self.fills += 1
+            self.bytes_prefetched += end - start
+        offset = address - start
+        return data[offset:offset + size]
+
+    def invalidate(self, address = None, size = None):
+        """Drop prefetched blocks overlapping a range, or all of them"""
+        with self._lock:
+            self._generation += 1
+            for stream in self._streams.values():
+                if stream.buffer is None:
+                    continue
+                if address is None or (stream.buffer_start < address + size and \
+                                       address < stream.buffer_start + len(stream.buffer)):
+                    stream.buffer = None
+
+    def get_statistics(self):
+        return {"hits": self.hits,
+                "fills": self.fills,
+                "bytes_prefetched": self.bytes_prefetched,
+                "bytes_used": self.bytes_used,
+                "streams": len(self._streams)}
@@ -0,0 +1,135 @@
+'''
+Incremental synchronization of RAM between emulator and target.
+
+Instead of copying whole RAM regions at every control transfer, the
+checksums of both sides are compared and only the blocks that differ are
+transferred. Checksums are computed where the memory is, e.g., by the gdb
+stub of the target (see Debuggable.get_checksum), so comparing a block
+costs a round trip, but no transfer of its contents.
+'''
+import logging
+from avatar.util.checksum import gdb_crc32
+
+log = logging.getLogger(__name__)
+
+class RangeMemory(object):
+    """
+    One side of the comparison of a range. Without remote checksums (see
+    Debuggable.has_remote_checksum), e.g., for QEMU, the range is read
+    once on its first checksum, and all checksums and copies are served
+    from these bytes.
+    """
+    def __init__(self, debuggable, start, end):
+        self._debuggable = debuggable
+        self._start = start
+        self._end = end
+        self._data = None
+        self.bytes_read = 0
+
+    def get_checksum(self, address, size):
+        if self._data is None and self._debuggable.has_remote_checksum():
+            return self._debuggable.get_checksum(address, size)
+        if self._data is None:
+            self._data = self._debuggable.read_untyped_memory(self._start, self._end - self._start)
+            self.bytes_read += len(self._data)
+        return gdb_crc32(self._data[address - self._start:address - self._start + size])
+
+    def read(self, address, size):
+        if self._data is not None:
+            return self._data[address - self._start:address - self._start + size]
+        self.bytes_read += size
+        return self._debuggable.read_untyped_memory(address, size)
+
+class RamSync(object):
+    """
+    Compares ranges hierarchically: the checksums of a whole range are
+    compared first, and a range that differs is split in halves until the
+    differing blocks of block_size bytes are found. A few changed blocks in
+    a large range thus cost a few checksums per halving step. Adjacent
+    differing blocks are copied with one bulk transfer. A side without
+    remote checksums is read once per range, and its checksums are
+    computed on the host (see RangeMemory).
+    """
+    def __init__(self, ranges, block_size = 0x400):
+        """
+        :param ranges: List of {"address", "size"} RAM ranges to keep in sync
+        :param block_size: Smallest unit that is compared and copied
+        """
+        assert(block_size > 0 and block_size & (block_size - 1) == 0) #Block size must be a power of two
+        self._ranges = sorted([(x["address"], x["address"] + x["size"]) for x in ranges])
+        self._block_size = block_size
+        self.synchronizations = 0
+        self.checksums = 0
+        self.blocks_copied = 0
+        self.bytes_copied = 0
+        self.bytes_compared = 0
+        self.bytes_read = 0
+
+    def get_ranges(self):
+        return [{"address": start, "size": end - start} for (start, end) in self._ranges]
+
+    def synchronize(self, source, destination, ranges = None, write = None):
+        """
+        Make the memory of destination equal to the memory of source in the
+        configured ranges, or in the {"address", "size"} ranges given.
+        source and destination are Debuggables, i.e., the emulator and the
+        target. write(address, data) is used instead of
+        destination.write_untyped_memory if given. Returns the number of
+        bytes copied.
+        """
+        if write is None:
+            write = destination.write_untyped_memory
+        if ranges is None:
+            ranges = self._ranges
+        else:
+            ranges = sorted([(x["address"], x["address"] + x["size"]) for x in ranges])
+        self.synchronizations += 1
+        copied = 0
+        for (start, end) in ranges:
+            self.bytes_compared += end - start
+            differing = []
+            source_memory = RangeMemory(source, start, end)
+            destination_memory = RangeMemory(destination, start, end)
+            self._find_differing(source_memory, destination_memory, start, end, differing)
+            for (block_start, block_end) in self._coalesce(differing):
+                log.debug("Copying 0x%x bytes at 0x%08x", block_end - block_start, block_start)
+                write(block_start, source_memory.read(block_start, block_end - block_start))
+                copied += block_end - block_start
+            self.bytes_read += source_memory.bytes_read + destination_memory.bytes_read
+        self.bytes_copied += copied
+        return copied
+
+    def _find_differing(self, source, destination, start, end, differing):
+        """Append the blocks of [start, end) whose contents differ to differing"""
+        self.checksums += 2
+        if source.get_checksum(start, end - start) == destination.get_checksum(start, end - start):
+            return
+        if end - start <= self._block_size:
+            self.blocks_copied += 1
+            differing.append((start, end))
+            return
+        #Split at a block boundary, so that blocks stay aligned
+        middle = (start + end) // 2
+        middle -= middle % self._block_size
+        if middle <= start:
+            middle = start - start % self._block_size + self._block_size
+        self._find_differing(source, destination, start, middle, differing)
+        self._find_differing(source, destination, middle, end, differing)
+
+    @staticmethod
+    def _coalesce(blocks):
+        result = []
+        for (start, end) in blocks:
+            if result and result[-1][1] == start:
+                result[-1] = (result[-1][0], end)
+            else:
+                result.append((start, end))
+        return result
+
+    def get_statistics(self):
+        return {"synchronizations": self.synchronizations,
+                "checksums": self.checksums,
+                "blocks_copied": self.blocks_copied,
+                "bytes_copied": self.bytes_copied,
+                "bytes_compared": self.bytes_compared,
+                "bytes_read": self.bytes_read}
@@ -0,0 +1,100 @@
+'''
+Page cache for reads from non-volatile target memory.
+'''
+from collections import OrderedDict
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+class ReadCache(object):
+    """
+    Bounded LRU cache of target memory pages. Pages are filled by one bulk
+    read each and dropped when they are written, when invalidate() is
+    called or when the least recently used page has to make room.
+
+    Pages are kept per key, e.g., per cached range: ranges that share a
+    page fill only their own part of it, so they must not share the copy.
+    """
+    def __init__(self, page_size = 0x400, max_pages = 1024):
+        assert(page_size > 0 and page_size & (page_size - 1) == 0) #Page size must be a power of two
+        assert(max_pages > 0)
+        self.page_size = page_size
+        self._max_pages = max_pages
+        #(key, page number) -> page
+        self._pages = OrderedDict()
+        self._keys = set()
+        self._lock = Lock()
+        #Incremented by invalidate(), so pages read concurrently are not kept
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def read(self, address, size, fill_page, key = None):
+        """
+        Return size bytes at address. Missing pages are read with
+        fill_page(page_number), which returns the page contents, and cached
+        under key.
+        """
+        data = bytearray()
+        end = address + size
+        while address < end:
+            (page_number, page_offset) = divmod(address, self.page_size)
+            length = min(end - address, self.page_size - page_offset)
+            data += self._get_page((key, page_number), fill_page)[page_offset:page_offset + length]
+            address += length
+        return bytes(data)
+
+    def _get_page(self, page_key, fill_page):
+        with self._lock:
+            page = self._pages.get(page_key)
+            if page is not None:
+                self.hits += 1
+                self._pages.move_to_end(page_key)
+                return page
+            self.misses += 1
+            generation = self._generation
+        #Fill outside of the lock, the target access is slow
+        page = fill_page(page_key[1])
+        with self._lock:
+            if generation != self._generation:
+                return page
+            self._keys.add(page_key[0])
+            self._pages[page_key] = page
+            if len(self._pages) > self._max_pages:
+                self._pages.popitem(last = False)
+                self.evictions += 1
+        return page
+
+    def invalidate(self, address = None, size = None):
+        """Drop the pages overlapping a range, or all pages if no range is given"""
+        with self._lock:
+            self._generation += 1
+            if address is None:
+                self.invalidations += len(self._pages)
+                self._pages.clear()
+                return
+            if not self._pages:
+                return
+            first = address // self.page_size
+            last = (address + max(size, 1) - 1) // self.page_size
+            for page_number in range(first, last + 1):
+                for key in self._keys:
+                    if self._pages.pop((key, page_number), None) is not None:
+                        self.invalidations += 1
+
+    def get_statistics(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": lookups and float(self.hits) / lookups or 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "pages": len(self._pages),
+                "max_pages": self._max_pages,
+                "page_size": self.page_size}
+
+    def reset_statistics(self):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
@@ -0,0 +1,129 @@
+'''
+Write combining for forwarded writes to plain memory.
+'''
+from bisect import bisect_right
+from threading import Lock
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+class WriteCombiner(object):
+    """
+    Merges consecutive forwarded writes to adjacent or overlapping addresses
+    into one run, which is written to the target with a single untyped
+    write. Only ranges without side effects may be combined: the target
+    sees the writes late, in one piece, and overlapping writes only once.
+
+    take() returns the run when it has to be flushed, i.e., when it
+    reached max_size bytes, is older than max_delay seconds, or an access
+    needs it to be written (see the call proxy). Runs that no access
+    touches are flushed by the writer thread of the call proxy, which
+    waits until get_deadline() and calls take_expired().
+    """
+    def __init__(self, ranges, max_size = 0x1000, max_delay = 0.01):
+        """
+        :param ranges: List of {"address", "size"} plain memory ranges
+        :param max_size: Runs are flushed once they reach this size
+        :param max_delay: Runs are flushed once they are this many seconds
+            old
+        """
+        self._ranges = sorted([(x["address"], x["address"] + x["size"]) for x in ranges])
+        self._starts = [x[0] for x in self._ranges]
+        self._max_size = max_size
+        self._max_delay = max_delay
+        self._lock = Lock()
+        self._run_start = None
+        self._run = None
+        self._run_time = 0
+        self.writes = 0
+        self.flushes = 0
+        self.bytes_flushed = 0
+
+    def covers(self, address, size):
+        """Return True if writes to a range may be combined"""
+        i = bisect_right(self._starts, address) - 1
+        return i >= 0 and address + size <= self._ranges[i][1]
+
+    def is_pending(self):
+        return self._run is not None
+
+    def add(self, address, data):
+        """
+        Add a write to the run. Returns the previous run as (address, data)
+        if the write does not extend it, or the run itself if it is full or
+        expired; the caller writes it to the target.
+        """
+        with self._lock:
+            self.writes += 1
+            flushed = None
+            run = self._run
+            if run is not None:
+                offset = address - self._run_start
+                if 0 <= offset + len(data) and offset <= len(run) and \
+                        self._ranges_of(self._run_start) == self._ranges_of(address):
+                    if offset < 0:
+                        #Extends the run downwards
+                        run[0:0] = bytes(-offset)
+                        self._run_start = address
+                        offset = 0
+                    run[offset:offset + len(data)] = data
+                else:
+                    flushed = self._take()
+                    run = None
+            if run is None:
+                self._run_start = address
+                self._run = bytearray(data)
+                self._run_time = time.monotonic()
+            if flushed is None and (len(self._run) >= self._max_size or \
+                                    time.monotonic() - self._run_time >= self._max_delay):
+                flushed = self._take()
+            return flushed
+
+    def _ranges_of(self, address):
+        #Runs must not cross into another range, which may not be adjacent memory
+        return bisect_right(self._starts, address)
+
+    def get_deadline(self):
+        """Return the time.monotonic() time at which the pending run expires, or None"""
+        if self._run is None:
+            return None
+        return self._run_time + self._max_delay
+
+    def take_expired(self):
+        """Return the pending run as (address, data) and remove it if it has expired, None otherwise"""
+        with self._lock:
+            if self._run is None or time.monotonic() - self._run_time < self._max_delay:
+                return None
+            return self._take()
+
+    def take(self, address = None, size = None):
+        """
+        Return the pending run as (address, data) and remove it, if it
+        overlaps the given range or has expired, or unconditionally if no
+        range is given. Returns None otherwise.
+        """
+        if self._run is None:
+            return None
+        with self._lock:
+            if self._run is None:
+                return None
+            if address is not None and not (self._run_start < address + size and \
+                                             address < self._run_start + len(self._run)) and \
+                    time.monotonic() - self._run_time < self._max_delay:
+                return None
+            return self._take()
+
+    def _take(self):
+        run = (self._run_start, bytes(self._run))
+        self._run = None
+        self.flushes += 1
+        self.bytes_flushed += len(run[1])
+        return run
+
+    def get_statistics(self):
+        return {"writes": self.writes,
+                "flushes": self.flushes,
+                "bytes_flushed": self.bytes_flushed,
+                "combine_ratio": self.flushes and float(self.writes) / self.flushes or 0.0,
+                "pending": self._run is not None and len(self._run) or 0}
@@ -12,6 +12,8 @@ log = logging.getLogger(__name__)
     
 ASYNCHRONOUS_MESSAGES = ["AVATAR_RPC_DTH_STATE", "AVATAR_RPC_DTH_PAGEFAULT", "AVATAR_RPC_DTH_INFO_EXCEPTION"]
 RESPONSE_TIMEOUT = 10
+#Error code of the error replies made up for requests the stub did not answer
+AVATAR_ERROR_NO_REPLY = 0xFF
 
 class AvatarProtocol():
     CONNECT_TIMEOUT = 10
@@ -46,22 +48,42 @@ class AvatarProtocol():
             if not result:
                 continue
             
+            #Pipelined requests come as lists of messages and references
+            (msgs, expected_replies, cv, refs) = result
+            if not isinstance(msgs, list):
+                (msgs, refs) = ([msgs], [refs])
             self._send_lock.acquire()
-            self._protocol.send_message(result[0])
+            for msg in msgs:
+                self._protocol.send_message(msg)
             self._send_lock.release()
             
-            if result[1]:
-                log.debug("Waiting for response to message %s", result[0].name)
-                recv_msg = self._received_synchronous_messages.get(timeout = RESPONSE_TIMEOUT)
-                if recv_msg and recv_msg.name in result[1]:
-                    if result[2]:
-                        result[2].acquire()
-                        if result[3]:
-                            result[3].set_value(recv_msg)
-                        result[2].notify()
-                        result[2].release()
-                else:
-                    log.warn("Unexpected message received: %s", recv_msg.name)
+            if expected_replies:
+                #The stub answers in order
+                replies = [self._receive_reply(msg, expected_replies) for msg in msgs]
+                if cv:
+                    cv.acquire()
+                    for (ref, reply) in zip(refs, replies):
+                        if ref:
+                            ref.set_value(reply)
+                    cv.notify()
+                    cv.release()
+
+    def _receive_reply(self, msg, expected_replies):
+        """
+        Return the reply to msg. If the stub does not answer in time or
+        sends something else, an error reply is returned, so that the
+        caller does not wait forever.
+        """
+        log.debug("Waiting for response to message %s", msg.name)
+        try:
+            recv_msg = self._received_synchronous_messages.get(timeout = RESPONSE_TIMEOUT)
+        except Empty:
+            log.warn("No response to message %s within %d seconds", msg.name, RESPONSE_TIMEOUT)
+            return create_avatar_message("AVATAR_RPC_DTH_REPLY_ERROR", {"error": AVATAR_ERROR_NO_REPLY})
+        if recv_msg.name in expected_replies:
+            return recv_msg
+        log.warn("Unexpected message received in response to %s: %s", msg.name, recv_msg.name)
+        return create_avatar_message("AVATAR_RPC_DTH_REPLY_ERROR", {"error": AVATAR_ERROR_NO_REPLY})
                 
     def handle_asynchronous_message(self, msg):
         if msg.name == "AVATAR_RPC_DTH_PAGEFAULT":
@@ -102,6 +124,37 @@ class AvatarProtocol():
             raise AvatarRemoteError(ref.get_value().error)
         return ref.get_value().value
         
+    def _execute_pipelined(self, msgs, expected_replies):
+        """
+        Send several requests back to back, without waiting for the reply
+        of one before sending the next, and wait for all replies. The
+        replies are matched to the requests in order.
+        """
+        cv = threading.Condition()
+        refs = [Reference() for _ in msgs]
+        
+        cv.acquire()
+        self._queued_commands.put((list(msgs), expected_replies, cv, refs))
+        while any(ref.get_value() is None for ref in refs):
+            cv.wait()
+        cv.release()
+        for ref in refs:
+            if ref.get_value().name == "AVATAR_RPC_DTH_REPLY_ERROR":
+                raise AvatarRemoteError(ref.get_value().error)
+        return [ref.get_value() for ref in refs]
+
+    def get_registers(self, registers):
+        """Return the values of a list of register numbers"""
+        msgs = [create_avatar_message("AVATAR_RPC_HTD_GET_REGISTER", {"register": x}) for x in registers]
+        replies = self._execute_pipelined(msgs, ["AVATAR_RPC_DTH_REPLY_GET_REGISTER",  "AVATAR_RPC_DTH_REPLY_ERROR"])
+        return [x.value for x in replies]
+
+    def set_registers(self, values):
+        """Set registers from a list of (register number, value)"""
+        msgs = [create_avatar_message("AVATAR_RPC_HTD_SET_REGISTER", {"register": register, "value": value})
+                for (register, value) in values]
+        self._execute_pipelined(msgs, ["AVATAR_RPC_DTH_REPLY_OK",  "AVATAR_RPC_DTH_REPLY_ERROR"])
+        
     def read_memory(self, address, size):
         msg = create_avatar_message("AVATAR_RPC_HTD_READ_MEMORY", {"address": address, "size": size})
         expected_replies = ["AVATAR_RPC_DTH_REPLY_READ_MEMORY",  "AVATAR_RPC_DTH_REPLY_ERROR"]
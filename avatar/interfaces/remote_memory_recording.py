@@ -0,0 +1,362 @@
+'''
+Recording and replay of RemoteMemory sessions.
+
+A RemoteMemoryRecorder attached to a RemoteMemory interface writes every
+request with its reply and timing to a binary log. Requests and replies are
+stored as messages of the binary wire format, so every command that can be
+sent over the wire can be recorded. Requests of a batch are recorded one by
+one.
+
+Log layout (little endian):
+
+    header:  magic "AVTRRMLG", version (u32)
+    records: timestamp (u64, ns since recording started), handler duration
+             (u64, ns), request length (u32), reply length (u32), request
+             message, reply message
+    index:   offset of every record (u64)
+    footer:  index offset (u64), record count (u64), magic "AVTRRIDX"
+
+The index and footer are written when the recorder is closed. A log without
+them, e.g., from a crashed run, is scanned record by record when opened.
+
+RemoteMemoryReplay answers an emulator's requests from a log instead of a
+target. Each request is compared to the next recorded one. The first one
+that differs in command, address, size, written value or PC is reported as
+divergence; from then on, requests are answered from the memory contents
+seen in the log up to that point.
+
+Run this module to serve a log to an emulator:
+
+    python3 -m avatar.interfaces.remote_memory_recording <log> <host:port|unix:/path>
+'''
+import sys
+import mmap
+import time
+import struct
+import logging
+import threading
+from time import perf_counter_ns
+from avatar.interfaces.remote_memory_wire import BinaryWireFormat, GET_CPU_STATE_REGISTERS
+from avatar.util.cpu_state import get_pc
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct("<8sI")
+MAGIC = b"AVTRRMLG"
+VERSION = 1
+RECORD = struct.Struct("<QQII")
+INDEX_ENTRY = struct.Struct("<Q")
+FOOTER = struct.Struct("<QQ8s")
+FOOTER_MAGIC = b"AVTRRIDX"
+
+class RemoteMemoryRecorder(object):
+    """Writes the requests handled by a RemoteMemory interface to a log file"""
+    def __init__(self, path):
+        self._path = path
+        self._wire_format = BinaryWireFormat()
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+        self._offset = HEADER.size
+        self._index = []
+        self._start = perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def get_path(self):
+        return self._path
+
+    def record(self, cmd, params, result, timestamp, duration):
+        """
+        Record one handled request.
+
+        :param timestamp: perf_counter_ns() when the request was received
+        :param duration: Time in ns spent in the request handler
+        """
+        if cmd == "batch":
+            requests = params["requests"]
+            for ((request_cmd, request_params), request_result) in zip(requests, result):
+                self.record(request_cmd, request_params, request_result, timestamp, duration // len(requests))
+            return
+        if cmd == "write_buffer":
+            cmd = "write_range"
+        if not cmd in self._wire_format.COMMAND_TYPES:
+            return
+        if cmd == "read_range" and result is None:
+            #The data went to a payload file, the interface keeps it for us
+            result = params["data"]
+        if cmd == "write_range" and "file" in params:
+            #Record the data itself, the payload file may be gone or
+            #overwritten when the log is replayed
+            params = dict((x, y) for (x, y) in params.items() if x != "file" and x != "offset")
+
+        request = self._wire_format.encode_request(cmd, params)
+        reply = self._wire_format.encode_reply(cmd, result)
+        with self._lock:
+            if self._file is None:
+                return
+            self._index.append(self._offset)
+            self._file.write(RECORD.pack(max(timestamp - self._start, 0), duration, len(request), len(reply)))
+            self._file.write(request)
+            self._file.write(reply)
+            self._offset += RECORD.size + len(request) + len(reply)
+
+    def close(self):
+        """Write the index and close the log"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(b"".join([INDEX_ENTRY.pack(x) for x in self._index]))
+            self._file.write(FOOTER.pack(self._offset, len(self._index), FOOTER_MAGIC))
+            self._file.close()
+            self._file = None
+        log.info("Recorded %d RemoteMemory requests to %s", len(self._index), self._path)
+
+class LogRecord(object):
+    """One recorded request, decoded"""
+    __slots__ = ("sequence", "cmd", "params", "result", "timestamp", "duration")
+
+    def __init__(self, sequence, cmd, params, result, timestamp, duration):
+        self.sequence = sequence
+        self.cmd = cmd
+        self.params = params
+        self.result = result
+        self.timestamp = timestamp
+        self.duration = duration
+
+    def get_pc(self):
+        return get_pc(self.params)
+
+class RemoteMemoryLog(object):
+    """Random access to the records of a RemoteMemory log, decoded on access"""
+    def __init__(self, path):
+        self._path = path
+        self._wire_format = BinaryWireFormat()
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        (magic, version) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a RemoteMemory log" % path)
+        self._index = self._read_index()
+
+    def _read_index(self):
+        if len(self._map) >= HEADER.size + FOOTER.size:
+            (index_offset, count, magic) = FOOTER.unpack_from(self._map, len(self._map) - FOOTER.size)
+            if magic == FOOTER_MAGIC:
+                return [x[0] for x in INDEX_ENTRY.iter_unpack(self._map[index_offset:index_offset + count * INDEX_ENTRY.size])]
+
+        log.warning("RemoteMemory log %s has no index, scanning it", self._path)
+        index = []
+        offset = HEADER.size
+        while offset + RECORD.size <= len(self._map):
+            (_, _, request_length, reply_length) = RECORD.unpack_from(self._map, offset)
+            end = offset + RECORD.size + request_length + reply_length
+            if end > len(self._map):
+                break
+            index.append(offset)
+            offset = end
+        return index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, sequence):
+        offset = self._index[sequence]
+        (timestamp, duration, request_length, reply_length) = RECORD.unpack_from(self._map, offset)
+        offset += RECORD.size
+        (request, _) = self._wire_format.extract_messages(self._map[offset:offset + request_length])
+        (reply, _) = self._wire_format.extract_messages(self._map[offset + request_length:offset + request_length + reply_length])
+        (cmd, params) = self._wire_format.decode_request(request[0])
+        result = self._wire_format.decode_reply(cmd, reply[0])
+        return LogRecord(sequence, cmd, params, result, timestamp, duration)
+
+    def __iter__(self):
+        for sequence in range(len(self)):
+            yield self[sequence]
+
+    def close(self):
+        self._map.close()
+
+class RemoteMemoryReplay(object):
+    """Answers RemoteMemory requests from a recorded log"""
+    PAGE_SIZE = 4096
+
+    def __init__(self, log_path):
+        self._log = RemoteMemoryLog(log_path)
+        self._position = 0
+        self._divergence = None
+        self._pages = {}
+        self._cpu_state = None
+        self._lock = threading.Lock()
+
+    def attach(self, interface):
+        """Install the replay as request handler of a RemoteMemory interface"""
+        interface.set_read_handler(self.handle_read)
+        interface.set_write_handler(self.handle_write)
+        interface.set_set_cpu_state_handler(self.handle_set_cpu_state)
+        interface.set_get_cpu_state_handler(self.handle_get_cpu_state)
+        interface.set_continue_handler(self.handle_continue)
+        interface.set_get_checksum_handler(self.handle_get_checksum)
+        interface.set_read_range_handler(self.handle_read_range)
+        interface.set_write_range_handler(self.handle_write_range)
+        interface.set_fork_state_handler(self.handle_fork_state)
+        interface.set_kill_state_handler(self.handle_kill_state)
+
+    def get_position(self):
+        """Return the number of log records replayed so far"""
+        return self._position
+
+    def get_divergence(self):
+        """Return a description of the first divergence from the log, or None"""
+        return self._divergence
+
+    def _next(self, cmd, params):
+        """Return the matching next record, or None once the run diverged"""
+        with self._lock:
+            if self._divergence is not None:
+                return None
+            if self._position >= len(self._log):
+                self._diverge("end of log", None, cmd, params)
+                return None
+            record = self._log[self._position]
+            reason = self._compare(record, cmd, params)
+            if reason:
+                self._diverge(reason, record, cmd, params)
+                return None
+            self._position += 1
+            self._apply(record)
+            return record
+
+    def _compare(self, record, cmd, params):
+        if record.cmd != cmd:
+            return "command"
+        if cmd in ["read", "write", "read_range", "write_range", "get_checksum"]:
+            if record.params["address"] != params["address"]:
+                return "address"
+            if record.params["size"] != params["size"]:
+                return "size"
+        if cmd == "write" and record.params["value"] != params["value"]:
+            return "value"
+        if cmd == "write_range" and "data" in record.params and "data" in params \
+                and bytes(record.params["data"]) != bytes(params["data"]):
+            return "value"
+        if record.get_pc() != get_pc(params):
+            return "pc"
+        return None
+
+    def _diverge(self, reason, record, cmd, params):
+        actual = {"cmd": cmd,
+                  "address": params and params.get("address"),
+                  "size": params and params.get("size"),
+                  "pc": get_pc(params)}
+        expected = record and {"cmd": record.cmd,
+                               "address": record.params and record.params.get("address"),
+                               "size": record.params and record.params.get("size"),
+                               "pc": record.get_pc()}
+        self._divergence = {"sequence": self._position,
+                            "reason": reason,
+                            "expected": expected,
+                            "actual": actual}
+        log.error("RemoteMemory replay diverged at request %d (%s): expected %s, got %s",
+                  self._position, reason, str(expected), str(actual))
+
+    def _apply(self, record):
+        """Track the memory contents seen in the log"""
+        if record.cmd == "read":
+            self._write_image(record.params["address"], record.result.to_bytes(record.params["size"], "little"))
+        elif record.cmd == "write":
+            self._write_image(record.params["address"], record.params["value"].to_bytes(record.params["size"], "little"))
+        elif record.cmd == "read_range":
+            self._write_image(record.params["address"], record.result)
+        elif record.cmd == "write_range" and "data" in record.params:
+            self._write_image(record.params["address"], record.params["data"])
+        elif record.cmd == "get_cpu_state":
+            self._cpu_state = record.result
+
+    def _write_image(self, address, data):
+        offset = 0
+        while offset < len(data):
+            (page, page_offset) = divmod(address + offset, self.PAGE_SIZE)
+            length = min(len(data) - offset, self.PAGE_SIZE - page_offset)
+            if not page in self._pages:
+                self._pages[page] = bytearray(self.PAGE_SIZE)
+            self._pages[page][page_offset:page_offset + length] = data[offset:offset + length]
+            offset += length
+
+    def _read_image(self, address, size):
+        data = bytearray()
+        while len(data) < size:
+            (page, page_offset) = divmod(address + len(data), self.PAGE_SIZE)
+            length = min(size - len(data), self.PAGE_SIZE - page_offset)
+            if page in self._pages:
+                data += self._pages[page][page_offset:page_offset + length]
+            else:
+                data += bytes(length)
+        return bytes(data)
+
+    def handle_read(self, params):
+        record = self._next("read", params)
+        if record is not None:
+            return record.result
+        return int.from_bytes(self._read_image(params["address"], params["size"]), "little")
+
+    def handle_write(self, params):
+        if self._next("write", params) is None:
+            self._write_image(params["address"], params["value"].to_bytes(params["size"], "little"))
+
+    def handle_read_range(self, params):
+        record = self._next("read_range", params)
+        if record is not None:
+            return record.result
+        return self._read_image(params["address"], params["size"])
+
+    def handle_write_range(self, params):
+        if self._next("write_range", params) is None:
+            self._write_image(params["address"], params["data"])
+
+    def handle_set_cpu_state(self, params):
+        self._next("set_cpu_state", params)
+
+    def handle_get_cpu_state(self, params):
+        self._next("get_cpu_state", params)
+        cpu_state = self._cpu_state or {}
+        return dict(("cpu_state_" + reg, hex(cpu_state.get(reg, 0))) for reg in GET_CPU_STATE_REGISTERS)
+
+    def handle_continue(self, params):
+        self._next("continue", params)
+
+    def handle_fork_state(self, params):
+        self._next("fork_state", params)
+
+    def handle_kill_state(self, params):
+        self._next("kill_state", params)
+
+    def handle_get_checksum(self, params):
+        record = self._next("get_checksum", params)
+        if record is not None:
+            return record.result
+        log.warning("No recorded checksum for 0x%x-0x%x after divergence, answering 0",
+                    params["address"], params["address"] + params["size"])
+        return 0
+
+    def close(self):
+        self._log.close()
+
+if __name__ == '__main__':
+    from avatar.interfaces.s2e_remote_memory import S2ERemoteMemoryServer
+    logging.basicConfig(level = logging.INFO)
+    if len(sys.argv) != 3:
+        print("Usage: %s <log> <host:port|unix:/path>" % sys.argv[0])
+        sys.exit(1)
+    address = sys.argv[2]
+    if not address.startswith("unix:"):
+        address = (address[:address.rfind(":")], int(address[address.rfind(":") + 1:]))
+    replay = RemoteMemoryReplay(sys.argv[1])
+    server = S2ERemoteMemoryServer(address)
+    replay.attach(server)
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    print("Replayed %d requests, divergence: %s" % (replay.get_position(), str(replay.get_divergence())))
@@ -0,0 +1,101 @@
+'''
+Latency and throughput counters of the RemoteMemory bridge.
+
+Every request is split into four stages:
+
+ - wait: time the bridge was idle waiting for the request to arrive
+ - decode: parsing the request from the wire format
+ - handler: executing the request, i.e., the call into the target
+ - reply: encoding and sending the reply
+
+For each command and stage, the number of samples, their sum and maximum,
+and a histogram with power-of-two buckets (in nanoseconds) are kept.
+Recording a sample is a handful of integer operations, so the counters are
+always enabled.
+'''
+import json
+import time
+
+STAGES = ["wait", "decode", "handler", "reply"]
+#Bucket i counts samples of [2**(i-1), 2**i) ns, i.e., up to about 9 s
+HISTOGRAM_BUCKETS = 34
+
+class LatencyHistogram(object):
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, nanoseconds):
+        self.count += 1
+        self.total += nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+        self.buckets[min(nanoseconds.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def to_dict(self):
+        """Return the histogram in microseconds, leaving out empty buckets"""
+        buckets = list(self.buckets)
+        return {"count": self.count,
+                "total_us": self.total / 1000.0,
+                "mean_us": self.count and self.total / 1000.0 / self.count or 0.0,
+                "max_us": self.max / 1000.0,
+                "histogram": [{"le_us": (1 << i) / 1000.0, "count": count}
+                              for (i, count) in enumerate(buckets) if count]}
+
+class CommandStatistics(object):
+    __slots__ = ("count", "errors", "stages")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.stages = [LatencyHistogram() for _ in STAGES]
+
+class RemoteMemoryStatistics(object):
+    """
+    Per-command, per-stage counters. Samples are recorded by the thread
+    serving the emulator; get_statistics() can be called from any thread
+    and returns a JSON-serializable snapshot.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._commands = {}
+        self._started = time.time()
+
+    def record(self, cmd, wait, decode, handler, reply, error = False):
+        """Record one request, all durations in nanoseconds"""
+        try:
+            command = self._commands[cmd]
+        except KeyError:
+            command = self._commands[cmd] = CommandStatistics()
+        command.count += 1
+        if error:
+            command.errors += 1
+        stages = command.stages
+        stages[0].add(wait)
+        stages[1].add(decode)
+        stages[2].add(handler)
+        stages[3].add(reply)
+
+    def get_statistics(self):
+        elapsed = time.time() - self._started
+        commands = {}
+        for (cmd, command) in list(self._commands.items()):
+            commands[cmd] = {"count": command.count,
+                             "errors": command.errors,
+                             "per_second": elapsed and command.count / elapsed or 0.0,
+                             "stages": dict((stage, histogram.to_dict())
+                                            for (stage, histogram) in zip(STAGES, command.stages))}
+        return {"started": self._started,
+                "elapsed": elapsed,
+                "commands": commands}
+
+    def dump(self, path):
+        """Write a snapshot of the statistics as JSON to path"""
+        with open(path, "w") as f:
+            json.dump(self.get_statistics(), f, indent = 2, sort_keys = True)
@@ -0,0 +1,482 @@
+'''
+Wire formats of the S2E RemoteMemory channel.
+
+Two encodings are supported: the original newline-framed JSON records with
+hex-string fields, and a compact binary framing built from fixed-layout
+struct records. Both sides start out speaking JSON; the binary framing is
+only used when it was agreed on with a "negotiate" record right after the
+connection has been established.
+
+Each wire format knows how to encode and decode both directions, so that
+the same code can be used by Avatar and by stand-in peers.
+
+Besides word-sized reads and writes, whole memory ranges can be moved with
+read_range and write_range. Their data is either carried in the message, or,
+for large transfers between processes on the same host, exchanged through a
+file named in the request ("file" and "offset" parameters) that both sides
+map into memory.
+
+Emulators that fork execution states identify the state issuing a memory
+access or a continue with an optional "state" field, and announce forks
+and terminated states with fork_state and kill_state.
+'''
+import json
+import struct
+import logging
+from avatar.util.cpu_state import CpuState
+
+log = logging.getLogger("avatar.remote_memory_interface")
+
+#Registers carried in the cpu_state of read/write/set_cpu_state requests
+CPU_STATE_REGISTERS = ["r0", "r1", "r2", "r3", "r4", "r5", "r6", "r7",
+                       "r8", "r9", "r10", "r11", "r12", "r13", "r14",
+                       "pc", "cpsr"]
+#Index of each register in the CPU state, built once for all CpuStates
+CPU_STATE_INDEXES = dict((name, i) for (i, name) in enumerate(CPU_STATE_REGISTERS))
+#Registers returned by a get_cpu_state reply, as "cpu_state_<name>"
+GET_CPU_STATE_REGISTERS = CPU_STATE_REGISTERS[:-1]
+
+#Commands that the emulator does not expect an answer for
+REPLYLESS_COMMANDS = frozenset(["write", "write_buffer", "fork_state", "kill_state"])
+#Commands that may carry the identifier of the emulator state issuing them
+STATEFUL_COMMANDS = frozenset(["read", "write", "read_range", "write_range", "continue"])
+#Commands that may be carried in a batch request
+BATCHABLE_COMMANDS = frozenset(["read", "write"])
+
+NEGOTIATE_COMMAND = "negotiate"
+
+class FramedReader(object):
+    """
+    Reads framed messages from a socket.
+
+    Data is received in large chunks into a reusable buffer, and every
+    complete message is extracted and decoded exactly once by the wire
+    format. Partial messages are kept until the rest has arrived.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, sock, wire_format, chunk_size = CHUNK_SIZE):
+        self._sock = sock
+        self._wire_format = wire_format
+        self._chunk = memoryview(bytearray(chunk_size))
+        self._pending = bytearray()
+
+    def set_wire_format(self, wire_format):
+        """Switch the framing, data already received is kept"""
+        self._wire_format = wire_format
+
+    def fill(self):
+        """
+        Receive one chunk from the socket.
+        Raises EOFError when the peer closed the connection.
+        """
+        received = self._sock.recv_into(self._chunk)
+        if not received:
+            raise EOFError("RemoteMemory connection closed by peer")
+        self._pending += self._chunk[:received]
+
+    def extract_messages(self):
+        """Return the list of complete messages already received"""
+        (messages, consumed) = self._wire_format.extract_messages(self._pending)
+        if consumed:
+            del self._pending[:consumed]
+        return messages
+
+    def read_messages(self):
+        """Receive one chunk and return the list of messages completed by it"""
+        self.fill()
+        return self.extract_messages()
+
+    def peek_line(self):
+        """Return the first complete line without consuming it, or None"""
+        end = self._pending.find(b"\n")
+        if end < 0:
+            return None
+        return bytes(self._pending[:end])
+
+    def consume_line(self):
+        del self._pending[:self._pending.find(b"\n") + 1]
+
+def parse_negotiate_reply(line):
+    """Return the wire format name agreed on in a negotiate reply line, or None"""
+    try:
+        record = json.loads(line.decode(encoding = 'ascii'))
+    except ValueError:
+        return None
+    if not isinstance(record, dict) or record.get("reply") != NEGOTIATE_COMMAND:
+        return None
+    return record.get("wire_format")
+
+def encode_negotiate_request(wire_formats):
+    return (json.dumps({"cmd": NEGOTIATE_COMMAND, "wire_formats": wire_formats}) + "\n").encode(encoding = 'ascii')
+
+def encode_negotiate_reply(wire_format):
+    return (json.dumps({"reply": NEGOTIATE_COMMAND, "wire_format": wire_format}) + "\n").encode(encoding = 'ascii')
+
+class JsonWireFormat(object):
+    """Newline-framed JSON records with hex-string fields"""
+    name = "json"
+
+    def extract_messages(self, buffer):
+        end = buffer.rfind(b"\n")
+        if end < 0:
+            return ([], 0)
+
+        messages = []
+        for line in buffer[:end].split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                messages.append(json.loads(line.decode(encoding = 'ascii')))
+            except ValueError:
+                log.error("Dropping malformed RemoteMemory record: %s", repr(bytes(line)))
+        return (messages, end + 1)
+
+    def decode_request(self, record):
+        """Return the (cmd, params) tuple described by a request record"""
+        cmd = record["cmd"]
+        if cmd == "read":
+            params = {"address" : int(record["params"]["address"], 16),
+                      "size": int(record["params"]["size"], 16),
+                      "cpu_state": CpuState.from_strings(record["cpu_state"])}
+        elif cmd == "write":
+            params = {"address" : int(record["params"]["address"], 16),
+                      "size": int(record["params"]["size"], 16),
+                      "value": int(record["params"]["value"], 16),
+                      "cpu_state": CpuState.from_strings(record["cpu_state"])}
+        elif cmd == "set_cpu_state":
+            params = {"cpu_state": CpuState.from_strings(record["cpu_state"])}
+        elif cmd == "get_cpu_state":
+            params = None
+        elif cmd == "continue":
+            params = {}
+        elif cmd == "read_range":
+            params = self._decode_range(record["params"])
+        elif cmd == "write_range":
+            params = self._decode_range(record["params"])
+            if not "file" in params:
+                params["data"] = bytes.fromhex(record["params"]["data"])
+        elif cmd == "write_buffer":
+            #Legacy form of write_range, the whole file is written
+            params = {"address": int(record["address"], 16),
+                      "size": None,
+                      "file": record["file"],
+                      "offset": 0}
+        elif cmd == "get_checksum":
+            params = {"address": int(record["params"]["address"], 16),
+                      "size": int(record["params"]["size"], 16)}
+        elif cmd == "batch":
+            params = {"requests": [self.decode_request(x) for x in record["requests"]]}
+        elif cmd == "fork_state":
+            params = {"state": int(record["state"], 16),
+                      "child": int(record["child"], 16)}
+        elif cmd == "kill_state":
+            params = {"state": int(record["state"], 16)}
+        else:
+            params = record
+        if cmd in STATEFUL_COMMANDS and "state" in record:
+            params["state"] = int(record["state"], 16)
+        return (cmd, params)
+
+    def _decode_range(self, record):
+        params = {"address": int(record["address"], 16),
+                  "size": int(record["size"], 16)}
+        if "file" in record:
+            params["file"] = record["file"]
+            params["offset"] = "offset" in record and int(record["offset"], 16) or 0
+        return params
+
+    def encode_reply(self, cmd, result):
+        if cmd == "read":
+            reply = {"reply": "read", "value": "0x%x" % result}
+        elif cmd == "get_cpu_state":
+            reply = dict(result)
+            reply["reply"] = "get_cpu_state"
+        elif cmd == "get_checksum":
+            reply = {"reply": "done", "value": "0x%08x" % result}
+        elif cmd == "batch":
+            reply = {"reply": "batch", "values": [None if x is None else "0x%x" % x for x in result]}
+        elif cmd == "read_range" and result is not None:
+            reply = {"reply": "read_range", "data": bytes(result).hex()}
+        else:
+            reply = {"reply": "done"}
+        return (json.dumps(reply) + "\n").encode(encoding = 'ascii')
+
+    def encode_request(self, cmd, params):
+        return (json.dumps(self._request_record(cmd, params)) + "\n").encode(encoding = 'ascii')
+
+    def _request_record(self, cmd, params):
+        record = {"cmd": cmd}
+        if cmd == "read":
+            record["params"] = {"address": "0x%x" % params["address"],
+                                "size": "0x%x" % params["size"]}
+            record["cpu_state"] = dict((reg, "0x%x" % val) for (reg, val) in params["cpu_state"].items())
+        elif cmd == "write":
+            record["params"] = {"address": "0x%x" % params["address"],
+                                "size": "0x%x" % params["size"],
+                                "value": "0x%x" % params["value"]}
+            record["cpu_state"] = dict((reg, "0x%x" % val) for (reg, val) in params["cpu_state"].items())
+        elif cmd == "set_cpu_state":
+            record["cpu_state"] = dict((reg, "0x%x" % val) for (reg, val) in params["cpu_state"].items())
+        elif cmd == "get_checksum":
+            record["params"] = {"address": "0x%x" % params["address"],
+                                "size": "0x%x" % params["size"]}
+        elif cmd == "batch":
+            record["requests"] = [self._request_record(x, y) for (x, y) in params["requests"]]
+        elif cmd == "read_range" or cmd == "write_range":
+            record["params"] = {"address": "0x%x" % params["address"],
+                                "size": "0x%x" % params["size"]}
+            if "file" in params:
+                record["params"]["file"] = params["file"]
+                record["params"]["offset"] = "0x%x" % params.get("offset", 0)
+            elif cmd == "write_range":
+                record["params"]["data"] = bytes(params["data"]).hex()
+        elif cmd == "fork_state":
+            record["child"] = "0x%x" % params["child"]
+        if params and "state" in params and (cmd in STATEFUL_COMMANDS or cmd == "fork_state" or cmd == "kill_state"):
+            record["state"] = "0x%x" % params["state"]
+        return record
+
+    def decode_reply(self, cmd, record):
+        if cmd == "read" or cmd == "get_checksum":
+            return int(record["value"], 16)
+        elif cmd == "get_cpu_state":
+            return dict((reg, int(record["cpu_state_" + reg], 16)) for reg in GET_CPU_STATE_REGISTERS)
+        elif cmd == "batch":
+            return [None if x is None else int(x, 16) for x in record["values"]]
+        elif cmd == "read_range" and "data" in record:
+            return bytes.fromhex(record["data"])
+        return None
+
+class BinaryWireFormat(object):
+    """
+    Fixed-layout binary framing.
+
+    Every message starts with a header holding the message type and the
+    payload length. Replies use the type of their request with the
+    REPLY_FLAG bit set. All values are little endian.
+
+    The payload of a BATCH request is a sequence of complete READ and WRITE
+    messages, the payload of its reply holds one reply message per request,
+    in the same order.
+
+    READ_RANGE and WRITE_RANGE requests start with a RANGE_REQUEST record.
+    If RANGE_STATE is set in its flags, a STATE record follows. Then, if
+    RANGE_FILE is set, comes the name of the payload file, otherwise a
+    WRITE_RANGE carries the data to write. The reply of a READ_RANGE holds
+    the data read, and is empty if it went to a file.
+
+    READ, WRITE and CONTINUE requests may end with a STATE record.
+    """
+    name = "binary"
+
+    HEADER = struct.Struct("<BI")
+
+    READ = 0x01
+    WRITE = 0x02
+    GET_CPU_STATE = 0x03
+    SET_CPU_STATE = 0x04
+    CONTINUE = 0x05
+    GET_CHECKSUM = 0x06
+    BATCH = 0x07
+    READ_RANGE = 0x08
+    WRITE_RANGE = 0x09
+    FORK_STATE = 0x0a
+    KILL_STATE = 0x0b
+    REPLY_FLAG = 0x80
+
+    RANGE_FILE = 0x01
+    RANGE_STATE = 0x02
+
+    COMMAND_NAMES = {READ: "read",
+                     WRITE: "write",
+                     GET_CPU_STATE: "get_cpu_state",
+                     SET_CPU_STATE: "set_cpu_state",
+                     CONTINUE: "continue",
+                     GET_CHECKSUM: "get_checksum",
+                     BATCH: "batch",
+                     READ_RANGE: "read_range",
+                     WRITE_RANGE: "write_range",
+                     FORK_STATE: "fork_state",
+                     KILL_STATE: "kill_state"}
+    COMMAND_TYPES = dict((name, msg_type) for (msg_type, name) in COMMAND_NAMES.items())
+
+    _CPU_STATE_FORMAT = "%dI" % len(CPU_STATE_REGISTERS)
+    READ_REQUEST = struct.Struct("<QB" + _CPU_STATE_FORMAT)
+    WRITE_REQUEST = struct.Struct("<QBQ" + _CPU_STATE_FORMAT)
+    SET_CPU_STATE_REQUEST = struct.Struct("<" + _CPU_STATE_FORMAT)
+    GET_CHECKSUM_REQUEST = struct.Struct("<QQ")
+    #Address, size, offset in the payload file, flags
+    RANGE_REQUEST = struct.Struct("<QQQB")
+    STATE = struct.Struct("<I")
+    FORK_STATE_REQUEST = struct.Struct("<II")
+    READ_REPLY = struct.Struct("<Q")
+    #Header and record of the most frequent messages, packed in one call
+    READ_REQUEST_FRAME = struct.Struct("<BI" + READ_REQUEST.format[1:])
+    WRITE_REQUEST_FRAME = struct.Struct("<BI" + WRITE_REQUEST.format[1:])
+    READ_REPLY_FRAME = struct.Struct("<BIQ")
+    GET_CPU_STATE_REPLY = struct.Struct("<%dI" % len(GET_CPU_STATE_REGISTERS))
+    GET_CHECKSUM_REPLY = struct.Struct("<I")
+
+    #Index of each register in the unpacked READ and WRITE records, so that
+    #the CpuState wraps the unpacked tuple without slicing it
+    READ_CPU_STATE_INDEXES = dict((name, i + 2) for (name, i) in CPU_STATE_INDEXES.items())
+    WRITE_CPU_STATE_INDEXES = dict((name, i + 3) for (name, i) in CPU_STATE_INDEXES.items())
+
+    def extract_messages(self, buffer):
+        messages = []
+        offset = 0
+        header_size = self.HEADER.size
+        unpack_header = self.HEADER.unpack_from
+        available = len(buffer)
+        while available - offset >= header_size:
+            (msg_type, length) = unpack_header(buffer, offset)
+            end = offset + header_size + length
+            if end > available:
+                break
+            messages.append((msg_type, bytes(buffer[offset + header_size:end])))
+            offset = end
+        return (messages, offset)
+
+    def _decode_cpu_state(self, values):
+        return CpuState.from_values(CPU_STATE_INDEXES, values)
+
+    def _encode_cpu_state(self, cpu_state):
+        if isinstance(cpu_state, CpuState):
+            return [reg in cpu_state and cpu_state.get_value(reg) or 0 for reg in CPU_STATE_REGISTERS]
+        get = cpu_state.get
+        return [get(reg, 0) for reg in CPU_STATE_REGISTERS]
+
+    def _frame(self, msg_type, payload = b""):
+        return self.HEADER.pack(msg_type, len(payload)) + payload
+
+    def _decode_state(self, params, payload, offset):
+        """Add the STATE record found at offset of payload, if any, to params"""
+        if len(payload) >= offset + self.STATE.size:
+            params["state"] = self.STATE.unpack_from(payload, offset)[0]
+        return params
+
+    def _encode_state(self, params):
+        return params and "state" in params and self.STATE.pack(params["state"]) or b""
+
+    def decode_request(self, message):
+        (msg_type, payload) = message
+        if msg_type == self.READ:
+            values = self.READ_REQUEST.unpack_from(payload)
+            params = {"address": values[0],
+                      "size": values[1],
+                      "cpu_state": CpuState(None, self.READ_CPU_STATE_INDEXES, values)}
+            if len(payload) > self.READ_REQUEST.size:
+                self._decode_state(params, payload, self.READ_REQUEST.size)
+            return ("read", params)
+        elif msg_type == self.WRITE:
+            values = self.WRITE_REQUEST.unpack_from(payload)
+            params = {"address": values[0],
+                      "size": values[1],
+                      "value": values[2],
+                      "cpu_state": CpuState(None, self.WRITE_CPU_STATE_INDEXES, values)}
+            if len(payload) > self.WRITE_REQUEST.size:
+                self._decode_state(params, payload, self.WRITE_REQUEST.size)
+            return ("write", params)
+        elif msg_type == self.CONTINUE:
+            return ("continue", self._decode_state({}, payload, 0))
+        elif msg_type == self.FORK_STATE:
+            (state, child) = self.FORK_STATE_REQUEST.unpack(payload)
+            return ("fork_state", {"state": state, "child": child})
+        elif msg_type == self.KILL_STATE:
+            return ("kill_state", {"state": self.STATE.unpack(payload)[0]})
+        elif msg_type == self.SET_CPU_STATE:
+            return ("set_cpu_state", {"cpu_state": self._decode_cpu_state(self.SET_CPU_STATE_REQUEST.unpack(payload))})
+        elif msg_type == self.GET_CHECKSUM:
+            (address, size) = self.GET_CHECKSUM_REQUEST.unpack(payload)
+            return ("get_checksum", {"address": address, "size": size})
+        elif msg_type == self.BATCH:
+            (messages, _) = self.extract_messages(payload)
+            return ("batch", {"requests": [self.decode_request(x) for x in messages]})
+        elif msg_type == self.READ_RANGE or msg_type == self.WRITE_RANGE:
+            (address, size, offset, flags) = self.RANGE_REQUEST.unpack_from(payload)
+            params = {"address": address, "size": size}
+            start = self.RANGE_REQUEST.size
+            if flags & self.RANGE_STATE:
+                self._decode_state(params, payload, start)
+                start += self.STATE.size
+            if flags & self.RANGE_FILE:
+                params["file"] = payload[start:].decode()
+                params["offset"] = offset
+            elif msg_type == self.WRITE_RANGE:
+                params["data"] = memoryview(payload)[start:]
+                assert(len(params["data"]) == size)
+            return (self.COMMAND_NAMES[msg_type], params)
+        elif msg_type in self.COMMAND_NAMES:
+            return (self.COMMAND_NAMES[msg_type], None)
+        return ("binary message type 0x%02x" % msg_type, None)
+
+    def encode_reply(self, cmd, result):
+        if cmd == "read":
+            return self.READ_REPLY_FRAME.pack(self.READ | self.REPLY_FLAG, self.READ_REPLY.size, result)
+        msg_type = self.COMMAND_TYPES[cmd] | self.REPLY_FLAG
+        if cmd == "get_cpu_state":
+            return self._frame(msg_type, self.GET_CPU_STATE_REPLY.pack(
+                *[int(result["cpu_state_" + reg], 16) for reg in GET_CPU_STATE_REGISTERS]))
+        elif cmd == "get_checksum":
+            return self._frame(msg_type, self.GET_CHECKSUM_REPLY.pack(result))
+        elif cmd == "batch":
+            return self._frame(msg_type, b"".join(
+                [self.encode_reply(x is None and "write" or "read", x) for x in result]))
+        elif cmd == "read_range" and result is not None:
+            return self._frame(msg_type, result)
+        return self._frame(msg_type)
+
+    def encode_request(self, cmd, params):
+        if cmd == "read":
+            if "state" in params:
+                return self._frame(self.READ, self.READ_REQUEST.pack(
+                    params["address"], params["size"], *self._encode_cpu_state(params["cpu_state"])) + self._encode_state(params))
+            return self.READ_REQUEST_FRAME.pack(self.READ, self.READ_REQUEST.size,
+                params["address"], params["size"], *self._encode_cpu_state(params["cpu_state"]))
+        elif cmd == "write":
+            if "state" in params:
+                return self._frame(self.WRITE, self.WRITE_REQUEST.pack(
+                    params["address"], params["size"], params["value"], *self._encode_cpu_state(params["cpu_state"])) \
+                    + self._encode_state(params))
+            return self.WRITE_REQUEST_FRAME.pack(self.WRITE, self.WRITE_REQUEST.size,
+                params["address"], params["size"], params["value"], *self._encode_cpu_state(params["cpu_state"]))
+        elif cmd == "continue":
+            return self._frame(self.CONTINUE, self._encode_state(params))
+        elif cmd == "fork_state":
+            return self._frame(self.FORK_STATE, self.FORK_STATE_REQUEST.pack(params["state"], params["child"]))
+        elif cmd == "kill_state":
+            return self._frame(self.KILL_STATE, self.STATE.pack(params["state"]))
+        elif cmd == "set_cpu_state":
+            return self._frame(self.SET_CPU_STATE, self.SET_CPU_STATE_REQUEST.pack(
+                *self._encode_cpu_state(params["cpu_state"])))
+        elif cmd == "get_checksum":
+            return self._frame(self.GET_CHECKSUM, self.GET_CHECKSUM_REQUEST.pack(params["address"], params["size"]))
+        elif cmd == "batch":
+            return self._frame(self.BATCH, b"".join([self.encode_request(x, y) for (x, y) in params["requests"]]))
+        elif cmd == "read_range" or cmd == "write_range":
+            flags = "state" in params and self.RANGE_STATE or 0
+            if "file" in params:
+                header = self.RANGE_REQUEST.pack(params["address"], params["size"], params.get("offset", 0), flags | self.RANGE_FILE)
+                return self._frame(self.COMMAND_TYPES[cmd], header + self._encode_state(params) + params["file"].encode())
+            header = self.RANGE_REQUEST.pack(params["address"], params["size"], 0, flags) + self._encode_state(params)
+            return self._frame(self.COMMAND_TYPES[cmd], cmd == "write_range" and header + bytes(params["data"]) or header)
+        return self._frame(self.COMMAND_TYPES[cmd])
+
+    def decode_reply(self, cmd, message):
+        (_, payload) = message
+        if cmd == "read":
+            return self.READ_REPLY.unpack(payload)[0]
+        elif cmd == "get_cpu_state":
+            return dict(zip(GET_CPU_STATE_REGISTERS, self.GET_CPU_STATE_REPLY.unpack(payload)))
+        elif cmd == "get_checksum":
+            return self.GET_CHECKSUM_REPLY.unpack(payload)[0]
+        elif cmd == "batch":
+            (messages, _) = self.extract_messages(payload)
+            return [self.READ_REPLY.unpack(x[1])[0] if x[0] == self.READ | self.REPLY_FLAG else None for x in messages]
+        elif cmd == "read_range":
+            return payload
+        return None
+
+WIRE_FORMATS = {JsonWireFormat.name: JsonWireFormat(),
+                BinaryWireFormat.name: BinaryWireFormat()}
@@ -1,10 +1,18 @@
 import threading
 import logging
-import sys
 import json
-import socket
+import os
+import mmap
+import selectors
 import time
+from time import perf_counter_ns
 from select import select
+from avatar.interfaces.remote_memory_wire import FramedReader, WIRE_FORMATS, \
+    REPLYLESS_COMMANDS, BATCHABLE_COMMANDS, NEGOTIATE_COMMAND, \
+    encode_negotiate_request, encode_negotiate_reply, parse_negotiate_reply
+from avatar.interfaces.remote_memory_stats import RemoteMemoryStatistics
+from avatar.interfaces.shm_ring import SharedMemoryChannel, DEFAULT_CAPACITY
+from avatar.util.ostools import connect_socket, listen_socket, format_address, get_socket_address
 
 log = logging.getLogger("avatar.remote_memory_interface")
 
@@ -16,6 +24,24 @@ class RemoteMemoryInterface(object):
         self._get_cpu_state_handler = None
         self._continue_handler = None
         self._get_checksum_handler = None
+        self._read_range_handler = None
+        self._write_range_handler = None
+        self._fork_state_handler = None
+        self._kill_state_handler = None
+        self._request_handlers = {"read": self._handle_read,
+                                  "write": self._handle_write,
+                                  "set_cpu_state": self._handle_set_cpu_state,
+                                  "get_cpu_state": self._handle_get_cpu_state,
+                                  "continue": self._handle_continue,
+                                  "get_checksum": self._handle_get_checksum,
+                                  "batch": self._handle_batch,
+                                  "read_range": self._handle_read_range,
+                                  "write_range": self._handle_write_range,
+                                  "write_buffer": self._handle_write_range,
+                                  "fork_state": self._handle_fork_state,
+                                  "kill_state": self._handle_kill_state}
+        self._statistics = RemoteMemoryStatistics()
+        self._recorder = None
         
     def set_read_handler(self, listener):
         self._read_handler = listener
@@ -34,7 +60,31 @@ class RemoteMemoryInterface(object):
 
     def set_get_checksum_handler(self, listener):
         self._get_checksum_handler= listener
+
+    def set_read_range_handler(self, listener):
+        self._read_range_handler = listener
+
+    def set_write_range_handler(self, listener):
+        self._write_range_handler = listener
+
+    def set_fork_state_handler(self, listener):
+        self._fork_state_handler = listener
+
+    def set_kill_state_handler(self, listener):
+        self._kill_state_handler = listener
         
+    def set_recorder(self, recorder):
+        """Record all handled requests with a RemoteMemoryRecorder, None to stop"""
+        self._recorder = recorder
+
+    def get_statistics(self):
+        """Return a snapshot of the per-command, per-stage latency counters"""
+        return self._statistics.get_statistics()
+
+    def dump_statistics(self, path):
+        """Write the latency counters as JSON to path"""
+        self._statistics.dump(path)
+
     def _handle_read(self, params):
         assert(self._read_handler) #Read handler must be installed when this is called
 
@@ -65,26 +115,197 @@ class RemoteMemoryInterface(object):
     def _handle_get_checksum(self, params):
         assert(self._get_checksum_handler)
 
-        return self._get_checksum_handler(params['address'], params['size'])
+        return self._get_checksum_handler(params)
+
+    def _handle_read_range(self, params):
+        """
+        Read a memory range through the read range handler. The data is
+        returned, or stored at the requested offset of the payload file,
+        which is grown if necessary.
+        """
+        assert(self._read_range_handler)
+
+        data = self._read_range_handler(params)
+        if not "file" in params:
+            return data
+
+        fd = os.open(params["file"], os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            end = params["offset"] + len(data)
+            if os.fstat(fd).st_size < end:
+                os.ftruncate(fd, end)
+            if data:
+                with mmap.mmap(fd, 0) as mapping:
+                    mapping[params["offset"]:end] = data
+        finally:
+            os.close(fd)
+        params["data"] = data #Kept for the recorder
+        return None
+
+    def _handle_write_range(self, params):
+        """
+        Write a memory range through the write range handler. Data that is
+        passed in a payload file is handed to the handler as a view of the
+        mapped file, without copying it.
+        """
+        assert(self._write_range_handler)
+
+        if not "file" in params:
+            self._write_range_handler(params)
+            return
+
+        with open(params["file"], "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapping:
+                offset = params["offset"]
+                if params["size"] is None:
+                    params["size"] = len(mapping) - offset
+                assert(offset + params["size"] <= len(mapping)) #Payload file too short
+                data = memoryview(mapping)[offset:offset + params["size"]]
+                try:
+                    params["data"] = data
+                    self._write_range_handler(params)
+                finally:
+                    if self._recorder is not None:
+                        params["data"] = bytes(data) #Kept for the recorder
+                    else:
+                        del params["data"]
+                    data.release()
+
+    def _handle_fork_state(self, params):
+        assert(self._fork_state_handler)
+
+        self._fork_state_handler(params)
+
+    def _handle_kill_state(self, params):
+        assert(self._kill_state_handler)
+
+        self._kill_state_handler(params)
+
+    def _handle_batch(self, params):
+        """
+        Execute a batch of reads and writes in order through the read and
+        write handlers. Returns one result per request, the value for reads
+        and None for writes.
+        """
+        results = []
+        for (cmd, request_params) in params["requests"]:
+            assert(cmd in BATCHABLE_COMMANDS) #Only reads and writes can be batched
+            results.append(self._request_handlers[cmd](request_params))
+        return results
+
+    def _dispatch_request(self, cmd, params):
+        """Run the handler of one decoded request and return its result"""
+        try:
+            handler = self._request_handlers[cmd]
+        except KeyError:
+            log.error("Unknown cmd %s" % cmd)
+            return None
+        return handler(params)
+
+    def _process_message(self, wire_format, message, wait, send):
+        """
+        Decode and execute one request and pass the encoded reply, if the
+        command has one, to send(). wait is the time in nanoseconds the
+        connection was idle before the request arrived.
+        """
+        cmd = "invalid"
+        reply = None
+        error = False
+        decoded = handled = None
+        start = perf_counter_ns()
+        try:
+            (cmd, params) = wire_format.decode_request(message)
+            decoded = perf_counter_ns()
+            result = self._dispatch_request(cmd, params)
+            handled = perf_counter_ns()
+            if not cmd in REPLYLESS_COMMANDS and cmd in self._request_handlers:
+                reply = wire_format.encode_reply(cmd, result)
+            if self._recorder is not None:
+                self._recorder.record(cmd, params, result, start, handled - decoded)
+        except Exception:
+            log.exception("Error in remote memory interface")
+            error = True
+        if reply is not None:
+            send(reply)
+        end = perf_counter_ns()
+        if decoded is None:
+            decoded = end
+        if handled is None:
+            handled = end
+        self._statistics.record(cmd, wait, decoded - start, handled - decoded, end - handled, error)
+
+    def _process_messages(self, wire_format, messages, idle_since, send):
+        """
+        Process a burst of requests that arrived together. The idle time is
+        attributed to the first one. Returns the time the bridge went idle
+        again.
+        """
+        wait = perf_counter_ns() - idle_since
+        for message in messages:
+            self._process_message(wire_format, message, wait, send)
+            wait = 0
+        return perf_counter_ns()
 
 class S2ERemoteMemoryInterface(RemoteMemoryInterface):
-        def __init__(self, sock_address):
+        NEGOTIATION_TIMEOUT = 2
+
+        def __init__(self, sock_address, wire_format = "json"):
+            """
+            :param sock_address: Address of the S2E RemoteMemory plugin, a
+                (host, port) tuple or a "unix:/path" string
+            :param wire_format: Preferred wire format ("json" or "binary"),
+                JSON is used if the plugin does not agree on binary framing
+            """
             super(S2ERemoteMemoryInterface, self).__init__()
+            assert(wire_format in WIRE_FORMATS)
             self._thread = threading.Thread(target = self._run)
 
             self._sock_address = sock_address
+            self._preferred_wire_format = wire_format
+            self._wire_format = WIRE_FORMATS["json"]
             self._stop = threading.Event()
             
         def start(self):
             self._thread.start()
 
+        def get_wire_format(self):
+            """Return the name of the wire format in use"""
+            return self._wire_format.name
+
+        def _negotiate_wire_format(self, sock, reader):
+            """
+            Propose the preferred wire format to the plugin. A plugin that
+            does not answer within NEGOTIATION_TIMEOUT, or that sends a request
+            instead, is talked to in JSON.
+            """
+            sock.sendall(encode_negotiate_request([self._preferred_wire_format, "json"]))
+            deadline = time.time() + self.NEGOTIATION_TIMEOUT
+            while reader.peek_line() is None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stop.is_set():
+                    log.info("RemoteMemory plugin did not negotiate, using JSON wire format")
+                    return
+                (rd, _, _) = select([sock], [], [], min(remaining, 1))
+                if rd:
+                    reader.fill()
+
+            wire_format = parse_negotiate_reply(reader.peek_line())
+            if wire_format is None:
+                log.info("RemoteMemory plugin does not support negotiation, using JSON wire format")
+                return
+            reader.consume_line()
+            if wire_format in WIRE_FORMATS:
+                self._wire_format = WIRE_FORMATS[wire_format]
+                reader.set_wire_format(self._wire_format)
+            log.info("Using %s wire format for RemoteMemory", self._wire_format.name)
+
         def _run(self):
             
             retries=1
             while retries < 10:
                 try:
-                    log.debug("Connecting to S2E RemoteMemory plugin at %s:%d", self._sock_address[0], self._sock_address[1])
-                    sock = socket.create_connection(self._sock_address)
+                    log.debug("Connecting to S2E RemoteMemory plugin at %s", format_address(self._sock_address))
+                    sock = connect_socket(self._sock_address)
                     log.info("Connection to RemoteMemory plugin established")
                     retries=10
                 except Exception:
@@ -93,84 +314,216 @@ class S2ERemoteMemoryInterface(RemoteMemoryInterface):
                     retries = retries+1
                     sock=None
             
-            #TODO: Do proper error signalling
             if not sock:
-                sys.exit(1)
-            
-            while not self._stop.is_set():
-                buffer = ""
-                while True:
-                    if self._stop.is_set():
-                        return
+                log.error("Giving up connecting to S2E RemoteMemory plugin at %s", format_address(self._sock_address))
+                return
+
+            reader = FramedReader(sock, self._wire_format)
+            try:
+                if self._preferred_wire_format != "json":
+                    self._negotiate_wire_format(sock, reader)
+                idle_since = perf_counter_ns()
+                messages = reader.extract_messages()
+                while not self._stop.is_set():
+                    if messages:
+                        idle_since = self._process_messages(self._wire_format, messages, idle_since, sock.sendall)
                     (rd, _, _) = select([sock], [], [], 1)
-                    if rd:
-                        buffer += sock.recv(1).decode(encoding = 'ascii')
-                        try:
-                            # this is outrageous
-                            request = json.loads(buffer)
-                            log.debug('buf: %s' % repr(buffer))
-                            buffer = "" # reset the buffer if we were able to parse it
-                            request["cmd"] # wait for cmd?
-                            break
-                        except:
-                            # wait for more data
-                            pass
-                try:
-                    if request["cmd"] == "read":
-                        params = {"address" : int(request["params"]["address"], 16),
-                                  "size": int(request["params"]["size"], 16),
-                                  "cpu_state": request["cpu_state"]}
-                        value = self._handle_read(params)
-                        json_string = json.dumps({"reply": "read", "value": "0x%x" % value}) + "\n"
-                        sock.send(json_string.encode(encoding = 'ascii'))
-                    elif request["cmd"] == "write":
-                        params = {"address" : int(request["params"]["address"], 16),
-                                  "size": int(request["params"]["size"], 16),
-                                  "value": int(request["params"]["value"], 16),
-                                  "cpu_state": request["cpu_state"]}
-                        self._handle_write(params)
-                    elif request["cmd"] == "set_cpu_state":
-                        params = {"cpu_state": request["cpu_state"]}
-                        self._handle_set_cpu_state(params)
-                        json_string = json.dumps({"reply":"done"}) + \
-                                "\n"
-                        sock.sendall(json_string.encode(encoding =
-                            'ascii'))
-                    elif request["cmd"] == "get_cpu_state":
-                        params = None
-                        ret = self._handle_get_cpu_state(params)
-                        ret = dict(list(ret.items()) + list({"reply":"get_cpu_state"}.items()))
-                        json_string = json.dumps(ret) + "\n"
-                        sock.sendall(json_string.encode(encoding =
-                            'ascii'))
-                    elif request["cmd"] == "continue":
-                        params = None
-                        self._handle_continue(params)
-                        # here we should wait for the breakpoint to be
-                        # hit
-                        json_string = json.dumps({"reply":"done"}) + \
-                                "\n"
-                        sock.sendall(json_string.encode(encoding =
-                            'ascii'))
-                    elif request["cmd"] == "write_buffer":
-                        params = {"address": int(request["address"], 16),
-                                "file": request["file"]}
-                        self._handle_write_buffer(params)
-                    elif request["cmd"] == "get_checksum":
-                        params = {"address": int(request["params"]["address"], 16),
-                                "size": int(request["params"]["size"], 16)}
-                        ret = self._handle_get_checksum(params)
-
-                        json_string = json.dumps({"reply":"done", \
-                            "value": "0x%08x" % ret}) + \
-                                "\n"
-                        sock.sendall(json_string.encode(encoding =
-                            'ascii'))
-                    else:
-                        log.error("Unknown cmd %s" % (request['cmd']))
-                except Exception:
-                    log.exception("Error in remote memory interface")
-                    
+                    messages = rd and reader.read_messages() or []
+            except EOFError:
+                log.info("RemoteMemory plugin closed the connection")
+            sock.close()
+
         def stop(self):
             self._stop.set()
     
+class RemoteMemoryConnection(object):
+    """Per-connection context of a RemoteMemory server"""
+    def __init__(self, connection_id, sock, peer_address):
+        self.id = connection_id
+        self.sock = sock
+        self.peer_address = peer_address
+        self.wire_format = WIRE_FORMATS["json"]
+        self.reader = FramedReader(sock, self.wire_format)
+        self.negotiated = False
+        self.outgoing = bytearray()
+        self.idle_since = perf_counter_ns()
+
+class S2ERemoteMemoryServer(RemoteMemoryInterface):
+    """
+    RemoteMemory endpoint that listens for emulator connections.
+
+    Several emulators (e.g., forked S2E worker processes) can be connected
+    at the same time. All connections are multiplexed by a single selector
+    loop, each one keeping its own framing and wire format. Requests are
+    executed one at a time, so that handlers never access the target
+    concurrently.
+    """
+    def __init__(self, listen_address, wire_formats = ["binary", "json"]):
+        """
+        :param listen_address: Address to listen on for emulator connections,
+            a (host, port) tuple or a "unix:/path" string
+        :param wire_formats: Wire formats agreed to when an emulator
+            negotiates, in order of preference
+        """
+        super(S2ERemoteMemoryServer, self).__init__()
+        self._listen_address = listen_address
+        self._wire_formats = wire_formats
+        self._connections = {}
+        self._next_connection_id = 0
+        self._handler_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._listen_sock = None
+        self._thread = threading.Thread(target = self._run)
+        self._stop = threading.Event()
+
+    def start(self):
+        self._listen_sock = listen_socket(self._listen_address)
+        self._listen_sock.setblocking(False)
+        self._selector.register(self._listen_sock, selectors.EVENT_READ, None)
+        log.info("RemoteMemory server listening on %s", format_address(self.get_address()))
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get_address(self):
+        return get_socket_address(self._listen_sock)
+
+    def get_connections(self):
+        """Return the list of currently connected emulators"""
+        return list(self._connections.values())
+
+    def _dispatch_request(self, cmd, params):
+        with self._handler_lock:
+            return super(S2ERemoteMemoryServer, self)._dispatch_request(cmd, params)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                for (key, events) in self._selector.select(1):
+                    if key.data is None:
+                        self._accept()
+                        continue
+                    connection = key.data
+                    try:
+                        if events & selectors.EVENT_WRITE:
+                            self._flush(connection)
+                        if events & selectors.EVENT_READ:
+                            self._service(connection)
+                    except (EOFError, ConnectionError):
+                        log.info("RemoteMemory connection %d from %s closed", connection.id, str(connection.peer_address))
+                        self._close(connection)
+        finally:
+            for connection in list(self._connections.values()):
+                self._close(connection)
+            self._selector.close()
+            self._listen_sock.close()
+
+    def _accept(self):
+        try:
+            (sock, peer_address) = self._listen_sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        connection = RemoteMemoryConnection(self._next_connection_id, sock, peer_address)
+        self._next_connection_id += 1
+        self._connections[connection.id] = connection
+        self._selector.register(sock, selectors.EVENT_READ, connection)
+        log.info("RemoteMemory connection %d from %s established", connection.id, str(peer_address))
+
+    def _close(self, connection):
+        del self._connections[connection.id]
+        self._selector.unregister(connection.sock)
+        connection.sock.close()
+
+    def _service(self, connection):
+        try:
+            connection.reader.fill()
+        except BlockingIOError:
+            return
+        if not connection.negotiated:
+            line = connection.reader.peek_line()
+            if line is None:
+                return
+            self._negotiate(connection, line)
+        messages = connection.reader.extract_messages()
+        if messages:
+            connection.idle_since = self._process_messages(connection.wire_format, messages, connection.idle_since,
+                                                           lambda reply: self._send(connection, reply))
+
+    def _negotiate(self, connection, line):
+        """Answer a wire format proposal sent as first record of a connection"""
+        connection.negotiated = True
+        try:
+            record = json.loads(line.decode(encoding = 'ascii'))
+        except ValueError:
+            return
+        if not isinstance(record, dict) or record.get("cmd") != NEGOTIATE_COMMAND:
+            return
+        connection.reader.consume_line()
+        agreed = [x for x in self._wire_formats if x in record.get("wire_formats", [])]
+        agreed = agreed and agreed[0] or "json"
+        self._send(connection, encode_negotiate_reply(agreed))
+        connection.wire_format = WIRE_FORMATS[agreed]
+        connection.reader.set_wire_format(connection.wire_format)
+        log.info("Using %s wire format for RemoteMemory connection %d", agreed, connection.id)
+
+    def _send(self, connection, data):
+        if connection.outgoing:
+            connection.outgoing += data
+            return
+        try:
+            sent = connection.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        if sent < len(data):
+            connection.outgoing += data[sent:]
+            self._selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+
+    def _flush(self, connection):
+        try:
+            sent = connection.sock.send(connection.outgoing)
+        except BlockingIOError:
+            return
+        del connection.outgoing[:sent]
+        if not connection.outgoing:
+            self._selector.modify(connection.sock, selectors.EVENT_READ, connection)
+
+class SharedMemoryRemoteMemoryInterface(RemoteMemoryInterface):
+    """
+    RemoteMemory endpoint for an emulator running on the same host, using
+    a shared-memory ring pair instead of a TCP connection. Avatar creates
+    the ring file, the emulator attaches to it. There is no negotiation,
+    both sides are configured with the same wire format.
+    """
+    def __init__(self, path, wire_format = "binary", capacity = DEFAULT_CAPACITY):
+        super(SharedMemoryRemoteMemoryInterface, self).__init__()
+        assert(wire_format in WIRE_FORMATS)
+        self._path = path
+        self._wire_format = WIRE_FORMATS[wire_format]
+        self._channel = SharedMemoryChannel(path, "avatar", create = True, capacity = capacity)
+        self._thread = threading.Thread(target = self._run)
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get_wire_format(self):
+        return self._wire_format.name
+
+    def _run(self):
+        log.info("Serving RemoteMemory requests on shared memory ring %s", self._path)
+        reader = FramedReader(self._channel, self._wire_format)
+        idle_since = perf_counter_ns()
+        try:
+            while not self._stop.is_set():
+                if not self._channel.wait_readable(1):
+                    continue
+                idle_since = self._process_messages(self._wire_format, reader.read_messages(),
+                                                    idle_since, self._channel.sendall)
+        except (EOFError, BrokenPipeError):
+            log.info("Emulator closed the RemoteMemory ring")
+        self._channel.close()
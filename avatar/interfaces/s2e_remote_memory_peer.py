@@ -0,0 +1,315 @@
+'''
+Local stand-in for the S2E RemoteMemory plugin.
+
+The peer listens like the plugin does, waits for Avatar to connect, answers
+the wire format negotiation and then issues forwarded accesses, so that the
+RemoteMemory interface can be exercised and benchmarked without S2E. It can
+also connect to a RemoteMemory server, like the plugin does in server mode,
+or attach to a shared-memory ring.
+
+Run this module to compare the throughput of the wire formats and transports:
+
+    python3 -m avatar.interfaces.s2e_remote_memory_peer [count]
+'''
+import sys
+import time
+import socket
+import logging
+from select import select
+from avatar.util.ostools import connect_socket, listen_socket, get_socket_address
+from avatar.interfaces.remote_memory_wire import FramedReader, WIRE_FORMATS, \
+    REPLYLESS_COMMANDS, NEGOTIATE_COMMAND, CPU_STATE_REGISTERS, \
+    encode_negotiate_request, encode_negotiate_reply, parse_negotiate_reply
+
+log = logging.getLogger(__name__)
+
+class RemoteMemoryPeer(object):
+    NEGOTIATION_TIMEOUT = 1
+
+    def __init__(self, listen_address = ("127.0.0.1", 0), wire_formats = ["binary", "json"]):
+        """
+        :param listen_address: Address to listen on, a (host, port) tuple or a
+            "unix:/path" string. A free TCP port is picked by default. Pass
+            None for a peer that will connect instead.
+        :param wire_formats: Wire formats the peer agrees to, in order of preference
+        """
+        self._wire_formats = wire_formats
+        self._wire_format = WIRE_FORMATS["json"]
+        self._listen_sock = None
+        self._sock = None
+        self._reader = None
+        if listen_address is not None:
+            self._listen_sock = listen_socket(listen_address, 1)
+
+    def get_address(self):
+        return get_socket_address(self._listen_sock)
+
+    def get_wire_format(self):
+        return self._wire_format.name
+
+    def accept(self):
+        """Wait for Avatar to connect and answer its wire format proposal"""
+        (self._sock, _) = self._listen_sock.accept()
+        self._set_nodelay()
+        self._reader = FramedReader(self._sock, self._wire_format)
+
+        deadline = time.time() + self.NEGOTIATION_TIMEOUT
+        while self._reader.peek_line() is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            (rd, _, _) = select([self._sock], [], [], remaining)
+            if rd:
+                self._reader.fill()
+
+        record = self._reader.extract_messages()[0]
+        if record.get("cmd") != NEGOTIATE_COMMAND:
+            return
+        agreed = [x for x in record["wire_formats"] if x in self._wire_formats]
+        agreed = agreed and agreed[0] or "json"
+        self._sock.sendall(encode_negotiate_reply(agreed))
+        self._wire_format = WIRE_FORMATS[agreed]
+        self._reader.set_wire_format(self._wire_format)
+
+    def _set_nodelay(self):
+        if self._sock.family != socket.AF_UNIX:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connect(self, address):
+        """Connect to a RemoteMemory server and propose the preferred wire format"""
+        self._sock = connect_socket(address)
+        self._set_nodelay()
+        self._reader = FramedReader(self._sock, self._wire_format)
+        if self._wire_formats[0] == "json":
+            return
+
+        self._sock.sendall(encode_negotiate_request(self._wire_formats))
+        while self._reader.peek_line() is None:
+            self._reader.fill()
+        agreed = parse_negotiate_reply(self._reader.peek_line())
+        self._reader.consume_line()
+        if agreed in self._wire_formats:
+            self._wire_format = WIRE_FORMATS[agreed]
+            self._reader.set_wire_format(self._wire_format)
+
+    def attach(self, channel):
+        """
+        Use an already connected channel, e.g., the emulator side of a
+        shared-memory ring. The first configured wire format is used.
+        """
+        self._sock = channel
+        self._wire_format = WIRE_FORMATS[self._wire_formats[0]]
+        self._reader = FramedReader(self._sock, self._wire_format)
+
+    def request(self, cmd, params = None):
+        """Send one request and return the decoded reply"""
+        self._sock.sendall(self._wire_format.encode_request(cmd, params))
+        if cmd in REPLYLESS_COMMANDS:
+            return None
+        messages = self._reader.extract_messages()
+        while not messages:
+            messages = self._reader.read_messages()
+        assert(len(messages) == 1) #Only one request is in flight
+        return self._wire_format.decode_reply(cmd, messages[0])
+
+    def _with_state(self, params, state):
+        if state is not None:
+            params["state"] = state
+        return params
+
+    def read(self, address, size, cpu_state = {}, state = None):
+        return self.request("read", self._with_state({"address": address, "size": size, "cpu_state": cpu_state}, state))
+
+    def write(self, address, size, value, cpu_state = {}, state = None):
+        self.request("write", self._with_state({"address": address, "size": size, "value": value, "cpu_state": cpu_state}, state))
+
+    def batch(self, requests):
+        """
+        Send a list of ("read", params) and ("write", params) requests in one
+        frame and return the list of results
+        """
+        return self.request("batch", {"requests": requests})
+
+    def read_range(self, address, size, file = None, offset = 0, state = None):
+        """
+        Read size bytes at address and return them, or let Avatar store
+        them at offset in file
+        """
+        params = {"address": address, "size": size}
+        if file is not None:
+            params.update({"file": file, "offset": offset})
+        return self.request("read_range", self._with_state(params, state))
+
+    def write_range(self, address, data = None, file = None, offset = 0, size = None, state = None):
+        """Write data, or size bytes found at offset in file, to address"""
+        if file is not None:
+            params = {"address": address, "size": size, "file": file, "offset": offset}
+        else:
+            params = {"address": address, "size": len(data), "data": data}
+        self.request("write_range", self._with_state(params, state))
+
+    def fork_state(self, state, child):
+        self.request("fork_state", {"state": state, "child": child})
+
+    def kill_state(self, state):
+        self.request("kill_state", {"state": state})
+
+    def get_cpu_state(self):
+        return self.request("get_cpu_state")
+
+    def set_cpu_state(self, cpu_state):
+        self.request("set_cpu_state", {"cpu_state": cpu_state})
+
+    def cont(self, state = None):
+        self.request("continue", self._with_state({}, state))
+
+    def get_checksum(self, address, size):
+        return self.request("get_checksum", {"address": address, "size": size})
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+        if self._listen_sock:
+            self._listen_sock.close()
+
+def _run_accesses(peer, count):
+    """Issue count forwarded writes and reads and return the number of accesses per second"""
+    cpu_state = dict((reg, 0x1000 + i) for (i, reg) in enumerate(CPU_STATE_REGISTERS))
+    start = time.time()
+    for i in range(count):
+        peer.write(0x20000000 + 4 * i, 4, i, cpu_state)
+        assert(peer.read(0x20000000 + 4 * i, 4, cpu_state) == i)
+    return 2 * count / (time.time() - start)
+
+def _set_memory_handlers(interface):
+    memory = {}
+    interface.set_read_handler(lambda params: memory.get(params["address"], 0))
+    interface.set_write_handler(lambda params: memory.__setitem__(params["address"], params["value"]))
+
+def _create_ring_interface(wire_format):
+    """Return a SharedMemoryRemoteMemoryInterface on a ring file in a new temporary directory"""
+    import tempfile
+    import os
+    from avatar.interfaces.s2e_remote_memory import SharedMemoryRemoteMemoryInterface
+
+    path = os.path.join(tempfile.mkdtemp(), "remote_memory.ring")
+    interface = SharedMemoryRemoteMemoryInterface(path, wire_format)
+    _set_memory_handlers(interface)
+    return (interface, path)
+
+def _remove_ring(path):
+    import os
+
+    directory = os.path.dirname(path)
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+    os.rmdir(directory)
+
+def benchmark(wire_format, count):
+    """
+    Run count forwarded reads and writes against a RemoteMemory interface
+    with trivial handlers and return the number of accesses per second.
+    """
+    from avatar.interfaces.s2e_remote_memory import S2ERemoteMemoryInterface
+
+    peer = RemoteMemoryPeer(wire_formats = [wire_format])
+    interface = S2ERemoteMemoryInterface(peer.get_address(), wire_format)
+    _set_memory_handlers(interface)
+    interface.start()
+    peer.accept()
+    assert(peer.get_wire_format() == wire_format)
+
+    rate = _run_accesses(peer, count)
+    interface.stop()
+    peer.close()
+    return rate
+
+def benchmark_shm(wire_format, count):
+    """
+    Like benchmark(), but over a shared-memory ring. Both ends run in this
+    process, so they compete for the interpreter lock; see
+    benchmark_process() for the setup of a real emulator.
+    """
+    from avatar.interfaces.shm_ring import SharedMemoryChannel
+
+    (interface, path) = _create_ring_interface(wire_format)
+    interface.start()
+    peer = RemoteMemoryPeer(None, [wire_format])
+    peer.attach(SharedMemoryChannel(path, "emulator"))
+
+    rate = _run_accesses(peer, count)
+    peer.close()
+    interface.stop()
+    _remove_ring(path)
+    return rate
+
+def _run_peer_process(transport, path, wire_format, count, results):
+    if transport == "ring":
+        from avatar.interfaces.shm_ring import SharedMemoryChannel
+
+        peer = RemoteMemoryPeer(None, [wire_format])
+        peer.attach(SharedMemoryChannel(path, "emulator"))
+    else:
+        peer = RemoteMemoryPeer(wire_formats = [wire_format])
+        results.put(peer.get_address())
+        peer.accept()
+    results.put(_run_accesses(peer, count))
+    peer.close()
+
+def benchmark_process(transport, wire_format, count):
+    """
+    Like benchmark() ("socket") and benchmark_shm() ("ring"), but the peer
+    runs in a separate process, as S2E does.
+    """
+    import multiprocessing
+    from avatar.interfaces.s2e_remote_memory import S2ERemoteMemoryInterface
+
+    results = multiprocessing.Queue()
+    path = None
+    if transport == "ring":
+        (interface, path) = _create_ring_interface(wire_format)
+    process = multiprocessing.Process(target = _run_peer_process, args = (transport, path, wire_format, count, results))
+    process.start()
+    if transport != "ring":
+        interface = S2ERemoteMemoryInterface(results.get(), wire_format)
+        _set_memory_handlers(interface)
+    interface.start()
+
+    rate = results.get()
+    process.join()
+    interface.stop()
+    if path is not None:
+        _remove_ring(path)
+    return rate
+
+def benchmark_codec(wire_format, count):
+    """Return the encode/decode cost in microseconds of one read request/reply pair"""
+    fmt = WIRE_FORMATS[wire_format]
+    cpu_state = dict((reg, 0x1000 + i) for (i, reg) in enumerate(CPU_STATE_REGISTERS))
+    request = fmt.encode_request("read", {"address": 0x20000000, "size": 4, "cpu_state": cpu_state})
+    reply = fmt.encode_reply("read", 0x12345678)
+
+    start = time.time()
+    for i in range(count):
+        fmt.decode_request(fmt.extract_messages(request)[0][0])
+        fmt.encode_reply("read", 0x12345678)
+    avatar_side = time.time() - start
+    start = time.time()
+    for i in range(count):
+        fmt.encode_request("read", {"address": 0x20000000, "size": 4, "cpu_state": cpu_state})
+        fmt.decode_reply("read", fmt.extract_messages(reply)[0][0])
+    peer_side = time.time() - start
+    return (avatar_side * 1e6 / count, peer_side * 1e6 / count)
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.WARNING)
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+    for wire_format in ["json", "binary"]:
+        (avatar_side, peer_side) = benchmark_codec(wire_format, count)
+        print("%-6s codec: %6.2f us/access in Avatar, %6.2f us/access in peer" % (wire_format, avatar_side, peer_side))
+    for wire_format in ["json", "binary"]:
+        print("%-6s link:  %8.0f accesses/s" % (wire_format, benchmark(wire_format, count)))
+    for wire_format in ["json", "binary"]:
+        print("%-6s ring:  %8.0f accesses/s" % (wire_format, benchmark_shm(wire_format, count)))
+    for transport in ["socket", "ring"]:
+        print("binary %-6s in a separate process: %8.0f accesses/s" % (transport, benchmark_process(transport, "binary", count)))
@@ -0,0 +1,254 @@
+'''
+Shared-memory transport for the RemoteMemory channel.
+
+Both processes map the same file, which holds a pair of lock-free
+single-producer/single-consumer byte rings: one carries requests from the
+emulator to Avatar, the other carries replies back. Positions are free
+running 64 bit counters, so a ring is empty when head == tail and full when
+tail - head == capacity.
+
+A consumer spins for a short while before going to sleep. Before sleeping it
+raises its "waiting" flag, and a producer only writes a wakeup byte to the
+consumer's FIFO when that flag is set. Consumers sleep with a timeout, so a
+wakeup lost to store/load reordering only costs latency.
+
+SharedMemoryChannel behaves like a connected socket (recv_into, sendall,
+fileno, close), so the framing and wire formats of the socket transport are
+used unchanged.
+'''
+import os
+import mmap
+import time
+import errno
+import struct
+import select
+
+#File header: magic, version, capacity of each ring
+HEADER = struct.Struct("<8sII")
+MAGIC = b"AVTRRING"
+VERSION = 1
+#Ring control block: head and tail (u64), consumer waiting and closed flags
+#(u32). Blocks are 64 bytes apart so that rings do not share a cache line.
+CONTROL_SIZE = 64
+POSITION = struct.Struct("<Q")
+#Head and tail, read together
+POSITIONS = struct.Struct("<QQ")
+FLAG = struct.Struct("<I")
+
+HEAD_OFFSET = 0
+TAIL_OFFSET = 8
+WAITING_OFFSET = 16
+CLOSED_OFFSET = 20
+
+#Ring carrying data from the emulator to Avatar, and back
+EMULATOR_TO_AVATAR = 0
+AVATAR_TO_EMULATOR = 1
+
+DEFAULT_CAPACITY = 1 << 20
+
+class SharedMemoryRing(object):
+    """One single-producer/single-consumer byte ring inside a mapping"""
+    def __init__(self, mapping, control_offset, data_offset, capacity):
+        assert(capacity & (capacity - 1) == 0) #Capacity must be a power of two
+        self._map = mapping
+        self._control = control_offset
+        self._data = data_offset
+        self._capacity = capacity
+        self._mask = capacity - 1
+
+    def _get(self, offset):
+        return POSITION.unpack_from(self._map, self._control + offset)[0]
+
+    def _set(self, offset, value):
+        POSITION.pack_into(self._map, self._control + offset, value)
+
+    def available(self):
+        """Return the number of bytes that can be read"""
+        (head, tail) = POSITIONS.unpack_from(self._map, self._control)
+        return tail - head
+
+    def write(self, data):
+        """Copy as much of data as fits into the ring and return the number of bytes written"""
+        (head, tail) = POSITIONS.unpack_from(self._map, self._control)
+        length = min(len(data), self._capacity - (tail - head))
+        if length <= 0:
+            return 0
+        start = tail & self._mask
+        first = min(length, self._capacity - start)
+        self._map[self._data + start:self._data + start + first] = data[:first]
+        if first < length:
+            self._map[self._data:self._data + length - first] = data[first:length]
+        #Publish only after the data is in place
+        self._set(TAIL_OFFSET, tail + length)
+        return length
+
+    def read_into(self, buffer):
+        """Copy available data into buffer and return the number of bytes read"""
+        (head, tail) = POSITIONS.unpack_from(self._map, self._control)
+        length = min(len(buffer), tail - head)
+        if length <= 0:
+            return 0
+        start = head & self._mask
+        first = min(length, self._capacity - start)
+        buffer[:first] = self._map[self._data + start:self._data + start + first]
+        if first < length:
+            buffer[first:length] = self._map[self._data:self._data + length - first]
+        self._set(HEAD_OFFSET, head + length)
+        return length
+
+    def is_consumer_waiting(self):
+        return FLAG.unpack_from(self._map, self._control + WAITING_OFFSET)[0] != 0
+
+    def set_consumer_waiting(self, waiting):
+        FLAG.pack_into(self._map, self._control + WAITING_OFFSET, waiting and 1 or 0)
+
+    def is_closed(self):
+        return FLAG.unpack_from(self._map, self._control + CLOSED_OFFSET)[0] != 0
+
+    def close(self):
+        FLAG.pack_into(self._map, self._control + CLOSED_OFFSET, 1)
+
+class SharedMemoryChannel(object):
+    """
+    Socket-like endpoint of a shared-memory ring pair.
+
+    Avatar creates the ring file and the two wakeup FIFOs (<path>.e2a and
+    <path>.a2e), the emulator side attaches to them.
+    """
+    #Spinning only helps when the peer can run at the same time
+    SPIN_ITERATIONS = (os.cpu_count() or 1) > 1 and 200 or 0
+    SLEEP_TIMEOUT = 0.01
+
+    def __init__(self, path, side = "avatar", create = False, capacity = DEFAULT_CAPACITY):
+        """
+        :param path: Path of the ring file
+        :param side: "avatar" or "emulator"
+        :param create: Create (or truncate) the ring file and FIFOs
+        :param capacity: Size of each ring in bytes, used when creating
+        """
+        assert(side in ["avatar", "emulator"])
+        self._path = path
+        if create:
+            self._create(path, capacity)
+
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        (magic, version, capacity) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a RemoteMemory ring file" % path)
+
+        rings = [SharedMemoryRing(self._map,
+                                  CONTROL_SIZE * (1 + i),
+                                  CONTROL_SIZE * 3 + capacity * i,
+                                  capacity) for i in range(2)]
+        fifos = [path + ".e2a", path + ".a2e"]
+        (rx, tx) = side == "avatar" and (EMULATOR_TO_AVATAR, AVATAR_TO_EMULATOR) \
+                                    or (AVATAR_TO_EMULATOR, EMULATOR_TO_AVATAR)
+        (self._rx, self._tx) = (rings[rx], rings[tx])
+        (rx_fifo, tx_fifo) = (fifos[rx], fifos[tx])
+        #O_RDWR keeps the open from blocking until the other side shows up
+        self._rx_wakeup = os.open(rx_fifo, os.O_RDWR | os.O_NONBLOCK)
+        self._tx_wakeup = os.open(tx_fifo, os.O_RDWR | os.O_NONBLOCK)
+        self._poll = select.poll()
+        self._poll.register(self._rx_wakeup, select.POLLIN)
+        self._closed = False
+
+    @staticmethod
+    def _create(path, capacity):
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, capacity))
+            f.truncate(CONTROL_SIZE * 3 + 2 * capacity)
+        for fifo in [path + ".e2a", path + ".a2e"]:
+            if os.path.exists(fifo):
+                os.unlink(fifo)
+            os.mkfifo(fifo)
+
+    def fileno(self):
+        return self._rx_wakeup
+
+    def wait_readable(self, timeout = None):
+        """
+        Wait until data can be read or the peer closed the channel.
+        Returns False if the timeout expired first.
+        """
+        rx = self._rx
+        for i in range(self.SPIN_ITERATIONS):
+            if rx.available() or rx.is_closed():
+                return True
+
+        deadline = timeout is not None and time.time() + timeout or None
+        while True:
+            rx.set_consumer_waiting(True)
+            if rx.available() or rx.is_closed():
+                rx.set_consumer_waiting(False)
+                return True
+            sleep = self.SLEEP_TIMEOUT
+            if deadline is not None:
+                sleep = min(sleep, deadline - time.time())
+                if sleep <= 0:
+                    rx.set_consumer_waiting(False)
+                    return False
+            events = self._poll.poll(sleep * 1000)
+            rx.set_consumer_waiting(False)
+            if events:
+                self._drain_wakeups()
+                if rx.available():
+                    return True
+
+    def _drain_wakeups(self):
+        #One read takes all wakeup bytes written so far. One that arrives
+        #later only causes a spurious wakeup, this saves a failing read on
+        #every wakeup.
+        try:
+            os.read(self._rx_wakeup, 4096)
+        except BlockingIOError:
+            pass
+
+    def recv_into(self, buffer):
+        """Block until data is available and copy it into buffer, returns 0 once the peer closed the channel"""
+        while True:
+            received = self._rx.read_into(buffer)
+            if received:
+                return received
+            if self._rx.is_closed():
+                return 0
+            self.wait_readable()
+
+    def sendall(self, data):
+        data = memoryview(data)
+        while data:
+            written = self._tx.write(data)
+            if written:
+                data = data[written:]
+                self._wakeup()
+            else:
+                if self._tx.is_closed():
+                    raise BrokenPipeError(errno.EPIPE, "RemoteMemory ring closed")
+                #Ring full, give the consumer time to catch up
+                self._wakeup()
+                time.sleep(0)
+
+    def _wakeup(self):
+        if self._tx.is_consumer_waiting():
+            try:
+                os.write(self._tx_wakeup, b"\0")
+            except BlockingIOError:
+                #FIFO full, the consumer has wakeups pending anyway
+                pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._tx.close()
+        self._rx.close()
+        try:
+            os.write(self._tx_wakeup, b"\0")
+        except BlockingIOError:
+            pass
+        os.close(self._rx_wakeup)
+        os.close(self._tx_wakeup)
+        self._map.close()
@@ -4,6 +4,7 @@ from avatar.plugins.avatar_plugin import AvatarPlugin
 from avatar.system import EVENT_REQUEST_WRITE_MEMORY_VALUE,\
     EVENT_REQUEST_READ_MEMORY_VALUE
 from functools import reduce
+from avatar.util.cpu_state import to_cpu_state
 
 
 log = logging.getLogger(__name__)
@@ -149,20 +150,22 @@ class MemoryRangeIdentifier(AvatarPlugin):
             memory_access = False
             if EVENT_REQUEST_WRITE_MEMORY_VALUE in evt["tags"]:
                 memory_access = True
-                self._add_memory_write_access(int(evt["properties"]["cpu_state"]["cpsr"], 16),
+                cpu_state = to_cpu_state(evt["properties"]["cpu_state"])
+                cpsr = cpu_state.get_value("cpsr")
+                self._add_memory_write_access(cpsr,
                                               evt["properties"]["address"],
                                               evt["properties"]["size"],
                                               evt["properties"]["value"],
                                               )
             elif EVENT_REQUEST_READ_MEMORY_VALUE in evt["tags"]:
-                self._add_memory_read_access(int(evt["properties"]["cpu_state"]["cpsr"], 16),
+                cpu_state = to_cpu_state(evt["properties"]["cpu_state"])
+                cpsr = cpu_state.get_value("cpsr")
+                self._add_memory_read_access(cpsr,
                                              evt["properties"]["address"],
                                              evt["properties"]["size"],
                                              )
                 memory_access = True
             if (memory_access):
-                self._add_stack_pointer_value(int(evt["properties"]["cpu_state"]["r13"], 16),
-                                              int(evt["properties"]["cpu_state"]["cpsr"], 16))
-                self._add_program_counter_value(int(evt["properties"]["cpu_state"]["pc"], 16),
-                                                int(evt["properties"]["cpu_state"]["cpsr"], 16))
+                self._add_stack_pointer_value(cpu_state.get_value("r13"), cpsr)
+                self._add_program_counter_value(cpu_state.get_value("pc"), cpsr)
         
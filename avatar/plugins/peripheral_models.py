@@ -0,0 +1,166 @@
+import logging
+import time
+from avatar.plugins.avatar_plugin import AvatarPlugin
+
+log = logging.getLogger(__name__)
+
+class PeripheralModel(object):
+    """
+    Host-side model of (some registers of) a peripheral at an address range.
+    The call proxy consults the models before forwarding an access to the
+    target. read() returns the value of a register, or None to let the read
+    fall through to the target; write() returns True if the model handled
+    the write, which then only reaches the target if write_through is set.
+    Offsets are relative to the start of the range.
+    """
+    write_through = False
+
+    def __init__(self, address, size, name = None):
+        self.address = address
+        self.size = size
+        self.name = name is None and "%s@0x%08x" % (self.__class__.__name__, address) or name
+        self.reads = 0
+        self.writes = 0
+        self.read_fallthroughs = 0
+        self.write_fallthroughs = 0
+
+    def read(self, offset, size):
+        return None
+
+    def write(self, offset, size, value):
+        return False
+
+    def handle_read(self, address, size):
+        """Called by the call proxy, returns the value or None"""
+        offset = address - self.address
+        value = None
+        if offset >= 0 and offset + size <= self.size:
+            value = self.read(offset, size)
+        if value is None:
+            self.read_fallthroughs += 1
+        else:
+            self.reads += 1
+        return value
+
+    def handle_write(self, address, size, value):
+        """Called by the call proxy, returns True if the model handled the write"""
+        offset = address - self.address
+        handled = offset >= 0 and offset + size <= self.size and self.write(offset, size, value)
+        if handled:
+            self.writes += 1
+        else:
+            self.write_fallthroughs += 1
+        return handled
+
+    def get_statistics(self):
+        return {"address": self.address,
+                "size": self.size,
+                "reads": self.reads,
+                "writes": self.writes,
+                "read_fallthroughs": self.read_fallthroughs,
+                "write_fallthroughs": self.write_fallthroughs}
+
+class ConstantRegisters(PeripheralModel):
+    """Registers that always read the same value, e.g., ID registers"""
+    def __init__(self, address, size, registers, name = None):
+        """
+        :param registers: Dict of register offset to value; other offsets
+            fall through to the target
+        """
+        super(ConstantRegisters, self).__init__(address, size, name)
+        self._registers = dict(registers)
+
+    def read(self, offset, size):
+        return self._registers.get(offset)
+
+class FreeRunningTimer(PeripheralModel):
+    """
+    Up-counting timer register that runs at frequency Hz of host time,
+    wrapping at width bits. Writes to the counter set its value.
+    """
+    def __init__(self, address, size, counter_offset = 0, frequency = 1000000, width = 32, name = None):
+        super(FreeRunningTimer, self).__init__(address, size, name)
+        self._counter_offset = counter_offset
+        self._frequency = frequency
+        self._mask = (1 << width) - 1
+        self._start = time.monotonic()
+        self._start_value = 0
+
+    def read(self, offset, size):
+        if offset != self._counter_offset:
+            return None
+        ticks = int((time.monotonic() - self._start) * self._frequency)
+        return (self._start_value + ticks) & self._mask
+
+    def write(self, offset, size, value):
+        if offset != self._counter_offset:
+            return False
+        self._start = time.monotonic()
+        self._start_value = value & self._mask
+        return True
+
+class Uart(PeripheralModel):
+    """
+    Transmit side of a UART: the status register always reports the
+    transmitter ready, bytes written to the data register are collected
+    (and sent to the target as well with write_through).
+    """
+    def __init__(self, address, size, status_offset, data_offset, ready_value, write_through = False, name = None):
+        super(Uart, self).__init__(address, size, name)
+        self._status_offset = status_offset
+        self._data_offset = data_offset
+        self._ready_value = ready_value
+        self.write_through = write_through
+        self.output = bytearray()
+        self._line = bytearray()
+
+    def read(self, offset, size):
+        return self._ready_value if offset == self._status_offset else None
+
+    def write(self, offset, size, value):
+        if offset != self._data_offset:
+            return False
+        self.output.append(value & 0xFF)
+        if value & 0xFF == ord("\n"):
+            log.info("%s: %s", self.name, self._line.decode("ascii", "replace"))
+            self._line = bytearray()
+        else:
+            self._line.append(value & 0xFF)
+        return True
+
+class PeripheralModels(AvatarPlugin):
+    """
+    A plugin to answer accesses to selected IO registers from Python models
+    on the host instead of the target
+    """
+
+    def __init__(self, system, models = []):
+        super().__init__(system)
+        self._models = list(models)
+        self._started = False
+
+    def init(self, **kwargs):
+        """ Add the models given as "models" """
+        for model in kwargs.get("models", []):
+            self.add_model(model)
+
+    def start(self, **kwargs):
+        """ Let the call proxy consult the models """
+        for model in self._models:
+            self._system.add_peripheral_model(model)
+        self._started = True
+
+    def stop(self, **kwargs):
+        """ Forward all accesses to the target again """
+        for model in self._models:
+            self._system.remove_peripheral_model(model)
+        self._started = False
+
+    def add_model(self, model):
+        self._models.append(model)
+        if self._started:
+            self._system.add_peripheral_model(model)
+
+    def get_statistics(self):
+        """ Return the access counters of all models by name """
+        return dict((model.name, model.get_statistics()) for model in self._models)
@@ -18,6 +18,8 @@ import sys
 import os
 from avatar.util.ostools import mkdir_p
 from avatar.call_proxy import EmulatorTargetCallProxy
+from avatar.forwarding.policy import get_remote_memory_ranges
+from avatar.forwarding.ram_sync import RamSync
 from queue import Empty, Queue
 
 
@@ -36,6 +38,8 @@ EVENT_REQUEST_READ_MEMORY_VALUE = "EVENT_REQUEST_READ_MEMORY_VALUE"
 EVENT_REQUEST_WRITE_MEMORY_VALUE = "EVENT_REQUEST_WRITE_MEMORY_VALUE"
 EVENT_RESPONSE_READ_MEMORY_VALUE = "EVENT_RESPONSE_READ_MEMORY_VALUE"
 EVENT_RESPONSE_WRITE_MEMORY_VALUE = "EVENT_RESPONSE_WRITE_MEMORY_VALUE"
+EVENT_REQUEST_READ_MEMORY_RANGE = "EVENT_REQUEST_READ_MEMORY_RANGE"
+EVENT_REQUEST_WRITE_MEMORY_RANGE = "EVENT_REQUEST_WRITE_MEMORY_RANGE"
 EVENT_SIGABRT = "EVENT_SIGABRT"
 
 class EventWaiter():
@@ -58,7 +62,15 @@ class System():
         self._configuration = configuration
         self._plugins = []
         self._terminating = Event()
-        self._call_proxy = EmulatorTargetCallProxy()
+        avatar_configuration = "avatar_configuration" in configuration and configuration["avatar_configuration"] or {}
+        call_proxy_configuration = dict(avatar_configuration.get("call_proxy", {}))
+        if not "endianness" in call_proxy_configuration and "machine_configuration" in configuration:
+            call_proxy_configuration["endianness"] = configuration["machine_configuration"].get("endianness", "little")
+        if not "memory_ranges" in call_proxy_configuration:
+            call_proxy_configuration["memory_ranges"] = get_remote_memory_ranges(configuration)
+        self._call_proxy = EmulatorTargetCallProxy(call_proxy_configuration)
+        ram_sync_configuration = avatar_configuration.get("ram_sync", {})
+        self._ram_sync = RamSync(ram_sync_configuration.get("ranges", []), ram_sync_configuration.get("block_size", 0x400))
         self._emulator = None
         self._target = None
         self._listeners = []
@@ -117,6 +129,10 @@ class System():
         self._emulator.set_get_cpu_state_request_handler(self._call_proxy.handle_emulator_get_cpu_state_request)
         self._emulator.set_continue_request_handler(self._call_proxy.handle_emulator_continue_request)
         self._emulator.set_get_checksum_request_handler(self._call_proxy.handle_emulator_get_checksum_request)
+        self._emulator.set_read_range_request_handler(self._call_proxy.handle_emulator_read_range_request)
+        self._emulator.set_write_range_request_handler(self._call_proxy.handle_emulator_write_range_request)
+        self._emulator.set_fork_state_request_handler(self._call_proxy.handle_emulator_fork_state_request)
+        self._emulator.set_kill_state_request_handler(self._call_proxy.handle_emulator_kill_state_request)
         self._call_proxy.set_target(self._target)
         
         self._target.start()
@@ -126,9 +142,9 @@ class System():
     def stop(self):
         if not self._terminating.is_set():
             self._terminating.set()
+            self._call_proxy.stop()
             self._emulator.stop()
             self._target.stop()
-            self._call_proxy.stop_monitors()
         
     def set_emulator(self, emulator):
         """This method is supposed to be called by the emulator init function
@@ -148,12 +164,45 @@ class System():
     def get_target(self):
         return self._target
         
-    def add_monitor(self, monitor):
-        self._call_proxy.add_monitor(monitor)
+    def add_monitor(self, monitor, ranges = None):
+        self._call_proxy.add_monitor(monitor, ranges)
+
+    def add_peripheral_model(self, model):
+        self._call_proxy.add_peripheral_model(model)
+
+    def remove_peripheral_model(self, model):
+        self._call_proxy.remove_peripheral_model(model)
+
+    def mark_checkpoint(self):
+        return self._call_proxy.mark_checkpoint()
+
+    def rollback(self, checkpoint):
+        return self._call_proxy.rollback(checkpoint)
+
+    def synchronize_memory(self, to_target = True, ranges = None):
+        """
+        Copy the RAM blocks that differ between emulator and target, in the
+        "ram_sync" ranges of the Avatar configuration or the {"address",
+        "size"} ranges given. Returns the number of bytes copied.
+        """
+        #Posted writes have to reach the target before it is compared
+        self._call_proxy.flush_writes()
+        if to_target:
+            #Through the call proxy, so that the writes are journaled and mirrored
+            copied = self._ram_sync.synchronize(self._emulator, self._target, ranges, self._call_proxy.write_memory)
+        else:
+            copied = self._ram_sync.synchronize(self._target, self._emulator, ranges)
+        return copied
+
+    def get_ram_sync(self):
+        return self._ram_sync
         
     def post_event(self, evt):
         if not "properties" in evt:
             evt["properties"] = {}
+        if evt.get("source") == "target":
+            #Not through a listener, these run later on the event thread
+            self._call_proxy.handle_target_event(evt)
         self._events.put(evt)
         
     def register_event_listener(self, listener):
@@ -34,6 +34,11 @@ ARM_REGISTER_NAMES = {"r0": 0,
                       "pc": 15,
                       "cpsr": 16}
 
+def _get_register_number(name):
+    if isinstance(name, str):
+        return ARM_REGISTER_NAMES[name.lower()]
+    return name
+
 class AvatarBreakpoint(Breakpoint):
     def __init__(self, system, address):
         super().__init__()
@@ -89,18 +94,18 @@ class AvatarstubTarget(Target):
         return self._avatar_connection.read_memory(address, size)
             
     def read_untyped_memory(self, address, length):
-        return self._avatar_connection.read_memory_untyped(address, length)
+        #The stub moves at most 255 bytes per message
+        data = bytearray()
+        while len(data) < length:
+            data += self._avatar_connection.read_memory_untyped(address + len(data), min(length - len(data), 255))
+        return bytes(data)
     
     def write_typed_memory(self, address, size, value):
         self._avatar_connection.write_memory(address, size, value)
         
     def write_untyped_memory(self, address, data):
-        chunk_address = address
-        remaining_size = len(data)
-        while remaining_size > 0:
-            self._avatar_connection.write_memory_untyped(address, data[address:address + 255])
-            chunk_address += 255
-            remaining_size -= 255
+        for offset in range(0, len(data), 255):
+            self._avatar_connection.write_memory_untyped(address + offset, bytes(data[offset:offset + 255]))
             
     def get_register(self, name):
         if isinstance(name, str):
@@ -112,6 +117,14 @@ class AvatarstubTarget(Target):
             name = ARM_REGISTER_NAMES[name.lower()]
         self._avatar_connection.set_register(name, value)
         
+    def get_registers(self, names):
+        numbers = [_get_register_number(x) for x in names]
+        return dict(zip(names, self._avatar_connection.get_registers(numbers)))
+
+    def set_registers(self, values):
+        self._avatar_connection.set_registers([(_get_register_number(name), value)
+                                               for (name, value) in values.items()])
+        
     def install_codelet(self, address, codelet):
         self.write_untyped_memory(address, codelet)
         
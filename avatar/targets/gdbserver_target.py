@@ -9,6 +9,7 @@ from avatar.bintools.gdb.gdb_debugger import GdbDebugger
 from avatar.system import EVENT_RUNNING, EVENT_STOPPED, EVENT_BREAKPOINT, EVENT_SIGABRT
 from avatar.bintools.gdb.mi_parser import Async
 from avatar.debuggable import Breakpoint
+from avatar.util.ostools import is_unix_address, format_address
 from queue import Queue
 
 log = logging.getLogger(__name__)
@@ -55,7 +56,8 @@ class GdbserverTarget(Target):
         conf = self._system.get_configuration()
         assert("avatar_configuration" in conf)
         assert("target_gdb_address" in conf["avatar_configuration"])
-        assert(conf["avatar_configuration"]["target_gdb_address"].startswith("tcp:"))
+        assert(conf["avatar_configuration"]["target_gdb_address"].startswith("tcp:") or
+               is_unix_address(conf["avatar_configuration"]["target_gdb_address"]))
         sockaddr_str = conf["avatar_configuration"]["target_gdb_address"][4:]
         if "target_gdb_path" in conf["avatar_configuration"]:
                 self.gdb_exec= conf["avatar_configuration"]["target_gdb_path"]
@@ -66,15 +68,21 @@ class GdbserverTarget(Target):
             self.additional_args = conf["avatar_configuration"]["target_gdb_additional_arguments"]
         else:
             self.additional_args = []
-        self._sockaddress = (sockaddr_str[:sockaddr_str.rfind(":")],
-                             int(sockaddr_str[sockaddr_str.rfind(":") + 1:]))
+        if is_unix_address(conf["avatar_configuration"]["target_gdb_address"]):
+            self._sockaddress = conf["avatar_configuration"]["target_gdb_address"]
+        else:
+            self._sockaddress = (sockaddr_str[:sockaddr_str.rfind(":")],
+                                 int(sockaddr_str[sockaddr_str.rfind(":") + 1:]))
         
     def start(self):
         #TODO: Handle timeout
-        if self._verbose: log.info("Trying to connect to target gdb server at %s:%d", self._sockaddress[0], self._sockaddress[1])
+        if self._verbose: log.info("Trying to connect to target gdb server at %s", format_address(self._sockaddress))
         self._gdb_interface = GdbDebugger(gdb_executable = self.gdb_exec, cwd = ".", additional_args = self.additional_args )
         self._gdb_interface.set_async_message_handler(self.handle_gdb_async_message)
-        self._gdb_interface.connect(("tcp", self._sockaddress[0], "%d" % self._sockaddress[1]))
+        if is_unix_address(self._sockaddress):
+            self._gdb_interface.connect(("unix", self._sockaddress[len("unix:"):]))
+        else:
+            self._gdb_interface.connect(("tcp", self._sockaddress[0], "%d" % self._sockaddress[1]))
         
     def write_typed_memory(self, address, size, data):
         self._gdb_interface.write_memory(address, size, data)
@@ -82,12 +90,24 @@ class GdbserverTarget(Target):
     def read_typed_memory(self, address, size):
         return self._gdb_interface.read_memory(address, size)
 
+    def read_untyped_memory(self, address, length):
+        return self._gdb_interface.read_untyped_memory(address, length)
+
+    def write_untyped_memory(self, address, data):
+        self._gdb_interface.write_untyped_memory(address, data)
+
     def set_register(self, reg, val):
         self._gdb_interface.set_register(reg, val)
 
     def get_register(self, reg):
         return self._gdb_interface.get_register(reg)
 
+    def get_registers(self, regs):
+        return self._gdb_interface.get_registers(regs)
+
+    def set_registers(self, values):
+        self._gdb_interface.set_registers(values)
+
     def get_register_from_nr(self, num):
         try:
             return self.get_register(["r0", "r1", "r2", "r3", "r4", "r5",
@@ -101,6 +121,9 @@ class GdbserverTarget(Target):
         return self._gdb_interface.execute_gdb_command(cmd)
     def get_checksum(self, addr, size):
         return self._gdb_interface.get_checksum(addr, size)
+
+    def has_remote_checksum(self):
+        return self._gdb_interface.has_remote_checksum()
         
     def stop(self):
         pass
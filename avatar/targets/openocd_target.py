@@ -2,6 +2,7 @@ from avatar.targets.target import Target
 import socket
 import logging
 import telnetlib
+import re
 
 log = logging.getLogger(__name__)
 
@@ -11,6 +12,12 @@ ARM_REGISTERS = ["r0", "r1","r2","r3","r4","r5","r6","r7","r8","r9","r10","r11",
                   "r10_fiq","r11_fiq","r12_fiq","sp_fiq","lr_fiq","spsr_fiq",
                   "sp_svc","lr_svc","spsr_svc","sp_abt","lr_abt","spsr_abt",
                   "sp_irq","lr_irq","spsr_irq","sp_und","lr_und","spsr_und"]
+#Registers that OpenOCD names by mode, e.g., sp_svc, and the mode bits of cpsr
+BANKED_REGISTERS = ["sp", "lr"]
+MODE_BANKS = {0x10: "usr", 0x11: "fiq", 0x12: "irq", 0x13: "svc", 0x17: "abt", 0x1b: "und", 0x1f: "usr"}
+#Output of the reg command, e.g., "r0 (/32): 0x00000000"
+REGISTER_VALUE = re.compile(r"(%s) \(/\d+\): (0x[0-9a-fA-F]+)" %
+                            "|".join(sorted(ARM_REGISTERS, key = len, reverse = True)))
 
 # Decorator for methods requiring target Stop&Start
 def paused(fn):
@@ -18,10 +25,11 @@ def paused(fn):
     def wrapped(self, opt=None):
         self.halt()
         if opt:
-          fn(self, opt)
+          result = fn(self, opt)
         else:
-          fn(self)
+          result = fn(self)
         self.cont()
+        return result
     return wrapped
 
 # Decorator for methods requiring target Hard Stop
@@ -186,6 +194,57 @@ class OpenocdTarget(Target):
 ## Halted methods
 ###################################################################
 
+    @halted
+    def get_registers(self, regnames : "list of str") -> "dict{str: int}":
+        """
+        Halt the target and read several registers with one command line,
+        whose Tcl result lists all of them
+        :param regnames: register names (allowed values within ARM_REGISTERS,
+            and sp and lr for the banked registers of the current mode)
+        :type regnames: list of str
+        :return: dict of regname->value
+        :rtype: dict of str->int
+        :raises Exception: if the output lacks a requested register
+        """
+        banked = [x for x in regnames if x in BANKED_REGISTERS]
+        query = [x for x in regnames if not x in BANKED_REGISTERS]
+        if banked:
+            #The mode is not known yet, read the registers of all banks
+            query += ["cpsr"] + ["%s_%s" % (x, y) for x in banked for y in sorted(set(MODE_BANKS.values()))]
+        for regname in query:
+            assert(regname in ARM_REGISTERS)
+        out = self.raw_cmd("list " + " ".join(["[reg %s]" % x for x in query]), False)
+        values = dict(REGISTER_VALUE.findall(out))
+        if banked and "cpsr" in values:
+            for regname in banked:
+                banked_name = self._banked_register(regname, int(values["cpsr"], 16))
+                if banked_name in values:
+                    values[regname] = values[banked_name]
+        missing = [x for x in regnames if not x in values]
+        if missing:
+            raise Exception("Could not read registers %s from OpenOCD output: %s" % (", ".join(missing), out.strip()))
+        return dict((x, int(values[x], 16)) for x in regnames)
+
+    @halted
+    def set_registers(self, values : "dict{str: int}"):
+        """
+        Halt the target and write several registers with one command line
+        :param values: dict of regname->value, sp and lr are the banked
+            registers of the current mode
+        :type values: dict of str->int
+        """
+        if any(x in BANKED_REGISTERS for x in values):
+            cpsr = int(self.get_raw_register("cpsr"), 16)
+            values = dict((x in BANKED_REGISTERS and self._banked_register(x, cpsr) or x, y) for (x, y) in values.items())
+        for regname in values:
+            assert(regname in ARM_REGISTERS)
+        self.raw_cmd("; ".join(["reg %s 0x%x" % x for x in values.items()]), False)
+
+    @staticmethod
+    def _banked_register(regname, cpsr):
+        """Return the OpenOCD name of sp or lr in the mode of cpsr"""
+        return "%s_%s" % (regname, MODE_BANKS.get(cpsr & 0x1f, "usr"))
+
     @halted
     def dump_all_registers(self)-> "dict{str: str 0xNNNNNNNN}":
         """
@@ -24,3 +24,25 @@ class Crc8():
     
     def get_crc(self):
         return self.crc
+
+def _make_crc32_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = crc & 0x80000000 and ((crc << 1) ^ 0x04c11db7) & 0xFFFFFFFF or (crc << 1) & 0xFFFFFFFF
+        table.append(crc)
+    return table
+
+CRC32_TABLE = _make_crc32_table()
+
+def gdb_crc32(data, crc = 0xFFFFFFFF):
+    """
+        Implements the CRC-32 of gdb's qCRC packet (polynomial 0x04c11db7,
+        most significant bit first, no final inversion), so that checksums
+        computed on the host can be compared with those of a gdb stub.
+    """
+    table = CRC32_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ byte]
+    return crc
@@ -0,0 +1,106 @@
+'''
+Register state carried with forwarded memory accesses.
+'''
+from collections.abc import Mapping
+
+class CpuState(Mapping):
+    """
+    Read-only, lazily decoded view of the register state sent by the
+    emulator with a forwarded access.
+
+    The view wraps whatever the wire format delivered (a dict of hex
+    strings, or register values in a fixed order) without copying it. A
+    register is only converted when a consumer asks for it, and the result
+    is cached. Indexing returns hex strings like the original dict did;
+    get_value() returns the integer.
+    """
+    __slots__ = ("_strings", "_names", "_raw_values", "_values")
+
+    def __init__(self, strings = None, names = None, values = None):
+        """
+        :param strings: Dict of register name to hex string, used as is
+        :param names: Register names, in the order of values, or a dict
+            of register name to index in values, which is used as is
+        :param values: Integer register values, in the order of names
+        """
+        #Views of register values allocate nothing else until a hex
+        #string is asked for, they are built for every forwarded access
+        self._strings = strings
+        if names is not None and not isinstance(names, dict):
+            names = dict((name, i) for (i, name) in enumerate(names))
+        self._names = names
+        self._raw_values = values
+        self._values = None
+
+    @classmethod
+    def from_strings(cls, strings):
+        return cls(strings = strings)
+
+    @classmethod
+    def from_values(cls, names, values):
+        return cls(names = names, values = values)
+
+    def get_value(self, name):
+        """Return the integer value of a register, raises KeyError for unknown ones"""
+        if self._raw_values is not None:
+            return self._raw_values[self._names[name]]
+        if self._values is None:
+            self._values = {}
+        else:
+            try:
+                return self._values[name]
+            except KeyError:
+                pass
+        value = int(self._strings[name], 16)
+        self._values[name] = value
+        return value
+
+    def get_values(self):
+        """Return a dict of all register values as integers"""
+        return dict((name, self.get_value(name)) for name in self)
+
+    def __getitem__(self, name):
+        if self._strings is None:
+            if self._raw_values is None:
+                raise KeyError(name)
+            self._strings = {}
+        else:
+            try:
+                return self._strings[name]
+            except KeyError:
+                if self._raw_values is None:
+                    raise
+        string = "0x%x" % self.get_value(name)
+        self._strings[name] = string
+        return string
+
+    def __contains__(self, name):
+        if self._names is not None:
+            return name in self._names
+        return self._strings is not None and name in self._strings
+
+    def __iter__(self):
+        if self._names is not None:
+            return iter(self._names)
+        return iter(self._strings or ())
+
+    def __len__(self):
+        if self._names is not None:
+            return len(self._names)
+        return self._strings is not None and len(self._strings) or 0
+
+    def __repr__(self):
+        return "CpuState(%s)" % ", ".join(["%s=%s" % (name, self[name]) for name in self])
+
+def to_cpu_state(cpu_state):
+    """Wrap a plain dict of hex strings, CpuState instances are returned unchanged"""
+    if isinstance(cpu_state, CpuState):
+        return cpu_state
+    return CpuState.from_strings(cpu_state)
+
+def get_pc(params):
+    """Return the PC sent with a forwarded request, or None"""
+    cpu_state = params and params.get("cpu_state")
+    if cpu_state is None or not "pc" in cpu_state:
+        return None
+    return to_cpu_state(cpu_state).get_value("pc")
@@ -22,3 +22,55 @@ def get_random_free_port(interface = '0.0.0.0'):
             return port
         except Exception as ex:
             raise ex
+
+UNIX_ADDRESS_PREFIX = "unix:"
+
+def is_unix_address(address):
+    """Return True for "unix:/path" socket addresses"""
+    return isinstance(address, str) and address.startswith(UNIX_ADDRESS_PREFIX)
+
+def format_address(address):
+    """Return a printable form of a (host, port) tuple or "unix:/path" address"""
+    if isinstance(address, str):
+        return address
+    return "%s:%d" % (address[0], address[1])
+
+def connect_socket(address, timeout = None):
+    """Connect to a (host, port) tuple or a "unix:/path" address"""
+    if is_unix_address(address):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address[len(UNIX_ADDRESS_PREFIX):])
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+    sock = socket.create_connection(address, timeout)
+    sock.settimeout(None)
+    return sock
+
+def listen_socket(address, backlog = 16):
+    """
+    Return a socket listening on a (host, port) tuple or a "unix:/path"
+    address. A stale unix socket file left over by a previous run is removed.
+    """
+    if is_unix_address(address):
+        path = address[len(UNIX_ADDRESS_PREFIX):]
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        path = address
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+def get_socket_address(sock):
+    """Return the address a socket is bound to, in the form accepted by connect_socket"""
+    if sock.family == socket.AF_UNIX:
+        return UNIX_ADDRESS_PREFIX + sock.getsockname()
+    return sock.getsockname()[:2]
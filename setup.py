@@ -12,6 +12,7 @@ setup(
                 'avatar/targets',
                 'avatar/plugins',
                 'avatar/util',
+                'avatar/forwarding',
                 'avatar/interfaces',
                 'avatar/interfaces/gdb',
                 'avatar/interfaces/avatar_stub',